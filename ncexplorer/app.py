@@ -6,11 +6,170 @@ Created on Nov 28, 2016
 import sys
 import logging
 import urllib2
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import xarray as xr
 from urlparse import urlparse
 from ncexplorer.config import repositories
+from ncexplorer.config import REGRID_WEIGHT_CACHE_DIR
+from ncexplorer.config import REGRID_WEIGHT_CACHE_SIZE
+from ncexplorer.config import REGRID_WEIGHT_CACHE_DISK_SIZE
+from ncexplorer.config import PRODUCT_CACHE_DIR, PRODUCT_CACHE_SIZE
+from ncexplorer.cache import weight_cache
+from ncexplorer.products import product_cache, cached_product
 from repository import NCXESGF, NCXURS, LocalDirectoryRepository
-from ncexplorer.util import simple_regrid
+from ncexplorer.util import simple_regrid, chunked_regrid, multi_regrid
+from ncexplorer.util import coarsen, gaussian_smooth
+from ncexplorer.util import Grid, GRID_025
+from ncexplorer.util import write_dataset, init_netcdf_worker
+from ncexplorer.jobs import RegridJob
+
+
+# The most repositories and files retrieved at once by bind_data.
+BIND_WORKERS = 8
+
+
+# The repositories report progress file by file.  When files are retrieved in
+# parallel, those reports go to the log, and the application's progress bar
+# counts finished files.
+class _LogProgressBar(object):
+    """A progress bar that writes its messages to a log."""
+    def __init__(self, logger):
+        self._logger = logger
+
+    def start(self, total_steps):
+        pass
+
+    def update(self, msg=""):
+        self._logger.debug(msg)
+
+    def close(self):
+        pass
+
+
+# The state of a worker process of Application.save(processes=True).  It is
+# only the datasets, where they go and the options, not the repositories
+# (with their database connections, locks and threads).  The datasets are
+# inherited when the worker is forked, rather than pickled and sent.
+_save_state = {}
+
+
+def _init_save_worker(targets, counter):
+    init_netcdf_worker()
+    _save_state['targets'] = targets
+    _save_state['counter'] = counter
+
+
+def _write_one(number):
+    ds, (filespec, store), options = _save_state['targets'][number]
+    progressbar = _CounterProgressBar(_save_state['counter'])
+    write_dataset(ds, filespec, store, progressbar=progressbar, **options)
+    return filespec
+
+
+def _push_one(repo, ds, options, counter):
+    return repo.push(_CounterProgressBar(counter), ds, **options)
+
+
+class _CounterProgressBar(object):
+    """A progress bar that counts its updates in shared memory, from
+    threads or processes."""
+    def __init__(self, counter):
+        self._counter = counter
+
+    def start(self, total_steps):
+        pass
+
+    def update(self, msg=""):
+        with self._counter.get_lock():
+            self._counter.value += 1
+
+    def close(self):
+        pass
+
+
+class SaveFuture(object):
+    """The pending result of Application.save().
+
+    The datasets are written in the background.  progress() is the fraction
+    of the writing done so far, and result() waits for the writing to finish
+    and returns the names of the files, in the order of the request.
+    """
+    def __init__(self, total_steps):
+        self.total_steps = total_steps
+        self._counter = multiprocessing.Value('l', 0)
+        self._finished = threading.Event()
+        self._results = None
+        self._errors = None
+
+    @property
+    def steps(self):
+        """The number of progress steps done so far."""
+        return self._counter.value
+
+    def progress(self):
+        """The fraction of the save done, from 0 to 1."""
+        if self.total_steps == 0:
+            return 1.0
+        return min(1.0, float(self.steps)/self.total_steps)
+
+    def done(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the save to finish.  Returns True if it has."""
+        self._finished.wait(timeout)
+        return self.done()
+
+    def exception(self, timeout=None):
+        """The first error of the save, or None."""
+        if not self.wait(timeout):
+            raise RuntimeError("The save has not finished.")
+        for err in self._errors:
+            if err is not None:
+                return err
+        return None
+
+    def errors(self):
+        """The error of each dataset (None if it was saved)."""
+        self.wait()
+        return list(self._errors)
+
+    def result(self, timeout=None):
+        """The names of the files written.
+
+        Raises the first error if any dataset could not be saved.
+        """
+        err = self.exception(timeout)
+        if err is not None:
+            raise err
+        return list(self._results)
+
+    # The pool is made by save(), in the thread that calls it.  Forking a
+    # process pool from the writer thread would copy the locks other threads
+    # hold.  calls are the (function, args) of each dataset.
+    def _run(self, pool, calls):
+        results = [None]*len(calls)
+        errors = [None]*len(calls)
+        try:
+            try:
+                pending = [pool.apply_async(function, args)
+                           for function, args in calls]
+                for number, async_result in enumerate(pending):
+                    try:
+                        results[number] = async_result.get()
+                    except Exception as err:
+                        errors[number] = err
+            finally:
+                pool.close()
+                pool.join()
+        except Exception as err:
+            errors = [err]*len(calls)
+        finally:
+            self._results = results
+            self._errors = errors
+            self._finished.set()
 
 
 def parse_params(param_str):
@@ -235,9 +394,24 @@ class Application(object):
         #
         # However, because regridding (FIX ME:  Need reference to more
         # detail on this subject) can take many hours to accomplish, the
-        # application will need to be able to save this work.
+        # application will need to be able to save this work.  See the
+        # checkpoint parameter of regrid().
         self.datasets = {}
 
+        # The files that could not be retrieved by the last bind_data().
+        self.bind_errors = []
+
+        # Regrid weights are saved to disk, so a pair of grids is triangulated
+        # only once, across sessions.
+        weight_cache.directory = REGRID_WEIGHT_CACHE_DIR
+        weight_cache.maxsize = REGRID_WEIGHT_CACHE_SIZE
+        weight_cache.maxbytes = REGRID_WEIGHT_CACHE_DISK_SIZE*1024*1024
+
+        # Regridded and smoothed variables are saved to disk too, and shared
+        # by everyone who uses the directory.
+        product_cache.directory = PRODUCT_CACHE_DIR
+        product_cache.maxbytes = PRODUCT_CACHE_SIZE*1024*1024
+
         # The variables.
         self.variables = {}
         
@@ -273,15 +447,62 @@ class Application(object):
         return usernames
 
     # FIXME:  This is hardcoded to /home/neil/workspace/data/neil
-    def save(self, request):
+    def save(self, request, background=False, workers=None,
+             processes=False, **options):
         """Saves a file to repository.
         
         Accepts a list of tuples of the form (repo, file).  Then calls the
-        corresponding repo's save() method with file."""
-        for repo_id, ds in request:
-            repo = self.repositories[repo_id]
-            progressbar = self._frame.progressbar('push')
-            repo.push(progressbar, ds)
+        corresponding repo's save() method with file.
+
+        The datasets are written in parallel, in a pool of up to workers
+        threads (by default one per CPU), waited for by a writer thread.
+        The netCDF library is called by one thread at a time, but reading,
+        packing and compressing the blocks (and writing Zarr stores) are
+        not.  If processes is True, each dataset is written in a process of
+        its own instead, which is forked here; only directory repositories
+        can be written that way.  If background is True, save returns a
+        SaveFuture at once.  Otherwise it shows the progress, and returns
+        the names of the files when they are written.  The options
+        (compress, complevel, shuffle, float32, access, store) are passed to
+        the repositories' push() methods.
+        """
+        jobs = [(self.repositories[repo_id], ds, options)
+                for repo_id, ds in request]
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = max(1, min(workers, len(jobs)))
+        future = SaveFuture(sum(repo.push_steps(ds, **o)
+                                for repo, ds, o in jobs))
+        if processes:
+            # The processes get where each dataset goes, not the
+            # repositories.
+            targets = [(ds, repo.push_target(ds, **o),
+                        dict((key, value) for key, value in o.items()
+                             if key != 'store'))
+                       for repo, ds, o in jobs]
+            pool = multiprocessing.Pool(workers, _init_save_worker,
+                                        (targets, future._counter))
+            calls = [(_write_one, (number,)) for number in range(len(jobs))]
+        else:
+            pool = ThreadPool(workers)
+            calls = [(_push_one, (repo, ds, o, future._counter))
+                     for repo, ds, o in jobs]
+        writer = threading.Thread(target=future._run, args=(pool, calls))
+        writer.daemon = True
+        writer.start()
+        if background:
+            return future
+
+        progressbar = self._frame.progressbar('push')
+        progressbar.start(future.total_steps)
+        shown = 0
+        while not future.wait(0.5) or shown < future.steps:
+            steps = future.steps
+            while shown < steps:
+                progressbar.update("Saving.")
+                shown += 1
+        progressbar.close()
+        return future.result()
 
     # FIX ME: This method would be more robust, and easier to test if it did
     # not presume the existence of a progress bar.  Better if it could work
@@ -374,7 +595,7 @@ class Application(object):
                 self._search_matches.add_file(handle, filename)
         return self._search_matches
 
-    def bind_data(self, request):
+    def bind_data(self, request, lazy=False, memory_budget=None):
         """Creates xarray dataset objects from the request.
 
         Cycles through the repositories, downloading the selected files, and
@@ -390,44 +611,83 @@ class Application(object):
             The second entry in the tuple can be the integer index of the
             specific file or the filename.  Both of these are listed in the
             application's search() method.
+
+        lazy : bool
+            If True, repositories that can do so open the files without
+            reading any data, and join files that make up a time series into
+            one dataset.  The data is read a chunk of about memory_budget
+            bytes at a time, when it's used.
         """
         # This can take a while, especially since it depends on external
-        # servers and the internet.
+        # servers and the internet.  The repositories, and the files of the
+        # repositories that can open files independently, are retrieved in
+        # a pool of threads.  Opening files waits mostly on the network and
+        # on the disk.
         progressbar = self._frame.progressbar('vars')
+        options = {}
+        if lazy:
+            options = {'lazy': True, 'memory_budget': memory_budget}
 
-        ds_index = 0
-#        for repo in self.repositories.itervalues():
+        tasks = []
         selections = self._search_matches.select(request)
         for i, repo, files in selections:
-
-            # Retrieving the data depends on the success of making an HTTP
-            # connection, logging on, and completing the conversation with the
-            # server.  When it fails, the reason it fails should be displayed
-            # to the user as a property of the server (repository?).
-            skipds = False
+            if repo.parallel_files and not lazy:
+                tasks.extend((repo, [item]) for item in files)
+            else:
+                tasks.append((repo, list(files)))
+
+        def retrieve(numbered_task):
+            number, (repo, files) = numbered_task
+            # The repository's own progress messages go to the log.  The
+            # progress bar counts whole tasks, and is only updated here, in
+            # this thread.
+            taskbar = _LogProgressBar(self._logger)
             try:
-                datasets = repo.retrieve_data(self._logger, progressbar, files)
-            except IOError as err:
-                if self._error_is_openid(err):
-                    self._logger.error(
-                        "OpenID error:  Access failure on node {0}.".format(repo.id)
-                    )
+                return number, repo.retrieve_data(self._logger, taskbar,
+                                                  files, **options), None
+            except Exception as err:
+                return number, None, err
+
+        # Results arrive in any order, and are put back in the order of the
+        # request.
+        results = [None]*len(tasks)
+        self.bind_errors = []
+        progressbar.start(len(tasks))
+        pool = ThreadPool(max(1, min(BIND_WORKERS, len(tasks))))
+        try:
+            for number, datasets, err in pool.imap_unordered(
+                    retrieve, enumerate(tasks)):
+                repo, files = tasks[number]
+                names = ", ".join(filename for j, filename in files)
+                if err is None:
+                    results[number] = datasets
+                    msg = "Retrieved: [{0}] {1}".format(repo.id, names)
                 else:
-                    self._logger.error("IO error: {0}".format(err))
-                skipds = True
+                    # Retrieving the data depends on the success of making an
+                    # HTTP connection, logging on, and completing the
+                    # conversation with the server.  A failure is reported
+                    # for the files it affects, and the rest carry on.
+                    self._report_bind_error(repo, names, err)
+                    msg = "Failed: [{0}] {1}".format(repo.id, names)
+                progressbar.update(msg)
+        finally:
+            pool.close()
+            pool.join()
 
-            # FIX ME: The error needs to be somehow pushed to the user
-            # interface.
-            if not skipds:
-                
-                # The variable datasets can be a list or a generator.  Assume
-                # it's a list if it's not a function.
-                if callable(datasets):
-                    self.datasets[ds_index] = datasets
-                else:
-                    for i in datasets:
-                        self.datasets[ds_index] = i
-                        ds_index += 1
+        ds_index = 0
+        for datasets in results:
+            if datasets is None:
+                continue
+
+            # The variable datasets can be a list or a generator.  Assume
+            # it's a list if it's not a function.
+            if callable(datasets):
+                self.datasets[ds_index] = datasets
+                ds_index += 1
+            else:
+                for dataset in datasets:
+                    self.datasets[ds_index] = dataset
+                    ds_index += 1
 
         if len(self.datasets) > 0:
             self._frame.display_variables(self.datasets)
@@ -471,6 +731,21 @@ class Application(object):
     # server serves a page explaining the a login is required instead of the
     # requested file.  The client process this as if it were a NetCDF file
     # and the parser fails.
+    # FIX ME: The error needs to be somehow pushed to the user interface.  In
+    # the meantime the failures of the last bind are kept in bind_errors.
+    def _report_bind_error(self, repo, names, err):
+        """Log a failure to retrieve files, and record it in bind_errors."""
+        self.bind_errors.append((repo.id, names, err))
+        if isinstance(err, IOError) and self._error_is_openid(err):
+            self._logger.error(
+                "OpenID error:  Access failure on node {0}.".format(repo.id))
+        elif isinstance(err, IOError):
+            self._logger.error("IO error: [{0}] {1}: {2}".format(
+                repo.id, names, err))
+        else:
+            self._logger.error("Error retrieving [{0}] {1}: {2}".format(
+                repo.id, names, err))
+
     def _error_is_openid(self, err):
         """Checks if the file retrieve failed due to an OpenID failure."""
         if "Access failure" in err.message:
@@ -480,29 +755,146 @@ class Application(object):
 
     # Utility Functions.
     # This first method should be a method of the xarray object.
-    def regrid(self, var, grid=None, likevar=None):
+    def regrid(self, var, grid=None, likevar=None, method='auto',
+               outfile=None, memory_budget=None, checkpoint=None,
+               min_coverage=None, cache=True):
         # This can take a while, especially if there is a lot of time data.
-        # If there are more than three dimensions, don't even try.  This case
-        # will require a very efficient algorithm, and most likely parallel
-        # processing..
-        if len(var.shape) > 3:
-            raise NotImplemented(
-                "Regridding a DataArray with more than latitude, longitude " +
-                "and time is not supported.")
-
-
-        if len(var.shape) == 2 or len(var.shape) == 3:
-            # Presume the dimensions are latitude, longitude and optionally
-            # time.
+        # Every dimension other than latitude and longitude (time, plev,
+        # realization, ...) is regridded with the same weights, in a single
+        # vectorized pass.  If the destination grid is an exact coarsening of
+        # the source grid, method 'auto' averages blocks of cells instead of
+        # interpolating.
+        self._check_horizontal(var, "Regridding")
+
+        # A long regrid can be run as a job that saves each block of time
+        # steps in the checkpoint directory.  Calling regrid again with the
+        # same directory resumes the job where it stopped.
+        if checkpoint is not None:
             progressbar = self._frame.progressbar('vars')
-            newvar = simple_regrid(var,
-                                   grid=grid,
-                                   likevar=likevar,
-                                   progressbar=progressbar)
+            job = RegridJob(var,
+                            checkpoint,
+                            grid=grid,
+                            likevar=likevar,
+                            method=method,
+                            memory_budget=memory_budget,
+                            min_coverage=min_coverage)
+            return job.run(progressbar=progressbar)
+
+        # A variable that is too big for memory is regridded a block of time
+        # steps at a time, straight to a file.
+        if outfile is not None:
+            progressbar = self._frame.progressbar('vars')
+            newvar = chunked_regrid(var,
+                                    outfile,
+                                    grid=grid,
+                                    likevar=likevar,
+                                    progressbar=progressbar,
+                                    method=method,
+                                    memory_budget=memory_budget,
+                                    min_coverage=min_coverage)
             return newvar
 
-        # The DataArray can't be regridded if we get here.
-        raise NotImplemented("Cannot regrid DataArray")
+        # The same variable is regridded to the same grid in session after
+        # session.  Unless cache is False, the result is saved in the product
+        # cache, and found there the next time.
+        def compute():
+            progressbar = self._frame.progressbar('vars')
+            return simple_regrid(var,
+                                 grid=grid,
+                                 likevar=likevar,
+                                 progressbar=progressbar,
+                                 method=method,
+                                 min_coverage=min_coverage)
+        if not cache:
+            return compute()
+
+        if grid is not None:
+            to_grid = grid
+        elif likevar is not None:
+            to_grid = Grid(array=likevar)
+        else:
+            to_grid = GRID_025
+        return cached_product('regrid', var, compute, grid=to_grid.digest,
+                              method=method, min_coverage=min_coverage)
+
+    def gaussian_smooth(self, var, sigma, method='auto', outfile=None,
+                        memory_budget=None, cache=True):
+        """Smooth a variable along time with a gaussian of sigma time steps.
+
+        See util.gaussian_smooth.  Unless outfile is given, or cache is
+        False, the result is saved in the product cache, and found there the
+        next time.
+        """
+        def compute():
+            progressbar = self._frame.progressbar('vars')
+            return gaussian_smooth(var,
+                                   sigma,
+                                   method=method,
+                                   outfile=outfile,
+                                   memory_budget=memory_budget,
+                                   progressbar=progressbar)
+        if outfile is not None or not cache:
+            return compute()
+
+        # The method changes the result only by rounding, so it isn't part
+        # of the key.
+        return cached_product('gaussian_smooth', var, compute, sigma=sigma)
+
+    def coarsen(self, var, factor=None, grid=None, likevar=None,
+                area_weighted=False, min_coverage=None):
+        """Coarsen a variable by averaging blocks of grid cells.
+
+        Either factor (the number of cells in a block, as an int or a
+        (lat, lon) pair) or a destination grid that is an exact coarsening of
+        the variable's grid must be given.
+        """
+        self._check_horizontal(var, "Coarsening")
+
+        progressbar = self._frame.progressbar('vars')
+        return coarsen(var,
+                       factor=factor,
+                       grid=grid,
+                       likevar=likevar,
+                       area_weighted=area_weighted,
+                       progressbar=progressbar,
+                       min_coverage=min_coverage)
+
+    # The horizontal dimensions are those of the variable's grid: lat and lon,
+    # or the dimensions of 2-D (curvilinear) or 1-D (unstructured) latitude
+    # and longitude coordinates.
+    def _check_horizontal(self, var, operation):
+        try:
+            dims = Grid(array=var).dims
+        except AttributeError:
+            dims = ('lat', 'lon')
+        if not all(dim in var.dims for dim in dims):
+            raise IndexError(
+                "{0} requires latitude and longitude coordinates.".format(
+                    operation))
+
+    def regrid_many(self, var, grids, method='auto', memory_budget=None,
+                    min_coverage=None):
+        """Regrid a variable onto each of a list of grids.
+
+        The variable is read only once.  Returns a list of the regridded
+        variables, in the same order as the grids.
+        """
+        progressbar = self._frame.progressbar('vars')
+        return multi_regrid(var,
+                            grids,
+                            progressbar=progressbar,
+                            method=method,
+                            memory_budget=memory_budget,
+                            min_coverage=min_coverage)
+
+    def regrid_cache_stats(self):
+        """Returns the hit and miss counts of the regrid weight cache."""
+        return weight_cache.stats()
+
+    def product_cache_stats(self):
+        """Returns the hit and miss counts, and the size, of the product
+        cache."""
+        return product_cache.stats()
 
 
 # The only purpose for a subclass of the Application class is to implement
@@ -0,0 +1,223 @@
+"""
+A cache of regrid weights, in memory and on disk.
+"""
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+import scipy
+from scipy import sparse
+
+import ncexplorer
+
+
+# The version of the weights.  Increase it when a change to a method changes
+# the weights it computes, so that the weights saved on disk by an earlier
+# version are not used.  The versions of the package and of scipy (whose
+# triangulation and trees compute them) are part of it too.
+WEIGHT_VERSION = "3-{0}-{1}".format(ncexplorer.__version__,
+                                    scipy.__version__)
+
+
+# The suffix of the files an entry is written to before it's renamed.
+TMP_SUFFIX = '.tmp.npz'
+
+
+# Triangulating a grid and computing the interpolation weights is by far the
+# most expensive part of a regrid, and the same few grids are regridded over
+# and over.  The weights depend only on the pair of grids and the method, so
+# they are cached, keyed by a hash of the grid coordinates.
+class WeightCache(object):
+    """A cache of regrid weights.
+
+    Parameters
+    ----------
+        maxsize (int) optional: The number of entries kept in memory.  When
+        the cache is full, the least recently used entry is evicted.
+
+        directory (str) optional: A directory in which every entry is also
+        saved as a compressed numpy file.  Entries evicted from memory, or
+        computed in an earlier session, are loaded from here.  If None, the
+        cache is memory only.
+
+        maxbytes (int) optional: The size of the directory.  When an entry
+        is saved and the files come to more than this, the least recently
+        used ones are removed.
+
+    An entry is a dictionary of numpy arrays and scipy sparse matrices.
+    """
+    def __init__(self, maxsize=32, directory=None, maxbytes=2*1024**3):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, method, *grids):
+        """Return a stable key for the method and the grids."""
+        digest = hashlib.sha1(WEIGHT_VERSION.encode('utf-8'))
+        digest.update(method.encode('utf-8'))
+        for grid in grids:
+            digest.update(grid.digest.encode('utf-8'))
+        return "{0}-{1}".format(method, digest.hexdigest())
+
+    def get(self, key):
+        """Return the entry for the key, or None if there is none."""
+        with self._lock:
+            if key in self._entries:
+                entry = self._entries.pop(key)
+                self._entries[key] = entry
+                self.hits += 1
+                return entry
+
+        entry = self._load(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.disk_hits += 1
+                self._remember(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        """Add the entry to the cache, and save it to disk."""
+        with self._lock:
+            self._remember(key, entry)
+        self._save(key, entry)
+
+    def clear(self):
+        """Empty the memory cache and reset the counts.
+
+        Entries saved to disk are not removed.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.disk_hits = 0
+
+    def stats(self):
+        """Return the hit and miss counts."""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'disk_hits': self.disk_hits,
+                'entries': len(self._entries)}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _remember(self, key, entry):
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _filespec(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    # Sparse matrices are flattened into their CSR components so that the
+    # whole entry fits in one compressed numpy file.
+    def _save(self, key, entry):
+        if self.directory is None:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        arrays = {}
+        for name, value in entry.items():
+            if sparse.issparse(value):
+                value = value.tocsr()
+                arrays[name + '__data'] = value.data
+                arrays[name + '__indices'] = value.indices
+                arrays[name + '__indptr'] = value.indptr
+                arrays[name + '__shape'] = np.array(value.shape)
+            else:
+                arrays[name] = np.asarray(value)
+
+        # Write to a temporary file and rename, so another process never
+        # sees a partially written file.  The temporary file is unique, so
+        # two threads saving the same entry don't write the same file.
+        filespec = self._filespec(key)
+        handle, tmpspec = tempfile.mkstemp(suffix=TMP_SUFFIX,
+                                           dir=self.directory)
+        os.close(handle)
+        try:
+            np.savez_compressed(tmpspec, **arrays)
+            os.rename(tmpspec, filespec)
+        except Exception:
+            os.remove(tmpspec)
+            raise
+        self._evict(keep=filespec)
+
+    def _files(self):
+        if self.directory is None or not os.path.isdir(self.directory):
+            return []
+        files = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.npz') or filename.endswith(TMP_SUFFIX):
+                continue
+            filespec = os.path.join(self.directory, filename)
+            try:
+                files.append((filespec, os.stat(filespec)))
+            except OSError:
+                continue
+        return files
+
+    # As ProductCache._evict: the least recently used files (by their
+    # modification time, which a load updates) are removed first.
+    def _evict(self, keep=None):
+        with self._lock:
+            files = sorted(self._files(), key=lambda item: item[1].st_mtime)
+            total = sum(stat.st_size for filespec, stat in files)
+            for filespec, stat in files:
+                if total <= self.maxbytes:
+                    break
+                if filespec == keep:
+                    continue
+                try:
+                    os.remove(filespec)
+                except OSError:
+                    continue
+                total -= stat.st_size
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        filespec = self._filespec(key)
+        try:
+            # The modification time is the time of last use.
+            os.utime(filespec, None)
+        except OSError:
+            return None
+
+        # Another process may remove the file (evicting it) at any time.
+        entry = {}
+        try:
+            with np.load(filespec) as npz:
+                for name in npz.files:
+                    if name.endswith('__data'):
+                        base = name[:-len('__data')]
+                        entry[base] = sparse.csr_matrix(
+                            (npz[name],
+                             npz[base + '__indices'],
+                             npz[base + '__indptr']),
+                            shape=tuple(npz[base + '__shape']))
+                    elif '__' not in name:
+                        entry[name] = npz[name]
+        except IOError:
+            return None
+        return entry
+
+
+# The cache shared by all the regrid functions.  The application sets the
+# directory from the configuration file.
+weight_cache = WeightCache()
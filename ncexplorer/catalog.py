@@ -0,0 +1,595 @@
+"""
+A catalog of the metadata of the files in a local repository, kept in SQLite.
+"""
+import os
+import json
+import sqlite3
+import threading
+import multiprocessing
+from collections import namedtuple, OrderedDict
+import numpy as np
+import xarray as xr
+import netCDF4
+
+from ncexplorer.util import is_zarr, netcdf_lock, init_netcdf_worker
+
+# Watching a directory for changes uses inotify if pyinotify is installed.
+# Otherwise the directory is polled.
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+# The catalog is kept in the directory it describes.  It, and the journal
+# files SQLite keeps beside it, are not data files.
+CATALOG_FILENAME = '.ncexplorer_catalog.sqlite'
+
+# The metadata files of a Zarr store, in the store and in each array's
+# directory.  The chunks are not metadata.
+ZARR_METADATA = ('.zgroup', '.zattrs', '.zarray', '.zmetadata')
+
+# The global attributes that get a column of their own, so that searching on
+# them is fast.
+CATALOG_ATTRS = ('institute_id', 'model_id', 'experiment_id')
+
+# Search parameters are named as for ESGF searches.  These are the columns
+# they match.
+SEARCH_COLUMNS = {
+    'institute': 'institute_id',
+    'institute_id': 'institute_id',
+    'model': 'model_id',
+    'model_id': 'model_id',
+    'experiment': 'experiment_id',
+    'experiment_id': 'experiment_id',
+    }
+
+# The ESGF facets that are named differently in the global attributes of the
+# files.  Any other parameter is looked for as the attribute of its name, or
+# of its name with _id appended.
+SEARCH_ATTRS = {
+    'time_frequency': ('frequency',),
+    'ensemble': ('variant_label', 'member_id'),
+    'realm': ('modeling_realm', 'realm'),
+    'project': ('project_id', 'mip_era', 'project'),
+    'cmor_table': ('table_id',),
+    }
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    filename TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    error TEXT,
+    institute_id TEXT,
+    model_id TEXT,
+    experiment_id TEXT,
+    time_start TEXT,
+    time_end TEXT,
+    lat_min REAL,
+    lat_max REAL,
+    lon_min REAL,
+    lon_max REAL,
+    attrs TEXT);
+CREATE TABLE IF NOT EXISTS variables (
+    filename TEXT,
+    name TEXT,
+    dims TEXT,
+    shape TEXT,
+    units TEXT,
+    long_name TEXT);
+CREATE INDEX IF NOT EXISTS variables_name ON variables (name);
+CREATE INDEX IF NOT EXISTS variables_filename ON variables (filename);
+"""
+
+
+def _attr_value(value):
+    # Attributes are numpy types, which JSON can't store.
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def _coordinate(nc, name, standard_name):
+    # The coordinate variable of a dimension, found by name or by the CF
+    # standard name.
+    if name in nc.variables:
+        return nc.variables[name]
+    for var in nc.variables.values():
+        if getattr(var, 'standard_name', None) == standard_name:
+            return var
+    return None
+
+
+def _time_range(nc):
+    time = _coordinate(nc, 'time', 'time')
+    if time is None or time.size == 0:
+        return None, None
+    ends = [time[0], time[-1]] if time.ndim == 1 else [time[:].min(),
+                                                        time[:].max()]
+    try:
+        dates = netCDF4.num2date(
+            np.asarray(ends, dtype=np.float64), time.units,
+            calendar=getattr(time, 'calendar', 'standard'))
+        return dates[0].isoformat(), dates[1].isoformat()
+    except (AttributeError, ValueError, TypeError):
+        return str(ends[0]), str(ends[1])
+
+
+def _bounds(nc, name, standard_name):
+    coord = _coordinate(nc, name, standard_name)
+    if coord is None or coord.size == 0:
+        return None, None
+    values = np.ma.filled(coord[:].astype(np.float64), np.NaN)
+    return float(np.nanmin(values)), float(np.nanmax(values))
+
+
+# A Zarr store, read through the few parts of the netCDF4.Dataset interface
+# that read_header uses.
+class _ZarrHeader(object):
+    def __init__(self, filespec):
+        self._ds = xr.open_zarr(filespec, decode_cf=False)
+        self.variables = OrderedDict((name, _ZarrVariable(var))
+                                     for name, var in
+                                     self._ds.variables.items())
+
+    def ncattrs(self):
+        return list(self._ds.attrs)
+
+    def getncattr(self, name):
+        return self._ds.attrs[name]
+
+    def close(self):
+        self._ds.close()
+
+
+class _ZarrVariable(object):
+    def __init__(self, var):
+        self._var = var
+        self.dimensions = var.dims
+        self.shape = var.shape
+        self.size = var.size
+        self.ndim = var.ndim
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_var'].attrs[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, key):
+        return np.asarray(self._var.values)[key]
+
+
+def read_header(filespec):
+    """Read the metadata of a NetCDF file or a Zarr store.
+
+    Only the header and the coordinate variables are read, not the data.
+    Returns a dictionary of the columns of the files table, with an extra
+    'variables' entry: a list of dictionaries, one per variable.
+    """
+    if is_zarr(filespec):
+        return _read_header(_ZarrHeader(filespec))
+    # A header is read under the netCDF lock, so a watcher reading headers
+    # in its thread doesn't call the library at the same time as the
+    # application.
+    with netcdf_lock():
+        return _read_header(netCDF4.Dataset(filespec, mode='r'))
+
+
+def _read_header(nc):
+    entry = {'error': None}
+    try:
+        attrs = dict((name, _attr_value(nc.getncattr(name)))
+                     for name in nc.ncattrs())
+        for name in CATALOG_ATTRS:
+            entry[name] = attrs.get(name)
+        entry['attrs'] = json.dumps(attrs)
+
+        entry['time_start'], entry['time_end'] = _time_range(nc)
+        entry['lat_min'], entry['lat_max'] = _bounds(nc, 'lat', 'latitude')
+        entry['lon_min'], entry['lon_max'] = _bounds(nc, 'lon', 'longitude')
+
+        entry['variables'] = [
+            {'name': name,
+             'dims': json.dumps(list(var.dimensions)),
+             'shape': json.dumps(list(var.shape)),
+             'units': _attr_value(getattr(var, 'units', None)),
+             'long_name': _attr_value(getattr(var, 'long_name', None))}
+            for name, var in nc.variables.items()]
+    finally:
+        nc.close()
+    return entry
+
+
+def _read_entry(filespec):
+    # The catalog entry of a file, or the error reading it.  A top level
+    # function, so that a process pool can call it.
+    try:
+        return read_header(filespec)
+    except (IOError, OSError, RuntimeError, KeyError, ValueError) as err:
+        return {'error': str(err)}
+
+
+StoreStat = namedtuple('StoreStat', ['st_mtime', 'st_size'])
+
+
+def store_stat(filespec):
+    """The modification time and size by which a change to a file is seen.
+
+    For a Zarr store, they are the latest modification time and the total
+    size of its metadata files, so that writing a chunk isn't a change, but
+    adding, removing or resizing an array is.
+    """
+    if not is_zarr(filespec):
+        return os.stat(filespec)
+
+    mtime = os.stat(filespec).st_mtime
+    size = 0
+    directories = [filespec] + [
+        os.path.join(filespec, name) for name in os.listdir(filespec)
+        if os.path.isdir(os.path.join(filespec, name))]
+    for directory in directories:
+        for name in ZARR_METADATA:
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            mtime = max(mtime, stat.st_mtime)
+            size += stat.st_size
+    return StoreStat(mtime, size)
+
+
+def is_data_file(filespec):
+    """Is filespec a file, or a Zarr store, that the catalog describes?"""
+    if os.path.basename(filespec).startswith(CATALOG_FILENAME):
+        return False
+    if is_zarr(filespec):
+        return os.path.isdir(filespec)
+    return os.path.isfile(filespec)
+
+
+# Reading the headers of thousands of files takes minutes.  The catalog reads
+# each file's header once, and searches are database queries that don't open
+# any file.
+class MetadataCatalog(object):
+    """A catalog of the metadata of the NetCDF files in a directory.
+
+    Parameters
+    ----------
+        directory (str): The directory of NetCDF files.  Zarr directory
+        stores (named *.zarr) in it are cataloged as files.
+
+        filespec (str) optional: The SQLite database file.  The default is
+        CATALOG_FILENAME in the directory.
+
+    For each file the catalog records the variables with their dimensions
+    and shapes, the time range, the latitude and longitude bounds, and the
+    global attributes.  Files that can't be read are recorded with the
+    error, so that they are not read again.
+    """
+    def __init__(self, directory, filespec=None):
+        self.directory = directory
+        if filespec is None:
+            filespec = os.path.join(directory, CATALOG_FILENAME)
+        self.filespec = filespec
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filespec, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock:
+            self._db.executescript(_SCHEMA)
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def data_files(self):
+        """The names of the data files and Zarr stores in the directory."""
+        return sorted(filename for filename in os.listdir(self.directory)
+                      if is_data_file(os.path.join(self.directory, filename)))
+
+    def filenames(self):
+        """The names of the files in the catalog, readable or not."""
+        with self._lock:
+            rows = self._db.execute("SELECT filename FROM files").fetchall()
+        return sorted(row['filename'] for row in rows)
+
+    def __contains__(self, filename):
+        with self._lock:
+            row = self._db.execute("SELECT 1 FROM files WHERE filename = ?",
+                                   (filename,)).fetchone()
+        return row is not None
+
+    def changes(self):
+        """Compare the directory with the catalog.
+
+        A file is changed if its modification time or size differs from when
+        it was cataloged.  Returns a list of the new and changed files, and a
+        list of the cataloged files that no longer exist.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT filename, mtime, size FROM files").fetchall()
+        known = dict((row['filename'], (row['mtime'], row['size']))
+                     for row in rows)
+
+        changed = []
+        present = set()
+        for filename in self.data_files():
+            present.add(filename)
+            try:
+                stat = store_stat(os.path.join(self.directory, filename))
+            except OSError:
+                continue
+            if known.get(filename) != (stat.st_mtime, stat.st_size):
+                changed.append(filename)
+        removed = sorted(set(known) - present)
+        return changed, removed
+
+    def refresh(self, workers=None):
+        """Bring the catalog up to date with the directory.
+
+        Only new and changed files have their headers read, in a pool of
+        workers processes (one per CPU if None).  Deleted files are dropped.
+        Returns the numbers of files (re)indexed and removed.
+        """
+        changed, removed = self.changes()
+        with self._lock:
+            for filename in removed:
+                self._delete(filename)
+            self._db.commit()
+        if len(changed) == 0:
+            return 0, len(removed)
+
+        # The modification times are taken before the headers are read, so a
+        # file that changes while it is read is read again next time.
+        stats = dict((filename,
+                      store_stat(os.path.join(self.directory, filename)))
+                     for filename in changed)
+        filespecs = [os.path.join(self.directory, filename)
+                     for filename in changed]
+
+        # The netCDF and HDF5 libraries are not thread safe, so the headers
+        # are read in processes.  One file isn't worth starting them.
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = min(workers, len(changed))
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, init_netcdf_worker)
+            try:
+                entries = pool.map(_read_entry, filespecs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            entries = [_read_entry(filespec) for filespec in filespecs]
+
+        for filename, entry in zip(changed, entries):
+            self.add(filename, entry, stats[filename])
+        return len(changed), len(removed)
+
+    def refresh_file(self, filename):
+        """Reindex one file, or drop it if it no longer exists."""
+        filespec = os.path.join(self.directory, filename)
+        if not is_data_file(filespec):
+            self.remove(filename)
+        else:
+            self.add(filename)
+
+    def add(self, filename, entry=None, stat=None):
+        """Add a file to the catalog, or replace its entry.
+
+        entry is the output of read_header.  If None, the header is read.
+        stat is the store_stat of the file when entry was read.
+        """
+        filespec = os.path.join(self.directory, filename)
+        if stat is None:
+            stat = store_stat(filespec)
+        if entry is None:
+            entry = _read_entry(filespec)
+
+        columns = ['filename', 'mtime', 'size', 'error', 'time_start',
+                   'time_end', 'lat_min', 'lat_max', 'lon_min', 'lon_max',
+                   'attrs'] + list(CATALOG_ATTRS)
+        values = dict(entry, filename=filename, mtime=stat.st_mtime,
+                      size=stat.st_size)
+        row = [values.get(column) for column in columns]
+        with self._lock:
+            self._delete(filename)
+            self._db.execute(
+                "INSERT INTO files ({0}) VALUES ({1})".format(
+                    ", ".join(columns), ", ".join('?'*len(columns))),
+                row)
+            self._db.executemany(
+                "INSERT INTO variables (filename, name, dims, shape, units, "
+                "long_name) VALUES (?, ?, ?, ?, ?, ?)",
+                [(filename, var['name'], var['dims'], var['shape'],
+                  var['units'], var['long_name'])
+                 for var in entry.get('variables', [])])
+            self._db.commit()
+
+    def remove(self, filename):
+        """Remove a file from the catalog."""
+        with self._lock:
+            self._delete(filename)
+            self._db.commit()
+
+    def _delete(self, filename):
+        self._db.execute("DELETE FROM files WHERE filename = ?", (filename,))
+        self._db.execute("DELETE FROM variables WHERE filename = ?",
+                         (filename,))
+
+    def entry(self, filename):
+        """The catalog entry of a file, as a dictionary, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT * FROM files WHERE filename = ?",
+                                   (filename,)).fetchone()
+            if row is None:
+                return None
+            variables = self._db.execute(
+                "SELECT * FROM variables WHERE filename = ? ORDER BY rowid",
+                (filename,)).fetchall()
+        entry = dict(zip(row.keys(), row))
+        entry['attrs'] = json.loads(entry['attrs'] or '{}')
+        entry['variables'] = [
+            {'name': var['name'],
+             'dims': tuple(json.loads(var['dims'])),
+             'shape': tuple(json.loads(var['shape'])),
+             'units': var['units'],
+             'long_name': var['long_name']}
+            for var in variables]
+        return entry
+
+    def search(self, **params):
+        """The names of the readable files that match the parameters.
+
+        variable matches the name of any variable in the file.  institute,
+        model and experiment (or institute_id, model_id and experiment_id)
+        match those global attributes.  The ESGF facets in SEARCH_ATTRS
+        match the attributes they correspond to, e.g. time_frequency
+        matches frequency, and ensemble matches variant_label or the
+        ensemble member (e.g. r1i1p1) of a CMIP5 file.  Any other parameter
+        matches the global attribute of that name, or of that name with _id
+        appended.  A value may be a list, of which any must match.  A file
+        that has none of the attributes a parameter is matched against is
+        not excluded by it.
+        """
+        clauses = ["error IS NULL"]
+        args = []
+        others = {}
+        for key, value in params.items():
+            if isinstance(value, (list, tuple)):
+                values = list(value)
+            else:
+                values = [value]
+            marks = ", ".join('?'*len(values))
+            if key == 'variable':
+                clauses.append(
+                    "filename IN (SELECT filename FROM variables "
+                    "WHERE name IN ({0}))".format(marks))
+            elif key in SEARCH_COLUMNS:
+                clauses.append("{0} IN ({1})".format(SEARCH_COLUMNS[key],
+                                                     marks))
+            else:
+                others[key] = [str(v) for v in values]
+                continue
+            args.extend(values)
+
+        query = "SELECT filename, attrs FROM files WHERE {0}".format(
+            " AND ".join(clauses))
+        with self._lock:
+            rows = self._db.execute(query, args).fetchall()
+
+        # Parameters without a column of their own are matched against the
+        # stored global attributes.  This still doesn't open any file.
+        matches = []
+        for row in rows:
+            if others:
+                attrs = json.loads(row['attrs'] or '{}')
+                if not all(_attr_matches(attrs, key, values)
+                           for key, values in others.items()):
+                    continue
+            matches.append(row['filename'])
+        return sorted(matches)
+
+
+def _attr_matches(attrs, key, values):
+    # Does a file with these global attributes match a search parameter?
+    names = SEARCH_ATTRS.get(key, (key, key + '_id'))
+    found = [str(attrs[name]) for name in names if name in attrs]
+    if key == 'ensemble' and 'realization' in attrs:
+        # CMIP5 files give the parts of the ensemble member separately.
+        found.append("r{0}i{1}p{2}".format(
+            attrs['realization'], attrs.get('initialization_method', 1),
+            attrs.get('physics_version', 1)))
+    if len(found) == 0:
+        return True
+    return any(value in values for value in found)
+
+
+# With tens of thousands of files, even comparing modification times takes a
+# while.  A watcher keeps the catalog current in the background, so a search
+# doesn't have to refresh it first.
+class CatalogWatcher(object):
+    """Keeps a catalog up to date as the files in its directory change.
+
+    Parameters
+    ----------
+        catalog (MetadataCatalog): The catalog to keep up to date.
+
+        interval (float) optional: Without inotify, the directory is
+        refreshed every interval seconds.
+
+    The files that change are reindexed in the watcher's thread, one at a
+    time, under the lock xarray reads files with.
+    """
+    def __init__(self, catalog, interval=60.0):
+        self.catalog = catalog
+        self.interval = interval
+        self._notifier = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._notifier is not None or self._thread is not None
+
+    def start(self):
+        """Start watching.  The catalog is refreshed first."""
+        if self.running:
+            return
+        self.catalog.refresh()
+        if pyinotify is not None:
+            self._start_inotify()
+        else:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._poll)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop watching."""
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _poll(self):
+        # Event.wait returns None in Python 2.6, so the flag is checked.
+        while True:
+            self._stop.wait(self.interval)
+            if self._stop.is_set():
+                break
+            # Processes are not forked from this thread: the headers are
+            # read here, one at a time, under the netCDF lock.
+            self.catalog.refresh(workers=1)
+
+    def _start_inotify(self):
+        catalog = self.catalog
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                path = os.path.relpath(event.pathname, catalog.directory)
+                top = path.split(os.sep)[0]
+                if path == top:
+                    if is_zarr(top) or not event.dir:
+                        catalog.refresh_file(top)
+                elif is_zarr(top) and event.name in ZARR_METADATA:
+                    catalog.refresh_file(top)
+
+        # A file is reindexed when it is closed after writing, not at every
+        # write.  The directories are watched too, for the metadata files of
+        # the Zarr stores, but not the chunks.
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE)
+        manager = pyinotify.WatchManager()
+        self._notifier = pyinotify.ThreadedNotifier(manager, Handler())
+        self._notifier.daemon = True
+        self._notifier.start()
+        manager.add_watch(self.catalog.directory, mask, rec=True,
+                          auto_add=True)
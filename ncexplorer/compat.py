@@ -0,0 +1,61 @@
+"""
+The parts of xarray used here that are not its public API, in one place.
+
+They are xarray 0.11's (setup.py requires it, the first with its own netCDF
+locks).  Where a later version moved or renamed something, it is handled
+here, and the rest of the package uses these functions instead.
+"""
+import numpy as np
+import xarray as xr
+
+# Indexing this wrapper of an array records the index instead of applying it.
+# The name changed in later versions of xarray.
+try:
+    from xarray.core.indexing import LazilyOuterIndexedArray as _LazyArray
+except ImportError:
+    from xarray.core.indexing import LazilyIndexedArray as _LazyArray
+from xarray.core.indexing import ExplicitlyIndexed
+from xarray.coding.variables import lazy_elemwise_func
+# The locks xarray holds around calls to the netCDF library, and a lock of
+# several locks.  Before 0.11, xarray had only a lock of its own.
+from xarray.backends.locks import HDF5_LOCK, NETCDFC_LOCK, combine_locks
+
+
+def variable_data(variable):
+    """The array a Variable holds: a numpy array, a dask array, or one of
+    xarray's lazily indexed wrappers of a file's variable."""
+    return variable._data
+
+
+def lazy_variable(variable):
+    """A Variable whose indexing is deferred until its values are used.
+
+    Data in memory is wrapped, as data read from a file already is.
+    Indexing a numpy array with index arrays would copy it.
+    """
+    data = variable_data(variable)
+    if isinstance(data, np.ndarray):
+        return xr.Variable(variable.dims, _LazyArray(data), variable.attrs,
+                           variable.encoding)
+    return variable
+
+
+def lazy_map(variable, func, dtype):
+    """The data of a Variable, with func applied to each part of it only
+    when the part is read.  func returns values of type dtype."""
+    data = lazy_elemwise_func(variable_data(variable), func, dtype)
+    # Dask arrays are lazy already.
+    if isinstance(data, ExplicitlyIndexed):
+        data = _LazyArray(data)
+    return data
+
+
+def to_temp_dataset(array):
+    """A DataArray as a Dataset (without loading it), to give back to
+    from_temp_dataset."""
+    return array._to_temp_dataset()
+
+
+def from_temp_dataset(array, dataset):
+    """The DataArray of a Dataset made by to_temp_dataset(array)."""
+    return array._from_temp_dataset(dataset)
@@ -33,6 +33,38 @@ repodirs = config.items('Directory Repositories')
 # Matplotlib backends
 MPL_BACKEND_REQUIREMENT = config.get('Matplotlib', 'mpl_backend_requirement')
 
+# Regridding.  The directory for the cache of regrid weights is optional.
+# Without it, the weights are cached only for the current session.
+if config.has_option('Regrid', 'weight_cache_dir'):
+    REGRID_WEIGHT_CACHE_DIR = os.path.expanduser(
+        config.get('Regrid', 'weight_cache_dir'))
+else:
+    REGRID_WEIGHT_CACHE_DIR = None
+if config.has_option('Regrid', 'weight_cache_size'):
+    REGRID_WEIGHT_CACHE_SIZE = config.getint('Regrid', 'weight_cache_size')
+else:
+    REGRID_WEIGHT_CACHE_SIZE = 32
+
+# The weights saved in the directory are kept to weight_cache_disk_size
+# megabytes.
+if config.has_option('Regrid', 'weight_cache_disk_size'):
+    REGRID_WEIGHT_CACHE_DISK_SIZE = config.getint('Regrid',
+                                                  'weight_cache_disk_size')
+else:
+    REGRID_WEIGHT_CACHE_DISK_SIZE = 2048
+
+# Regridded and smoothed variables are cached in this directory, if it is
+# given, up to product_cache_size megabytes.
+if config.has_option('Regrid', 'product_cache_dir'):
+    PRODUCT_CACHE_DIR = os.path.expanduser(
+        config.get('Regrid', 'product_cache_dir'))
+else:
+    PRODUCT_CACHE_DIR = None
+if config.has_option('Regrid', 'product_cache_size'):
+    PRODUCT_CACHE_SIZE = config.getint('Regrid', 'product_cache_size')
+else:
+    PRODUCT_CACHE_SIZE = 10240
+
 # Username and password to avoid logging in multiple times.
 TRIVIAL_USERNAME = config.get('Authentication', 'username')
 TRIVIAL_PASSWORD = config.get('Authentication', 'password')
@@ -323,8 +323,15 @@ class BaseFrame(object):
         self._display_variables(payload)
 
     # Utility functions.  These just call the corresponding app method.
-    def regrid(self, var, grid=None, likevar=None):
-        return self._app.regrid(var, grid, likevar)
+    def regrid(self, var, grid=None, likevar=None, method='auto'):
+        return self._app.regrid(var, grid, likevar, method)
+
+    def coarsen(self, var, factor=None, grid=None, area_weighted=False):
+        return self._app.coarsen(var, factor, grid,
+                                 area_weighted=area_weighted)
+
+    def regrid_many(self, var, grids, method='auto'):
+        return self._app.regrid_many(var, grids, method)
 
     # This method must be overridden.
     def mainloop(self):
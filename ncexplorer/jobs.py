@@ -0,0 +1,214 @@
+"""
+Regrid jobs that save their work as they go, and resume where they stopped.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import xarray as xr
+
+from ncexplorer.util import Grid, GRID_025
+from ncexplorer.util import regrid_weights, apply_weights
+from ncexplorer.util import regridded_coords, regridded_attrs
+from ncexplorer.util import batch_dims, time_block_length, time_blocks
+from ncexplorer.products import fingerprint
+
+
+MANIFEST = 'manifest.json'
+
+
+# Regridding a long time series can take hours.  A job saves each block of
+# time steps to its own file as soon as it is done, and records it in a
+# manifest.  If the job is interrupted (a crash, Ctrl-C, a restart), running
+# it again with the same directory picks up at the first unfinished block.
+class RegridJob(object):
+    """A regrid that saves its work as it goes.
+
+    Parameters
+    ----------
+        var (DataArray): The variable to regrid.  It must have a time
+        dimension.
+
+        directory (str): Where the blocks and the manifest are saved.  If the
+        directory holds an earlier run of the same job, that run is resumed,
+        in the blocks it was started with, whatever the memory_budget.
+
+        grid, likevar, method, memory_budget, min_coverage, options: As for
+        util.chunked_regrid.
+
+    The directory can be read with load_regrid_job() at any time, including
+    while the job is running, to see the blocks finished so far.
+    """
+    def __init__(self, var, directory, grid=None, likevar=None,
+                 method='auto', memory_budget=None, min_coverage=None,
+                 **options):
+        if 'time' not in var.dims:
+            msg = "A regrid job requires a time dimension."
+            raise IndexError(msg)
+
+        if grid is not None:
+            self.to_grid = grid
+        elif likevar is not None:
+            self.to_grid = Grid(array=likevar)
+        else:
+            self.to_grid = GRID_025
+
+        self.var = var
+        self.directory = directory
+        self.method = method
+        self.min_coverage = min_coverage
+        self.options = options
+        self.from_grid = Grid(array=var)
+
+        # Time is the first dimension, so the blocks are concatenated along
+        # it when they are loaded.
+        dims = ['time'] + [dim for dim in batch_dims(var, self.from_grid.dims)
+                           if dim != 'time']
+        self.dims = dims + list(self.from_grid.dims)
+        self.to_dims = dims + list(self.to_grid.dims)
+        slabs = int(np.prod([var.sizes[dim] for dim in dims[1:]]))
+        self.block_length = time_block_length(self.from_grid, self.to_grid,
+                                              memory_budget, slabs=slabs)
+        self.blocks = list(time_blocks(var.sizes['time'], self.block_length))
+
+        self.manifest = self._open_manifest()
+        self.block_length = self.manifest['block_length']
+        self.blocks = [tuple(block) for block in self.manifest['blocks']]
+
+    @property
+    def completed(self):
+        """The numbers of the blocks that are done."""
+        return sorted(self.manifest['completed'])
+
+    @property
+    def done(self):
+        return len(self.manifest['completed']) == len(self.blocks)
+
+    def run(self, progressbar=None):
+        """Regrid the blocks that are not done yet.
+
+        Returns the regridded variable.
+        """
+        print "Regridding from {0} to {1} in {2}.".format(
+            str(self.from_grid), str(self.to_grid), self.directory)
+        weights = regrid_weights(self.from_grid, self.to_grid,
+                                 method=self.method, **self.options)
+
+        name = self.manifest['name']
+        attrs = regridded_attrs(self.var, self.to_grid)
+        source = self.var.transpose(*self.dims)
+        ntimes = len(self.var.time)
+        if progressbar is not None:
+            progressbar.start(len(self.blocks))
+
+        for number, (start, stop) in enumerate(self.blocks):
+            if number in self.manifest['completed']:
+                msg = "Time steps {0} to {1} were already done.".format(
+                    start, stop - 1)
+            else:
+                block = source.isel(time=slice(start, stop))
+                newblock = xr.DataArray(
+                    apply_weights(weights, block.values, self.min_coverage),
+                    name=name,
+                    attrs=attrs,
+                    coords=regridded_coords(block, self.to_grid,
+                                            self.from_grid.dims),
+                    dims=self.to_dims)
+                self._save_block(number, newblock)
+                msg = "Regridded time steps {0} to {1} of {2}.".format(
+                    start, stop - 1, ntimes)
+            if progressbar is not None:
+                progressbar.update(msg)
+
+        return self.result()
+
+    def result(self):
+        """The blocks that are done, as one DataArray."""
+        return load_regrid_job(self.directory)
+
+    # The job is identified by the grids, the method, the shape and times of
+    # the variable, and where its data come from (see products.fingerprint).
+    # A directory that holds a different job is not overwritten.  The blocks
+    # are not part of it: they are in the manifest, and a job resumed with
+    # another memory_budget carries on with them.
+    def _key(self):
+        sha = hashlib.sha1()
+        for item in (self.method, self.min_coverage,
+                     sorted(self.options.items()),
+                     self.from_grid.digest, self.to_grid.digest,
+                     self.dims, [self.var.sizes[dim] for dim in self.dims],
+                     [str(time) for time in self.var.time.values],
+                     fingerprint(self.var), str(self.var.name)):
+            sha.update(repr(item).encode('utf-8'))
+        return sha.hexdigest()
+
+    def _open_manifest(self):
+        key = self._key()
+        filespec = os.path.join(self.directory, MANIFEST)
+        if os.path.exists(filespec):
+            with open(filespec) as f:
+                manifest = json.load(f)
+            if manifest['key'] != key:
+                msg = ("The directory {0} holds a different regrid job."
+                       ).format(self.directory)
+                raise ValueError(msg)
+            return manifest
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        manifest = {'key': key,
+                    'name': self.var.name or 'regridded',
+                    'grid': str(self.to_grid),
+                    'method': self.method,
+                    'block_length': self.block_length,
+                    'blocks': self.blocks,
+                    'completed': []}
+        self._write_manifest(manifest)
+        return manifest
+
+    # The manifest and the blocks are written to a temporary file and then
+    # renamed.  A rename is atomic, so a reader never sees half a file, and
+    # an interrupted write leaves the job as it was.
+    def _write_manifest(self, manifest):
+        filespec = os.path.join(self.directory, MANIFEST)
+        tmpspec = filespec + '.tmp'
+        with open(tmpspec, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.rename(tmpspec, filespec)
+
+    def _save_block(self, number, block):
+        filespec = os.path.join(self.directory, block_filename(number))
+        tmpspec = filespec + '.tmp'
+        block.to_dataset().to_netcdf(tmpspec)
+        os.rename(tmpspec, filespec)
+
+        self.manifest['completed'].append(number)
+        self._write_manifest(self.manifest)
+
+
+def block_filename(number):
+    return "block_{0:05d}.nc".format(number)
+
+
+def load_regrid_job(directory):
+    """Load the finished blocks of a regrid job.
+
+    Only the blocks recorded in the manifest are loaded, so this is safe to
+    call while the job is running.  Returns None if no block is done.  The
+    blocks are opened lazily, each a dask chunk of the result, and are read
+    when the values are used.
+    """
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+    completed = sorted(manifest['completed'])
+    if len(completed) == 0:
+        return None
+
+    blocks = []
+    for number in completed:
+        filespec = os.path.join(directory, block_filename(number))
+        ds = xr.open_dataset(filespec, chunks={})
+        blocks.append(ds[manifest['name']])
+    newvar = xr.concat(blocks, dim='time')
+    newvar.attrs['missing_value'] = 'nan'
+    return newvar
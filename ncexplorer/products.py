@@ -0,0 +1,279 @@
+"""
+A cache of derived products (regridded and smoothed variables) on disk.
+"""
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+import xarray as xr
+from xarray.conventions import decode_cf_variable
+
+import ncexplorer
+from ncexplorer.util import write_netcdf
+from ncexplorer.compat import variable_data
+from ncexplorer.catalog import store_stat
+
+
+# The version of the products.  A product cached by an earlier version of the
+# package, whose regrid or smoothing may have been different, is not used.
+PRODUCT_VERSION = "{0}-{1}".format(ncexplorer.__version__, xr.__version__)
+
+# The global attribute in which the attributes of the product are saved.
+# write_netcdf doesn't write some of them (e.g. a missing_value of 'nan').
+PRODUCT_ATTRS = 'ncexplorer_attrs'
+
+# The global attribute that lists the variables of the product that had
+# decoded (datetime) values.  The others are read back as they were, so a
+# time in numbers stays in numbers.
+PRODUCT_DECODED = 'ncexplorer_decoded'
+
+
+def _update_array(sha, values):
+    values = np.asarray(values)
+    sha.update(repr((values.shape, str(values.dtype))).encode('utf-8'))
+    if values.dtype.kind == 'O':
+        sha.update(repr(values.tolist()).encode('utf-8'))
+    else:
+        sha.update(np.ascontiguousarray(values).tostring())
+
+
+def _source_identity(source):
+    # A file is identified by its name, its modification time and its size.
+    # Anything else (a URL) only by its name.
+    if isinstance(source, (list, tuple)):
+        return [_source_identity(part) for part in source]
+    try:
+        stat = store_stat(source)
+    except (OSError, TypeError):
+        return source
+    return (os.path.abspath(source), stat.st_mtime, stat.st_size)
+
+
+def _in_memory(data):
+    # Is the array, under any lazy indexing, a numpy array?  Then reading it
+    # costs no I/O.
+    while not isinstance(data, np.ndarray) and hasattr(data, 'array'):
+        data = data.array
+    return isinstance(data, np.ndarray)
+
+
+def fingerprint(var):
+    """A digest that is the same for two DataArrays only if their data are.
+
+    The name, dimensions, attributes and coordinates are always part of it.
+    The data are identified, in order of preference:
+
+        * by their values, if they are in memory.
+        * by the file they are read from (its name, modification time and
+          size), if they are not loaded yet.  The coordinates identify the
+          part of the file that is selected.  open_local records the file in
+          the encoding of each variable.
+        * by the name and the chunks of the dask array.  dask derives the
+          name from where the array came from.
+
+    The data are never read to make the fingerprint.  If none of these
+    identifies them (e.g. data read lazily from an OPeNDAP server), returns
+    None: the variable can't be cached.
+    """
+    sha = hashlib.sha1()
+    sha.update(repr((var.name, var.dims, var.shape,
+                     str(var.dtype))).encode('utf-8'))
+    sha.update(repr(sorted((str(key), repr(value))
+                           for key, value in var.attrs.items())
+                    ).encode('utf-8'))
+    for name in sorted(var.coords):
+        coord = var.coords[name]
+        sha.update(repr((name, coord.dims)).encode('utf-8'))
+        _update_array(sha, coord.values)
+
+    data = variable_data(var.variable)
+    source = var.encoding.get('source')
+    if isinstance(data, np.ndarray):
+        _update_array(sha, data)
+    elif source is not None:
+        sha.update(repr(_source_identity(source)).encode('utf-8'))
+    elif hasattr(data, 'dask'):
+        sha.update(repr((data.name, data.chunks)).encode('utf-8'))
+    elif _in_memory(data):
+        _update_array(sha, var.values)
+    else:
+        return None
+    return sha.hexdigest()
+
+
+# Regridding or smoothing a long time series takes hours, and the same
+# products are made again and again, by everyone who uses the data.  A
+# product is saved to a NetCDF file named by a digest of its input and of
+# the operation, and found again by the same digest.
+class ProductCache(object):
+    """A cache of regridded and smoothed variables, on disk.
+
+    Parameters
+    ----------
+        directory (str) optional: The directory of the cache.  If None, the
+        cache is off: nothing is saved or found.
+
+        maxbytes (int) optional: The size of the cache.  When a product is
+        added and the files come to more than this, the least recently used
+        ones are removed.
+
+    A product found in the cache is returned as a DataArray backed by its
+    file, which is read only when its values are used.
+    """
+    def __init__(self, directory=None, maxbytes=10*1024**3):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, operation, var, **params):
+        """Return the key of the product of the operation on var, or None if
+        var has no fingerprint."""
+        digest = fingerprint(var)
+        if digest is None:
+            return None
+        sha = hashlib.sha1()
+        for item in (PRODUCT_VERSION, operation, digest,
+                     sorted(params.items())):
+            sha.update(repr(item).encode('utf-8'))
+        return "{0}-{1}".format(operation, sha.hexdigest())
+
+    def get(self, key):
+        """Return the product for the key, or None if there is none."""
+        if self.directory is None:
+            return None
+        filespec = self._filespec(key)
+        try:
+            # The modification time is the time of last use.
+            os.utime(filespec, None)
+            ds = xr.open_dataset(filespec, decode_times=False)
+        except (IOError, OSError, RuntimeError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Only the times that were decoded in the product are decoded.
+        for name in json.loads(ds.attrs.get(PRODUCT_DECODED, '[]')):
+            variable = decode_cf_variable(name, ds[name].variable)
+            if name in ds.coords:
+                ds.coords[name] = variable
+            else:
+                ds[name] = variable
+
+        name = ds.attrs['name']
+        var = ds[name]
+        var.attrs = json.loads(ds.attrs[PRODUCT_ATTRS])
+        with self._lock:
+            self.hits += 1
+        return var
+
+    def put(self, key, var):
+        """Save the product, and remove the least recently used products if
+        the cache is too big."""
+        if self.directory is None:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        name = var.name or 'product'
+        ds = var.to_dataset(name=name)
+        ds.attrs['name'] = name
+        ds.attrs[PRODUCT_ATTRS] = json.dumps(
+            dict((key, value.tolist() if hasattr(value, 'tolist') else value)
+                 for key, value in var.attrs.items()))
+        ds.attrs[PRODUCT_DECODED] = json.dumps(
+            [vname for vname, variable in ds.variables.items()
+             if variable.dtype.kind in 'mM'])
+
+        # Write to a temporary file and rename, so another process never
+        # sees a partially written file.
+        filespec = self._filespec(key)
+        tmpspec = "{0}.{1}.tmp".format(filespec, os.getpid())
+        write_netcdf(ds, tmpspec)
+        os.rename(tmpspec, filespec)
+        self._evict(keep=filespec)
+
+    def clear(self):
+        """Remove every product, and reset the counts."""
+        with self._lock:
+            for filespec, stat in self._files():
+                os.remove(filespec)
+            self.hits = 0
+            self.misses = 0
+
+    def size(self):
+        """The size of the products on disk, in bytes."""
+        return sum(stat.st_size for filespec, stat in self._files())
+
+    def stats(self):
+        """Return the hit and miss counts."""
+        files = self._files()
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(files),
+                'bytes': sum(stat.st_size for filespec, stat in files)}
+
+    def _filespec(self, key):
+        return os.path.join(self.directory, key + '.nc')
+
+    def _files(self):
+        if self.directory is None or not os.path.isdir(self.directory):
+            return []
+        files = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.nc'):
+                continue
+            filespec = os.path.join(self.directory, filename)
+            try:
+                files.append((filespec, os.stat(filespec)))
+            except OSError:
+                continue
+        return files
+
+    # A product that is open is still readable when it is removed, until it
+    # is closed.
+    def _evict(self, keep=None):
+        with self._lock:
+            files = sorted(self._files(), key=lambda item: item[1].st_mtime)
+            total = sum(stat.st_size for filespec, stat in files)
+            for filespec, stat in files:
+                if total <= self.maxbytes:
+                    break
+                if filespec == keep:
+                    continue
+                try:
+                    os.remove(filespec)
+                except OSError:
+                    continue
+                total -= stat.st_size
+
+
+# The cache shared by the application.  The application sets the directory
+# and the size from the configuration file.
+product_cache = ProductCache()
+
+
+def cached_product(operation, var, compute, cache=None, **params):
+    """Return the product of an operation on var, from the cache if it's
+    there.
+
+    Otherwise compute() makes the product, which is saved in the cache.  The
+    params are what, besides var, the product depends on.  A variable
+    without a fingerprint is not cached.
+    """
+    if cache is None:
+        cache = product_cache
+    if cache.directory is None:
+        return compute()
+
+    key = cache.key(operation, var, **params)
+    if key is None:
+        return compute()
+    product = cache.get(key)
+    if product is not None:
+        return product
+    product = compute()
+    cache.put(key, product)
+    return product
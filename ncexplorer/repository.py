@@ -3,8 +3,11 @@ Created on Dec 21, 2016
 
 @author: neil
 '''
-import os
 import ntpath
+import importlib
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from webob.exc import HTTPError
 from pyesgf.logon import LogonManager
 from pydap.cas.esgf import setup_session
@@ -19,7 +22,10 @@ from ncexplorer.config import CFG_ESGF_NODE
 from ncexplorer.config import CFG_ESGF_SEARCH_NODE
 from ncexplorer.config import CFG_ESGF_OPENID_NODE
 from ncexplorer.config import TRIVIAL_USERNAME, TRIVIAL_PASSWORD
-from ncexplorer.util import get_urs_file
+from ncexplorer.util import get_urs_file, decode_dataset, Grid
+from ncexplorer.util import write_dataset, write_steps
+from ncexplorer.util import open_local
+from ncexplorer.catalog import MetadataCatalog, CatalogWatcher
 from fileinput import filename
 from platform import node
 
@@ -143,6 +149,10 @@ class NCXRepository(object):
     repository if required.
     """
 #    shortname = None
+
+    # True if retrieving each file on its own, in parallel with the others,
+    # gives the same datasets as retrieving them together.
+    parallel_files = False
     
     def __init__(self, repospec):
 
@@ -187,7 +197,7 @@ class NCXRepository(object):
         pass
     def _search(self, log, progressbar):
         pass
-    def _retrieve_data(self, log, progressbar, files):
+    def _retrieve_data(self, log, progressbar, files, **options):
         pass
 
     # The repository will have occasion to call the parent application's
@@ -200,13 +210,35 @@ class NCXRepository(object):
         # Let the subclass choose the authentication method.
         self._authenticator = self._set_authenticator()
 
-    def push(self, progressbar, ds):
-        """Push the dataset from the client to the repository."""
-        return self._push(progressbar, ds)
+    def push(self, progressbar, ds, **options):
+        """Push the dataset from the client to the repository.
+
+        The options (e.g. compress, float32) are understood by some
+        repositories and ignored by the others.
+        """
+        return self._push(progressbar, ds, **options)
+
+    def push_steps(self, ds, **options):
+        """The number of progress updates push() makes for the dataset."""
+        return 1
+
+    def push_target(self, ds, store=None, **options):
+        """The file push() writes the dataset to, and its store.
+
+        Returns (filespec, store), for write_dataset.  A repository that
+        isn't a directory has no file to write in another process.
+        """
+        msg = "{0} can't be written by another process.".format(
+            type(self).__name__)
+        raise NotImplementedError(msg)
 
-    def retrieve_data(self, log, progressbar, files):
-        """Retrieve the data specified in the saved OpenDAP URLS."""
-        return self._retrieve_data(log, progressbar, files)
+    def retrieve_data(self, log, progressbar, files, **options):
+        """Retrieve the data specified in the saved OpenDAP URLS.
+
+        The options (e.g. lazy=True) are understood by some repositories and
+        ignored by the others.
+        """
+        return self._retrieve_data(log, progressbar, files, **options)
 
     # The search parameters are set here, at the level of the base class, in an
     # attempt to standardize the search parameters across repositories.  This
@@ -231,17 +263,13 @@ class NCXRepository(object):
         """Routine cleaning of the dataset.
 
         The dataset passed as a parameter is mutable so it gets modified.
+        Missing values are replaced with numpy's NaN, and packed values
+        (scale_factor and add_offset) are unpacked.  Nothing is read here:
+        each variable is decoded a piece at a time, as it is read.
         """
-        # Replace missing values with numpy's NaN.  The missing value is
-        # usually 1e+20, but values can be like 1.0000002e+20, which is
-        # different.  Ergo the inequality.
-        for var in dataset.data_vars.itervalues():
-            if 'missing_value' in var.attrs:
-                missing_data_value = var.missing_value
-                try:
-                    var.values[var.values >= missing_data_value] = np.NaN
-                except ValueError:
-                    print "Encountered ValueError in {0}.  Ignoring".format(var.name)
+        # Decoding the whole dataset up front was the biggest bottleneck of
+        # searching and retrieving data.
+        decode_dataset(dataset)
 
 #        # FIX ME: This should check if the time type is monClim.  Also, check
 #        # to see if the first value should be 15.5.  In the meantime, so that
@@ -318,7 +346,7 @@ class NCXURS(NCXRepository):
         # available on this repository.
         self._urls = ['3B43.[YYYYMMDD].[hh].7.HDF']
                         
-    def _retrieve_data(self, log, progressbar, files):
+    def _retrieve_data(self, log, progressbar, files, **options):
         
 #        temp_ds = []
 #        for i, remotefile in files:
@@ -361,7 +389,10 @@ class NCXESGF(NCXRepository):
         """Execute the search using the pyesgf library.
         
         Execute the search using the pyesgf library, which uses the ESGF
-        search API.  Stores a list of OpenDAP URLs as resources.
+        search API.  Stores a list of OpenDAP URLs as resources.  The files
+        of the datasets found are searched concurrently (see search_files),
+        up to the repository's 'search_workers' at once, and 'node_workers'
+        at once to one index node.
         """
         # FIXME: This should be part of the initialization.
         # The urls() method must return a list.
@@ -381,36 +412,56 @@ class NCXESGF(NCXRepository):
 
         # Each search clears the files from before.  The pyesgf library allows
         # for searches to be refined.  Consider utilizing that capability here.
-        if hit_count > 0:
+        if hit_count == 0:
+            return
+        if progressbar is not None:
             progressbar.start(hit_count)
 #            self._variable = self._search_params['variable']
-            datasets = ctx.search()
-            i = 1
-            for dsresult in datasets:
-                if 'variable' in self._search_params:
-                    remotefiles = dsresult.file_context().search(
-                        variable=self._search_params['variable'])
-                else:
-                    remotefiles = dsresult.file_context().search()
-                msg = "Searching %s of %s.  %s files." % (i, hit_count, len(remotefiles))
+        if 'variable' in self._search_params:
+            file_params = {'variable': self._search_params['variable']}
+        else:
+            file_params = {}
+
+        # The file searches of the datasets are made at the same time, and
+        # their files are added as they come in.  A filename found in more
+        # than one dataset gets the URL from the last of them, as if they
+        # were searched one after the other.
+        owners = {}
+        done = 0
+        for number, files, error in search_files(
+                ctx.search(),
+                workers=self._repo_parameters.get('search_workers'),
+                node_limit=self._repo_parameters.get('node_workers'),
+                **file_params):
+            done += 1
+            if error is not None:
+                msg = "Searching {0} of {1} failed: {2}".format(
+                    done, hit_count, error)
+                log.warning(msg)
+            else:
+                msg = "Searching {0} of {1}.  {2} files.".format(
+                    done, hit_count, len(files))
                 log.debug(msg)
-    
-                for remotefile in remotefiles:
-                    try:
-                        urlobj = urlparse(remotefile.opendap_url)
-                        filename = urlobj.path.split('/')[-1]
-                        self._urls[filename] = remotefile.opendap_url
-                    except AttributeError:
-                        print "Missing OPeNDAP URL found."
-                i += 1
+
+            for name, url in files:
+                if url is None:
+                    print "Missing OPeNDAP URL found."
+                elif number >= owners.get(name, -1):
+                    owners[name] = number
+                    self._urls[name] = url
+            if progressbar is not None:
                 progressbar.update(msg)
 
     # Not permitted to push files to the ESGF repositoris.
-    def _push(self, progressbar, ds):
+    def _push(self, progressbar, ds, **options):
         msg = "ESGF repository is read only.  Pushing data not permitted."
         raise TypeError(msg)
 
-    def _retrieve_data(self, log, progressbar, files):
+    def push_target(self, ds, **options):
+        msg = "ESGF repository is read only.  Pushing data not permitted."
+        raise TypeError(msg)
+
+    def _retrieve_data(self, log, progressbar, files, **options):
         """Retrieve data using the pyesgf library.
 
         Execute the search using the pyesgf library, which uses the ESGF
@@ -511,13 +562,145 @@ class NCXESGF(NCXRepository):
 #        dataset.coords['time'] -= time0
 
 
+# The number of file searches made at the same time, and the number of them
+# made to any one index node.
+SEARCH_WORKERS = 16
+NODE_WORKERS = 4
+
+
+# A search can hit hundreds of datasets, each with a search of its own for
+# its files.  One after the other, each waits for a round trip to an index
+# node.
+class _NodeLimits(object):
+    """A semaphore for each node, bounding the requests made to it at once.
+
+    The datasets whose node isn't known aren't bounded, but for the number
+    of workers: they are likely on different nodes.
+    """
+    def __init__(self, limit):
+        self._limit = limit
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def __call__(self, index_node):
+        if index_node is None:
+            return _NoLimit()
+        with self._lock:
+            if index_node not in self._semaphores:
+                self._semaphores[index_node] = threading.BoundedSemaphore(
+                    self._limit)
+            return self._semaphores[index_node]
+
+
+class _NoLimit(object):
+    # Stands in for a semaphore that is never full.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+def _result_node(dsresult):
+    # The index node that holds the dataset's files.
+    record = getattr(dsresult, 'json', None) or {}
+    return record.get('index_node') or record.get('data_node')
+
+
+def _interleave(dsresults):
+    # The datasets, numbered in the order of the search, taking one from each
+    # node in turn.  A worker waiting on a busy node then has others to
+    # work on.
+    queues = {}
+    nodes = []
+    for number, dsresult in enumerate(dsresults):
+        index_node = _result_node(dsresult)
+        if index_node not in queues:
+            queues[index_node] = []
+            nodes.append(index_node)
+        queues[index_node].append((number, dsresult))
+    tasks = []
+    for turn in range(max([len(queue) for queue in queues.values()] or [0])):
+        tasks.extend(queues[index_node][turn] for index_node in nodes
+                     if turn < len(queues[index_node]))
+    return tasks
+
+
+def search_files(dsresults, workers=None, node_limit=None, **params):
+    """Search the files of each of the datasets found by a search, at once.
+
+    Each dataset's file search is made in a pool of workers threads, no
+    more than node_limit of them to the same index node.  Yields (number,
+    files, error) as each search finishes, in no particular order: number is
+    the dataset's place in dsresults, and files is a list of (filename,
+    OPeNDAP URL) pairs, the URL None if the file has none.  If the search
+    failed, files is empty and error is the exception.
+
+    Parameters
+    ----------
+        dsresults: The pyesgf DatasetResults of a search.
+
+        workers (int) optional: The number of searches at once.  The default
+        is SEARCH_WORKERS.
+
+        node_limit (int) optional: The number of searches at once to one
+        index node.  The default is NODE_WORKERS.
+
+        params: The parameters of each file search (e.g. variable).
+    """
+    if workers is None:
+        workers = SEARCH_WORKERS
+    if node_limit is None:
+        node_limit = NODE_WORKERS
+    tasks = _interleave(dsresults)
+    if len(tasks) == 0:
+        return
+    limits = _NodeLimits(node_limit)
+
+    def search(task):
+        number, dsresult = task
+        try:
+            with limits(_result_node(dsresult)):
+                # The results are fetched here, in the worker, a page at a
+                # time.
+                remotefiles = list(dsresult.file_context().search(**params))
+        except (IOError, ValueError, KeyError) as err:
+            return number, [], err
+
+        files = []
+        for remotefile in remotefiles:
+            try:
+                url = remotefile.opendap_url
+            except AttributeError:
+                url = None
+            if url is None:
+                files.append((None, None))
+            else:
+                files.append((urlparse(url).path.split('/')[-1], url))
+        return number, files, None
+
+    pool = ThreadPool(max(1, min(workers, len(tasks))))
+    try:
+        for result in pool.imap_unordered(search, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
 class LocalDirectoryRepository(NCXRepository):
     """A repository consisting of NC files on the local disk
 
-    This repository is intended primarily for testing and unit tests.
+    Zarr directory stores (named *.zarr) are found, read and written like
+    the files.  This repository is intended primarily for testing and unit
+    tests.
     """
+    parallel_files = True
+
     def __init__(self, repospec):
         self._path = None
+        self._catalog = None
+        self._watcher = None
         NCXRepository.__init__(self, repospec)
 
     # The sublass must implement the repository interface.
@@ -550,27 +733,95 @@ class LocalDirectoryRepository(NCXRepository):
         auth = NullAuthenticator(self._app)
         return auth
 
+    # The catalog is opened on the first search, rather than when the
+    # repository is created, so that an unused repository costs nothing.  Its
+    # location can be set with the 'catalog' parameter.  If the 'watch'
+    # parameter is set, the catalog is kept up to date in the background.
+    def catalog(self):
+        """Return the metadata catalog of the directory."""
+        if self._catalog is None:
+            self._catalog = MetadataCatalog(
+                self._path, self._repo_parameters.get('catalog'))
+            if self._repo_parameters.get('watch'):
+                self._watcher = CatalogWatcher(self._catalog)
+                self._watcher.start()
+        return self._catalog
+
     def _search(self, log, progressbar):
-        """Collects the output of ls -1 *nc in the repository directory."""
-        self._urls = []
-        for filename in os.listdir(self._path):
-            url = 'file:////' + filename
-            self._urls.append(url)
-        self._urls.sort()
-
-    def _push(self, progressbar, ds):
+        """Finds the files in the directory that match the search parameters.
+
+        The search is a query of the metadata catalog.  Only files that are
+        new or changed since they were cataloged have their headers read.
+        """
+        catalog = self.catalog()
+        if self._watcher is None:
+            indexed, removed = catalog.refresh()
+            if indexed > 0 or removed > 0:
+                log.debug("Cataloged {0} and removed {1} files in {2}.".format(
+                    indexed, removed, self._path))
+
+        params = self._search_params or {}
+        self._urls = ['file:////' + filename
+                      for filename in catalog.search(**params)]
+
+    # Datasets are saved as NetCDF4 files, or as Zarr stores if the
+    # repository's 'store' parameter (or the store option of a push) is
+    # 'zarr'.
+    def _store(self, store):
+        if store is None:
+            store = self._repo_parameters.get('store', 'netcdf')
+        if store not in ('netcdf', 'zarr'):
+            msg = "Unknown store {0}.".format(store)
+            raise ValueError(msg)
+        return store
+
+    def push_steps(self, ds, store=None, float32=False, access='auto',
+                   **options):
+        return write_steps(ds, self._store(store), float32, access)
+
+    def _push(self, progressbar, ds, compress=True, complevel=4,
+              shuffle=True, float32=False, access='auto', store=None,
+              threads=1):
+        """Write the dataset to a compressed NetCDF4 file in the directory.
+
+        With store='zarr', the dataset is written to a Zarr directory store
+        instead, threads blocks at a time.  Returns the file's name.  See
+        util.write_netcdf and util.write_zarr for the options.
+        """
+        filespec, store = self.push_target(ds, store)
+        write_dataset(ds, filespec, store, progressbar=progressbar,
+                      compress=compress, complevel=complevel,
+                      shuffle=shuffle, float32=float32, access=access,
+                      threads=threads)
+        return filespec
+
+    def push_target(self, ds, store=None, **options):
+        store = self._store(store)
         # Form the filename from the dataset metadata:
-        # program.product.version.time_frequency.grid.nc
-        filename = "{0}.{1}.{2}.{3}.{4}.nc".format(
+        # program.product.version.time_frequency.grid.nc (or .zarr)
+        filename = "{0}.{1}.{2}.{3}.{4}.{5}".format(
             ds.attrs['program'] if 'program' in ds.attrs else '',
             ds.attrs['product'] if 'product' in ds.attrs else '',
             ds.attrs['version'] if 'version' in ds.attrs else '',
             ds.attrs['time_frequency'] if 'time_frequency' in ds.attrs else '',
-            ds.attrs['grid'] if 'grid' in ds.attrs else '')
-        filespec = self._path + '/' + filename
-        ds.to_netcdf(filespec)
+            ds.attrs['grid'] if 'grid' in ds.attrs else '',
+            'zarr' if store == 'zarr' else 'nc')
+        return self._path + '/' + filename, store
         
-    def _retrieve_data(self, log, progressbar, files):
+    def _retrieve_data(self, log, progressbar, files, lazy=False,
+                       memory_budget=None, workers=None):
+        """Open the files, and make the data available as xarray Datasets.
+
+        By default, each file is a Dataset of its own.  With lazy, the files
+        are opened in a pool of workers threads and nothing is read: the
+        data is read a chunk at a time (as dask arrays, with chunks of about
+        memory_budget bytes) when it is used.  Files of the same variables on
+        the same grid are concatenated along time into one Dataset, so a
+        time series split over many files is a single variable.
+        """
+        if lazy:
+            return self._retrieve_lazy(log, progressbar, files,
+                                       memory_budget, workers)
 
         # Add two to the progress bar.  One for just starting, and another
         # for when it's all finished.  Without these extra, the user can be
@@ -581,10 +832,10 @@ class LocalDirectoryRepository(NCXRepository):
         progressbar.start(2*file_len)
         for i, localfile in files:
 
-            # FIX ME: Explore cheaper ways to determine if the file contains
-            # the requested variable.  This implementation downloads the
-            # entire file, and then discards it.
-            xdataset = xr.open_dataset(self._path + '/' + localfile, decode_cf=False)
+            # The search only returns files with the requested variable, and
+            # opening a file (or a Zarr store) reads only its header.
+            xdataset = open_local(self._path + '/' + localfile,
+                                  decode_cf=False)
 #            if self._search_params['variable'] in xdataset:
 
             urlobj = urlparse(localfile)
@@ -593,15 +844,168 @@ class LocalDirectoryRepository(NCXRepository):
             log.debug(msg)
             progressbar.update(msg)
 
-            # Normalize it.
-            # FIX ME: Consider moving this to another place.  This
-            # operation is the biggest bottleneck of this searching and
-            # retrieving data.
-#            self._clean(xdataset)
+            # Normalize it.  This is lazy, so it costs nothing until the data
+            # is used.
+            self._clean(xdataset)
 
             temp_ds.append(xdataset)
             msg = "Saved: [{0}] {1}".format(urlobj.netloc, filename)
             log.debug(msg)
             progressbar.update(msg)
 
-        return temp_ds
\ No newline at end of file
+        return temp_ds
+
+    def _open_lazy(self, localfile):
+        filespec = self._path + '/' + localfile
+        xdataset = open_local(filespec, decode_cf=False)
+        self._clean(xdataset)
+        return xdataset
+
+    def _retrieve_lazy(self, log, progressbar, files, memory_budget, workers):
+        # The data are read lazily as dask arrays.  dask is optional
+        # otherwise, so say what is missing rather than fail in xarray.
+        try:
+            importlib.import_module('dask.array')
+        except ImportError:
+            msg = "Retrieving data lazily (lazy=True) requires dask."
+            raise ImportError(msg)
+
+        filenames = [localfile for i, localfile in files]
+        progressbar.start(len(filenames) + 1)
+
+        # Opening a file reads its header and coordinates.  xarray serializes
+        # the calls to the netCDF library, but the rest overlaps.
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        pool = ThreadPool(max(1, min(workers, len(filenames))))
+        try:
+            datasets = []
+            for name, xdataset in zip(
+                    filenames, pool.imap(self._open_lazy, filenames)):
+                datasets.append(xdataset)
+                msg = "Opened: [{0}] {1}".format(self.id, name)
+                log.debug(msg)
+                progressbar.update(msg)
+        finally:
+            pool.close()
+            pool.join()
+
+        combined = [chunk_dataset(xdataset, memory_budget)
+                    for xdataset in concat_time_series(datasets)]
+        msg = "Combined {0} files into {1} datasets.".format(len(datasets),
+                                                              len(combined))
+        log.debug(msg)
+        progressbar.update(msg)
+        return combined
+
+
+# The default size of a chunk of data read lazily, in bytes.
+RETRIEVE_CHUNK_BYTES = 128*1024*1024
+
+
+def chunk_dataset(dataset, memory_budget=None):
+    """Convert the variables of a Dataset to dask arrays.
+
+    Each chunk is a block of whole time steps of about memory_budget bytes,
+    for the largest variable.  A Dataset without a time dimension is one
+    chunk per variable.
+    """
+    if memory_budget is None:
+        memory_budget = RETRIEVE_CHUNK_BYTES
+    if 'time' not in dataset.dims:
+        return dataset.chunk()
+
+    step_bytes = max([var.dtype.itemsize*var.size//var.sizes['time']
+                      for var in dataset.data_vars.values()
+                      if 'time' in var.dims] or [1])
+    length = max(1, min(dataset.sizes['time'], memory_budget//step_bytes))
+    return dataset.chunk({'time': length})
+
+
+# The global attributes that identify a simulation: the model, the
+# experiment, the ensemble member and the frequency, under their CMIP5 and
+# CMIP6 names.  Files of different simulations are never one series.
+SERIES_ATTRS = ('institute_id', 'institution_id', 'model_id', 'source_id',
+                'experiment_id', 'realization', 'initialization_method',
+                'physics_version', 'variant_label', 'member_id',
+                'parent_experiment_rip', 'frequency', 'time_frequency')
+
+
+def _series_key(dataset):
+    # Files are parts of the same time series if they have the same
+    # variables, on the same grid, with times in the same units, from the
+    # same simulation.
+    if 'time' not in dataset.dims:
+        return None
+    if 'lat' in dataset.variables and 'lon' in dataset.variables:
+        grid = Grid(array=dataset).digest
+    else:
+        grid = None
+    return (tuple(sorted(dataset.data_vars)), grid,
+            dataset['time'].attrs.get('units'),
+            tuple(sorted((dim, size) for dim, size in dataset.sizes.items()
+                         if dim != 'time')),
+            tuple(str(dataset.attrs.get(name)) for name in SERIES_ATTRS))
+
+
+def _in_sequence(parts):
+    # Each part's times increase, and come after the times of the part
+    # before it.
+    last = None
+    for part in parts:
+        times = part['time'].values
+        if len(times) == 0:
+            return False
+        if len(times) > 1 and not np.all(times[1:] > times[:-1]):
+            return False
+        if last is not None and not times[0] > last:
+            return False
+        last = times[-1]
+    return True
+
+
+def concat_time_series(datasets):
+    """Concatenate the Datasets that are parts of the same time series.
+
+    Returns a list of Datasets, in the order of their first file.  The parts
+    of a series are put in order of their first time.  Parts whose times
+    overlap, or are out of order, are not a series: they are kept separate.
+    Nothing is read except the coordinates.
+    """
+    groups = []
+    members = {}
+    for xdataset in datasets:
+        key = _series_key(xdataset)
+        if key is None:
+            groups.append([xdataset])
+        elif key in members:
+            members[key].append(xdataset)
+        else:
+            members[key] = [xdataset]
+            groups.append(members[key])
+
+    combined = []
+    for group in groups:
+        if len(group) == 1:
+            combined.append(group[0])
+            continue
+        ordered = sorted(group, key=lambda part: part['time'].values[0]
+                         if part.sizes['time'] > 0 else None)
+        if not _in_sequence(ordered):
+            combined.extend(group)
+            continue
+        group = ordered
+        series = xr.concat(group, dim='time', data_vars='minimal',
+                           coords='minimal')
+        # xarray keeps the encoding of the first part.  The series is read
+        # from all of them.
+        for name, var in series.variables.items():
+            if 'time' not in var.dims:
+                continue
+            sources = [part[name].encoding.get('source') for part in group]
+            if None in sources:
+                var.encoding.pop('source', None)
+            else:
+                var.encoding['source'] = sources
+        combined.append(series)
+    return combined
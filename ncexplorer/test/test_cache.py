@@ -0,0 +1,74 @@
+"""
+Tests of the regrid weight cache on disk.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+from scipy import sparse
+
+from ncexplorer import cache
+from ncexplorer.cache import WeightCache
+from ncexplorer.util import GRID_100, GRID_300
+
+
+def _entry(seed):
+    np.random.seed(seed)
+    return {'matrix': sparse.random(200, 300, density=0.1, format='csr'),
+            'index': np.arange(10)}
+
+
+class WeightCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_round_trip(self):
+        weights = WeightCache(directory=self.directory)
+        entry = _entry(0)
+        weights.put('key', entry)
+        weights.clear()
+        loaded = weights.get('key')
+        self.assertEqual(weights.stats()['disk_hits'], 1)
+        self.assertEqual((loaded['matrix'] != entry['matrix']).nnz, 0)
+        np.testing.assert_array_equal(loaded['index'], entry['index'])
+
+    def test_concurrent_saves(self):
+        weights = WeightCache(directory=self.directory)
+        threads = [threading.Thread(target=weights.put,
+                                    args=('key', _entry(0)))
+                   for number in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(os.listdir(self.directory), ['key.npz'])
+
+    def test_eviction(self):
+        weights = WeightCache(maxsize=1, directory=self.directory,
+                              maxbytes=1)
+        for number in range(3):
+            weights.put("key{0}".format(number), _entry(number))
+        # The entry just saved is kept, even if it alone is too big.
+        self.assertEqual(os.listdir(self.directory), ['key2.npz'])
+
+    def test_version(self):
+        weights = WeightCache()
+        key = weights.key('linear', GRID_100, GRID_300)
+        version = cache.WEIGHT_VERSION
+        try:
+            cache.WEIGHT_VERSION = version + '-next'
+            self.assertNotEqual(weights.key('linear', GRID_100, GRID_300),
+                                key)
+        finally:
+            cache.WEIGHT_VERSION = version
+
+
+if __name__ == '__main__':
+    unittest.main()
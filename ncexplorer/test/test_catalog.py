@@ -0,0 +1,61 @@
+"""
+Tests of the metadata catalog search.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import xarray as xr
+
+from ncexplorer.catalog import MetadataCatalog
+
+
+def _write(filespec, **attrs):
+    ds = xr.Dataset({'tas': (('lat', 'lon'), np.zeros((2, 3)))},
+                    coords={'lat': [0., 10.], 'lon': [0., 10., 20.]},
+                    attrs=attrs)
+    ds.to_netcdf(filespec)
+
+
+class CatalogSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        _write(os.path.join(self.directory, 'cmip5.nc'),
+               project_id='CMIP5', model_id='CCSM4', experiment_id='lgm',
+               frequency='mon', modeling_realm='atmos', realization=1,
+               initialization_method=1, physics_version=1)
+        _write(os.path.join(self.directory, 'cmip6.nc'),
+               mip_era='CMIP6', source_id='CESM2', experiment_id='lgm',
+               frequency='day', realm='atmos', variant_label='r1i1p1f1')
+        _write(os.path.join(self.directory, 'bare.nc'))
+        self.catalog = MetadataCatalog(self.directory)
+        self.catalog.refresh(workers=1)
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_esgf_facets(self):
+        search = self.catalog.search
+        self.assertEqual(search(time_frequency='mon'),
+                         ['bare.nc', 'cmip5.nc'])
+        self.assertEqual(search(ensemble='r1i1p1'), ['bare.nc', 'cmip5.nc'])
+        self.assertEqual(search(ensemble='r1i1p1f1'), ['bare.nc', 'cmip6.nc'])
+        self.assertEqual(search(realm='atmos'),
+                         ['bare.nc', 'cmip5.nc', 'cmip6.nc'])
+        self.assertEqual(search(project=['CMIP6']), ['bare.nc', 'cmip6.nc'])
+
+    def test_columns(self):
+        self.assertEqual(self.catalog.search(experiment='lgm'),
+                         ['cmip5.nc', 'cmip6.nc'])
+        self.assertEqual(self.catalog.search(variable='tas', model='CCSM4'),
+                         ['cmip5.nc'])
+        self.assertEqual(self.catalog.search(source='CCSM4'),
+                         ['bare.nc', 'cmip5.nc'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+"""
+Tests of decoding packed values: the scale factor and offset, and the fill
+and missing values.
+"""
+import unittest
+
+import numpy as np
+import xarray as xr
+
+from ncexplorer import util
+from ncexplorer.util import decode_values, decode_dataset
+
+
+def _packing(**attrs):
+    return dict((key, np.asarray(value, dtype=np.float64))
+                for key, value in attrs.items())
+
+
+class DecodeValuesTest(unittest.TestCase):
+
+    def test_integer_packing(self):
+        raw = np.array([-32767, 0, 100, 32767], dtype=np.int16)
+        packing = _packing(scale_factor=0.01, add_offset=273.15)
+        dtype = util.decoded_dtype(raw.dtype, packing)
+        self.assertEqual(dtype, np.float64)
+        np.testing.assert_allclose(decode_values(raw, packing, dtype),
+                                   raw*0.01 + 273.15)
+        # Without an offset, float32 holds the values.
+        self.assertEqual(util.decoded_dtype(raw.dtype,
+                                            _packing(scale_factor=0.5)),
+                         np.float32)
+
+    def test_fill_value(self):
+        raw = np.array([[-32767, 1], [2, -32767]], dtype=np.int16)
+        packing = _packing(scale_factor=2.0, _FillValue=-32767)
+        decoded = decode_values(raw, packing, np.float32)
+        self.assertEqual(decoded.dtype, np.float32)
+        np.testing.assert_array_equal(decoded, [[np.NaN, 2], [4, np.NaN]])
+
+    def test_nan_and_inf_fills(self):
+        raw = np.array([np.NaN, 1.0, np.inf, -np.inf], dtype=np.float32)
+        decoded = decode_values(raw, _packing(_FillValue=np.NaN),
+                                np.float32)
+        np.testing.assert_array_equal(decoded, [np.NaN, 1, np.inf, -np.inf])
+        decoded = decode_values(raw, _packing(missing_value=np.inf),
+                                np.float32)
+        np.testing.assert_array_equal(decoded, [np.NaN, 1, np.NaN, -np.inf])
+
+    def test_missing_value_tolerance(self):
+        # The values are close to the missing value, but not equal to it.
+        raw = np.array([1e20, 1.0000002e20, 9.9e19, 1.0], dtype=np.float32)
+        decoded = decode_values(raw, _packing(missing_value=1e20),
+                                np.float32)
+        np.testing.assert_array_equal(decoded,
+                                      [np.NaN, np.NaN, np.float32(9.9e19), 1])
+
+    def test_slabs(self):
+        # The values are decoded a slab at a time, the last one short.
+        raw = np.arange(25, dtype=np.int16).reshape(5, 5)
+        packing = _packing(scale_factor=0.5, add_offset=1.0, _FillValue=7)
+        expected = raw*0.5 + 1.0
+        expected[1, 2] = np.NaN
+        size = util.DECODE_SLAB_SIZE
+        util.DECODE_SLAB_SIZE = 4
+        try:
+            decoded = decode_values(raw, packing, np.float64)
+        finally:
+            util.DECODE_SLAB_SIZE = size
+        np.testing.assert_array_equal(decoded, expected)
+
+    def test_lazy(self):
+        raw = np.array([[-1, 1], [2, 3]], dtype=np.int16)
+        ds = xr.Dataset({'v': (('y', 'x'), raw,
+                               {'scale_factor': 0.5, '_FillValue': -1,
+                                'units': 'K'})})
+        decode_dataset(ds)
+        self.assertNotIsInstance(ds.v.variable._data, np.ndarray)
+        self.assertEqual(ds.v.attrs, {'units': 'K'})
+        self.assertEqual(ds.v.encoding['scale_factor'], 0.5)
+        np.testing.assert_array_equal(ds.v.values, [[np.NaN, 0.5], [1, 1.5]])
+
+
+if __name__ == '__main__':
+    unittest.main()
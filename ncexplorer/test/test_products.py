@@ -0,0 +1,85 @@
+"""
+Tests of the product cache: a product found in the cache is the product
+that was computed.
+"""
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from ncexplorer.products import ProductCache, cached_product, fingerprint
+
+
+def _variable(times):
+    np.random.seed(1)
+    return xr.DataArray(
+        np.random.rand(len(times), 3, 4), name='tas',
+        dims=('time', 'lat', 'lon'),
+        coords={'time': times, 'lat': [-10., 0., 10.],
+                'lon': [0., 90., 180., 270.]},
+        attrs={'units': 'K', 'missing_value': 'nan'})
+
+
+class ProductCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ProductCache(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _miss_and_hit(self, var):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return var*2
+
+        miss = cached_product('double', var, compute, cache=self.cache)
+        hit = cached_product('double', var, compute, cache=self.cache)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        return miss, hit
+
+    def _assert_same(self, miss, hit):
+        self.assertEqual(hit.name, miss.name)
+        self.assertEqual(hit.dims, miss.dims)
+        self.assertEqual(hit.dtype, miss.dtype)
+        self.assertEqual(hit.attrs, miss.attrs)
+        np.testing.assert_array_equal(hit.values, miss.values)
+        for name in miss.coords:
+            self.assertEqual(hit[name].dtype, miss[name].dtype)
+            np.testing.assert_array_equal(hit[name].values,
+                                          miss[name].values)
+            self.assertEqual(hit[name].attrs, miss[name].attrs)
+
+    def test_decoded_times(self):
+        var = _variable(pd.date_range('2000-01-01', periods=5))
+        self._assert_same(*self._miss_and_hit(var))
+
+    def test_numeric_times(self):
+        # A time left in numbers (decode_times=False) isn't decoded.
+        times = xr.DataArray(np.arange(5.), dims='time',
+                             attrs={'units': 'days since 2000-01-01',
+                                    'calendar': 'noleap'})
+        miss, hit = self._miss_and_hit(_variable(times))
+        self.assertEqual(hit.time.dtype.kind, 'f')
+        self._assert_same(miss, hit)
+
+    def test_fingerprint(self):
+        var = _variable(pd.date_range('2000-01-01', periods=5))
+        self.assertEqual(fingerprint(var), fingerprint(var.copy()))
+        self.assertNotEqual(fingerprint(var), fingerprint(var + 1))
+        # A dask array is identified by its name and chunks, not its values.
+        lazy = var.chunk({'time': 2})
+        self.assertEqual(fingerprint(lazy), fingerprint(lazy))
+        self.assertNotEqual(fingerprint(lazy),
+                            fingerprint(var.chunk({'time': 3})))
+
+
+if __name__ == '__main__':
+    unittest.main()
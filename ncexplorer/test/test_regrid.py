@@ -0,0 +1,212 @@
+"""
+Tests of the regrid: the weights against analytic fields and against the
+original, pointwise regrid.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from ncexplorer.util import Grid, GRID_100, simple_regrid, chunked_regrid
+from ncexplorer.util import standardize_latlon
+from ncexplorer.jobs import RegridJob
+
+
+def _field(lat, lon):
+    # A smooth field on the sphere, z + x of the point on the unit sphere.
+    lat, lon = np.meshgrid(np.radians(lat), np.radians(lon), indexing='ij')
+    return np.sin(lat) + np.cos(lat)*np.cos(lon)
+
+
+def _variable(lat, lon, values=None):
+    if values is None:
+        values = _field(lat, lon)
+    return xr.DataArray(values, name='v', dims=('lat', 'lon'),
+                        coords={'lat': lat, 'lon': lon})
+
+
+# A global 2.5 degree grid in 0 to 360 longitudes, which don't reach 360:
+# the destination longitudes between 357.5 and 360 are between the last
+# and the first source longitude.
+LAT = np.linspace(-88.75, 88.75, 72)
+LON = np.arange(144)*2.5
+
+
+class RegridTest(unittest.TestCase):
+
+    def _assert_field(self, newvar, grid, tolerance):
+        expected = _field(grid.lat, grid.lon)
+        self.assertFalse(np.isnan(newvar.values).any())
+        self.assertLess(np.abs(newvar.values - expected).max(), tolerance)
+
+    def test_analytic(self):
+        var = _variable(LAT, LON)
+        for method in ('bilinear', 'linear'):
+            newvar = simple_regrid(var, grid=GRID_100, method=method)
+            self.assertEqual(newvar.shape, GRID_100.shape)
+            self._assert_field(newvar, GRID_100, 1e-3)
+
+    def test_identity(self):
+        var = _variable(LAT, LON)
+        grid = Grid(array=var)
+        for method in ('auto', 'bilinear', 'linear'):
+            newvar = simple_regrid(var, grid=grid, method=method)
+            np.testing.assert_allclose(newvar.values, var.values,
+                                       atol=1e-9)
+
+    def test_lon_wrap(self):
+        # The destination is in -180 to 180 longitudes, and has points
+        # across the seam of the source.
+        grid = Grid(lat=np.linspace(-60, 60, 13),
+                    lon=np.linspace(-178.75, 178.75, 144))
+        var = _variable(LAT, LON)
+        for method in ('bilinear', 'linear'):
+            newvar = simple_regrid(var, grid=grid, method=method)
+            self._assert_field(newvar, grid, 1e-3)
+
+    def test_descending_lat(self):
+        var = _variable(LAT, LON)
+        flipped = var.isel(lat=slice(None, None, -1))
+        for method in ('bilinear', 'linear'):
+            np.testing.assert_allclose(
+                simple_regrid(flipped, grid=GRID_100, method=method).values,
+                simple_regrid(var, grid=GRID_100, method=method).values,
+                atol=1e-9)
+
+    def test_batch_dims(self):
+        # The other dimensions are kept, and each slab is regridded alike.
+        var = _variable(LAT, LON)
+        times = pd.Index(pd.date_range('2000-01-01', periods=3), name='time')
+        series = xr.concat([var, 2*var, 3*var], dim=times)
+        newvar = simple_regrid(series, grid=GRID_100)
+        self.assertEqual(newvar.dims, ('time', 'lat', 'lon'))
+        np.testing.assert_array_equal(newvar.time.values, times.values)
+        first = simple_regrid(var, grid=GRID_100)
+        for number in range(3):
+            np.testing.assert_allclose(newvar.values[number],
+                                       (number + 1)*first.values)
+
+    def test_neighbours_outside_source(self):
+        # A regional source leaves the rest of a global grid NaN, as the
+        # linear methods do.
+        lat = np.arange(20, 50.1, 2.5)
+        lon = np.arange(230, 300.1, 2.5)
+        var = _variable(lat, lon)
+        inside = simple_regrid(var, grid=GRID_100, method='linear')
+        for method in ('nearest', 'idw'):
+            newvar = simple_regrid(var, grid=GRID_100, method=method)
+            valid = ~np.isnan(newvar.values)
+            self.assertTrue(valid[~np.isnan(inside.values)].all())
+            self.assertLess(valid.sum(), 2*(~np.isnan(inside.values)).sum())
+            far = simple_regrid(var, grid=GRID_100, method=method,
+                                max_distance=np.inf)
+            self.assertFalse(np.isnan(far.values).any())
+
+    def test_pointwise_reference(self):
+        # Triangulating in the lat-lon plane reproduces a field linear in
+        # lat and lon, as does interpolating one axis at a time.
+        lat = np.linspace(-30, 30, 7)
+        lon = np.linspace(0, 60, 7)
+        var = _variable(lat, lon, np.add.outer(lat, 2*lon))
+        grid = Grid(lat=np.linspace(-25, 25, 6), lon=np.linspace(5, 55, 6))
+        reference = simple_regrid(var, grid=grid, method='pointwise')
+        np.testing.assert_allclose(reference.values,
+                                   np.add.outer(grid.lat, 2*grid.lon))
+        np.testing.assert_allclose(
+            simple_regrid(var, grid=grid, method='bilinear').values,
+            reference.values)
+
+        times = pd.Index(pd.date_range('2000-01-01', periods=2), name='time')
+        series = xr.concat([var, -var], dim=times)
+        np.testing.assert_allclose(
+            simple_regrid(series, grid=grid, method='pointwise').values,
+            simple_regrid(series, grid=grid, method='bilinear').values)
+
+
+class ChunkedRegridTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_dimension_without_coordinate(self):
+        # member has no coordinate variable, so the file has no member
+        # dimension until the regridded variable is added.
+        var = _variable(LAT, LON)
+        values = np.array([[var.values*(time + member) for member in (1, 2)]
+                           for time in range(4)])
+        series = xr.DataArray(
+            values, name='v', dims=('time', 'member', 'lat', 'lon'),
+            coords={'time': pd.date_range('2000-01-01', periods=4),
+                    'lat': LAT, 'lon': LON})
+        filespec = os.path.join(self.directory, 'regridded.nc')
+        newvar = chunked_regrid(series, filespec, grid=GRID_100,
+                                memory_budget=1024*1024)
+        self.assertEqual(newvar.dims, ('time', 'member', 'lat', 'lon'))
+        np.testing.assert_allclose(
+            newvar.values, simple_regrid(series, grid=GRID_100).values)
+        newvar.close()
+
+    def test_job(self):
+        var = _variable(LAT, LON)
+        series = xr.DataArray(
+            np.array([var.values*time for time in range(6)]), name='v',
+            dims=('time', 'lat', 'lon'),
+            coords={'time': pd.date_range('2000-01-01', periods=6),
+                    'lat': LAT, 'lon': LON})
+        job = RegridJob(series, self.directory, grid=GRID_100,
+                        memory_budget=256*1024)
+        newvar = job.run()
+        # The blocks are read when they are used, not when they are loaded.
+        self.assertGreater(len(job.blocks), 1)
+        self.assertNotIsInstance(newvar.variable._data, np.ndarray)
+        self.assertEqual(len(newvar.chunks[0]), len(job.blocks))
+        np.testing.assert_allclose(
+            newvar.values, simple_regrid(series, grid=GRID_100).values)
+
+
+class StandardizeLatLonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_lazy(self):
+        # Latitudes from north to south, longitudes from 0 to 360.
+        lat = LAT[::-1]
+        series = xr.DataArray(
+            np.array([_field(lat, LON)*time for time in range(3)]),
+            name='v', dims=('time', 'lat', 'lon'),
+            coords={'time': pd.date_range('2000-01-01', periods=3),
+                    'lat': lat, 'lon': LON})
+        filespec = os.path.join(self.directory, 'source.nc')
+        series.to_netcdf(filespec)
+
+        with xr.open_dataset(filespec) as ds:
+            for source in (ds, ds.v, series):
+                standard = standardize_latlon(source)
+                if isinstance(standard, xr.Dataset):
+                    standard = standard.v
+                # Nothing is read until the values are used.
+                self.assertNotIsInstance(standard.variable._data, np.ndarray)
+                self.assertFalse(ds.v.variable._in_memory)
+
+                lon = np.where(LON >= 180, LON - 360, LON)
+                order = np.argsort(lon)
+                np.testing.assert_array_equal(standard.lat, LAT)
+                np.testing.assert_array_equal(standard.lon, lon[order])
+                np.testing.assert_allclose(
+                    standard.values,
+                    series.values[:, ::-1, :][:, :, order])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+"""
+Tests of the concurrent ESGF file search, with fake search results in place
+of an index node.
+"""
+import time
+import threading
+import unittest
+
+from ncexplorer import repository
+from ncexplorer.repository import NCXESGF, search_files
+
+
+class FakeFile(object):
+    def __init__(self, url):
+        self.opendap_url = url
+
+
+class FakeFileContext(object):
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def search(self, **params):
+        return self.dataset.file_search(**params)
+
+
+class FakeDataset(object):
+    """A dataset result, whose files are dup.nc and f<number>.nc.
+
+    A search of its files takes a while, and is counted against its index
+    node.
+    """
+    def __init__(self, number, node, counter, fail=False):
+        self.number = number
+        self.json = {'index_node': node}
+        self.counter = counter
+        self.fail = fail
+
+    def file_context(self):
+        return FakeFileContext(self)
+
+    def file_search(self, **params):
+        self.counter.enter(self.json['index_node'])
+        try:
+            time.sleep(0.02)
+        finally:
+            self.counter.leave(self.json['index_node'])
+        if self.fail:
+            raise IOError("The index node timed out.")
+        return [FakeFile("http://data/{0}/dup.nc".format(self.number)),
+                FakeFile("http://data/f{0}.nc".format(self.number)),
+                FakeFile(None)]
+
+
+class Counter(object):
+    """Counts the searches at once, to each node and in all."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.active = {}
+        self.peak = {}
+        self.total = 0
+        self.peak_total = 0
+
+    def enter(self, node):
+        with self._lock:
+            self.active[node] = self.active.get(node, 0) + 1
+            self.peak[node] = max(self.peak.get(node, 0), self.active[node])
+            self.total += 1
+            self.peak_total = max(self.peak_total, self.total)
+
+    def leave(self, node):
+        with self._lock:
+            self.active[node] -= 1
+            self.total -= 1
+
+
+def _datasets(counter, count=30, nodes=3, fail=()):
+    return [FakeDataset(number, "node{0}".format(number % nodes), counter,
+                        fail=number in fail)
+            for number in range(count)]
+
+
+class SearchFilesTest(unittest.TestCase):
+
+    def test_node_limit(self):
+        counter = Counter()
+        results = list(search_files(_datasets(counter), workers=12,
+                                    node_limit=2, variable='tas'))
+        self.assertEqual(sorted(number for number, files, error in results),
+                         list(range(30)))
+        for node, peak in counter.peak.items():
+            self.assertLessEqual(peak, 2)
+        # The nodes are searched at the same time.
+        self.assertGreater(counter.peak_total, 2)
+
+    def test_unknown_nodes(self):
+        # Datasets without an index node aren't all limited as one node.
+        counter = Counter()
+        datasets = _datasets(counter, count=12, nodes=1)
+        for dataset in datasets:
+            dataset.json = {'index_node': None}
+        results = list(search_files(datasets, workers=6, node_limit=2,
+                                    variable='tas'))
+        self.assertEqual(len(results), 12)
+        self.assertGreater(counter.peak[None], 2)
+
+    def test_files_and_errors(self):
+        counter = Counter()
+        results = dict(
+            (number, (files, error)) for number, files, error in
+            search_files(_datasets(counter, count=4, fail=(2,))))
+        files, error = results[1]
+        self.assertIsNone(error)
+        self.assertEqual(files, [('dup.nc', 'http://data/1/dup.nc'),
+                                 ('f1.nc', 'http://data/f1.nc'),
+                                 (None, None)])
+        files, error = results[2]
+        self.assertEqual(files, [])
+        self.assertIsInstance(error, IOError)
+
+    def test_no_datasets(self):
+        self.assertEqual(list(search_files([])), [])
+
+
+class FakeContext(object):
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.hit_count = len(datasets)
+
+    def search(self):
+        return self.datasets
+
+
+class FakeConnection(object):
+    datasets = []
+
+    def __init__(self, url, distrib=True):
+        pass
+
+    def new_context(self, **params):
+        return FakeContext(self.datasets)
+
+
+class Log(object):
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, msg):
+        self.warnings.append(msg)
+
+    def debug(self, msg):
+        pass
+
+
+class ESGFSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self._connection = repository.SearchConnection
+        repository.SearchConnection = FakeConnection
+
+    def tearDown(self):
+        repository.SearchConnection = self._connection
+
+    def test_urls(self):
+        counter = Counter()
+        FakeConnection.datasets = _datasets(counter, count=12, fail=(5,))
+        repo = NCXESGF.__new__(NCXESGF)
+        repo._repo_parameters = {'search_node': 'search', 'search_workers': 8,
+                                 'node_workers': 2}
+        repo._search_params = {'variable': 'tas'}
+        log = Log()
+        repo._search(log, None)
+
+        # A file found in several datasets has the URL of the last of them,
+        # whatever order the searches finished in.
+        urls = repo._urls
+        self.assertEqual(urls['dup.nc'], 'http://data/11/dup.nc')
+        self.assertEqual(sorted(urls),
+                         ['dup.nc'] + sorted("f{0}.nc".format(number)
+                                             for number in range(12)
+                                             if number != 5))
+        self.assertEqual(sorted(repo.urls()), sorted(urls.values()))
+        self.assertEqual(len(log.warnings), 1)
+        self.assertLessEqual(max(counter.peak.values()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+"""
+Tests of writing datasets: the encoding is kept, and files can be written by
+several threads at once.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from ncexplorer.util import write_netcdf
+
+
+def _dataset(seed):
+    np.random.seed(seed)
+    values = np.random.rand(6, 4, 5)*50 + 250
+    values[0, 0, 0] = np.NaN
+    lat = np.random.rand(4, 5)
+    return xr.Dataset(
+        {'tas': (('time', 'y', 'x'), values, {'units': 'K'})},
+        coords={'time': pd.date_range('2000-01-01', periods=6),
+                'lat': (('y', 'x'), lat), 'lon': (('y', 'x'), 2*lat),
+                'height': 2.0})
+
+
+class WriteNetCDFTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _filespec(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_packed(self):
+        ds = _dataset(0)
+        ds.tas.encoding.update(dtype='int16', scale_factor=0.01,
+                               add_offset=273.15, _FillValue=-32767)
+        ds.to_netcdf(self._filespec('source.nc'))
+        with xr.open_dataset(self._filespec('source.nc')) as source:
+            write_netcdf(source, self._filespec('copy.nc'))
+            with xr.open_dataset(self._filespec('copy.nc')) as copy:
+                self.assertEqual(copy.tas.encoding['dtype'], np.int16)
+                self.assertEqual(copy.tas.encoding['scale_factor'], 0.01)
+                np.testing.assert_array_equal(copy.tas.values,
+                                              source.tas.values)
+                self.assertEqual(sorted(copy.tas.coords),
+                                 ['height', 'lat', 'lon', 'time'])
+
+    def test_threads(self):
+        datasets = [_dataset(seed) for seed in range(6)]
+        filespecs = [self._filespec("{0}.nc".format(number))
+                     for number in range(6)]
+        pool = ThreadPool(3)
+        try:
+            pool.map(lambda args: write_netcdf(*args),
+                     zip(datasets, filespecs))
+        finally:
+            pool.close()
+            pool.join()
+        for ds, filespec in zip(datasets, filespecs):
+            with xr.open_dataset(filespec) as copy:
+                np.testing.assert_array_equal(copy.tas.values,
+                                              ds.tas.values)
+
+
+if __name__ == '__main__':
+    unittest.main()
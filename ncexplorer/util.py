@@ -5,16 +5,28 @@ Created on Dec 28, 2016
 '''
 import sys
 import math
+import hashlib
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from multiprocessing.sharedctypes import RawArray
 import numpy as np
 import xarray as xr
-from scipy.spatial import KDTree, Delaunay
+from scipy.spatial import KDTree, cKDTree, Delaunay, ConvexHull
 from scipy.interpolate import LinearNDInterpolator
+from scipy import sparse
 from scipy.signal import gaussian
-from scipy.signal import convolve
+from scipy.ndimage import convolve1d
+from scipy.fftpack import next_fast_len
 
 from pydap.client import open_url
 from pydap.cas.urs import setup_session
 
+from ncexplorer.cache import WeightCache, weight_cache
+from ncexplorer.compat import lazy_variable, lazy_map
+from ncexplorer.compat import to_temp_dataset, from_temp_dataset
+from ncexplorer.compat import HDF5_LOCK, NETCDFC_LOCK, combine_locks
+
 
 # Grid definitions
 class Grid(object):
@@ -22,9 +34,9 @@ class Grid(object):
 
     Parameters
     ----------
-        array (DataArray) optional: If a DataArray is passed as a parameter,
-        then all other parameters are ignored.  The DataArray is presumed to
-        define a latitude-longitude grid, and that is used.
+        array (DataArray or Dataset) optional: If a DataArray is passed as a
+        parameter, then all other parameters are ignored.  The DataArray is
+        presumed to define a latitude-longitude grid, and that is used.
         
         lat, lon (list) optional: A numpy array of the specific values for the
         latitudes and longitudes.
@@ -33,6 +45,9 @@ class Grid(object):
         not passed, a default name is constructed from the cell widths.  This
         however is redundant.  For example, [-90, -60, -30, 0, 30, 60, 90] and
         [-75, -45, -15, 15, 45, 75] would both be 015x*.
+
+        dims (tuple) optional: The horizontal dimensions, for a grid given by
+        lat and lon.  Only needed for curvilinear and unstructured grids.
     
     The python str() function will return a string nxm, where n (m) is the
     distance between lines of latitude (longitude).
@@ -45,25 +60,47 @@ class Grid(object):
     Longitudes
     ----------
     The range of longitudes is [-180, 180].
+
+    Curvilinear and unstructured grids
+    ----------------------------------
+    Ocean and regional models often use grids where the latitude and
+    longitude are 2-D coordinates, lat(y,x) and lon(y,x), or 1-D coordinates
+    of a single dimension of cells, lat(cell) and lon(cell).  The Grid keeps
+    the names of these horizontal dimensions in dims.  Such grids can be
+    regridded with the 'linear', 'nearest' and 'idw' methods.
     """
-    def __init__(self, array=None, lat=None, lon=None, name=None):
+    def __init__(self, array=None, lat=None, lon=None, name=None, dims=None):
         
         # The preference is to use the grid from a specified existing
         # DataArray.
         if array is not None:
-            if type(array) is not xr.DataArray:
-                msg = "The parameter array must be an xarray DataArray."
+            if not isinstance(array, (xr.DataArray, xr.Dataset)):
+                msg = ("The parameter array must be an xarray DataArray or "
+                       "Dataset.")
                 raise TypeError(msg)
 
             self._lats = array.lat.values
             self._lons = array.lon.values
 
+            # On a rectilinear grid, lat and lon are their own dimensions.
+            # Otherwise they are coordinates of other dimensions.
+            if array.lat.dims == ('lat',) and array.lon.dims == ('lon',):
+                self.dims = ('lat', 'lon')
+            else:
+                self.dims = array.lat.dims
+
         # Specifying the latituds and longitudes explicitly is ultimately the
         # easiest and most reliable way, due primarlly to the redundancy:
         # [-90, 0, 90] and (-45, 45] are both grids with 90-degree widths.
         else:
             self._lats = lat
             self._lons = lon
+            if dims is not None:
+                self.dims = tuple(dims)
+            elif np.ndim(lat) == 2:
+                self.dims = ('y', 'x')
+            else:
+                self.dims = ('lat', 'lon')
 
         # Determining a name from the latitudes and longitudes is complicated
         # from too many choices for how to form the name.  Best is to let the
@@ -77,6 +114,9 @@ class Grid(object):
     # spacing in tenths of a degree.  Most grids are defined such that the
     # spacing between lines of latitude and longitude are the same.
     def _name(self):
+        if self.curvilinear:
+            return "GRID_{0}".format('x'.join(str(n) for n in self.shape))
+
         latitude_range = self._lats[-1] - self._lats[0]
         
         # Subtract 1 from the length because [-90, 0, 90] has three latitudes
@@ -96,6 +136,23 @@ class Grid(object):
     def lon(self):
         return self._lons
 
+    # A grid is curvilinear (or unstructured) if its latitudes and longitudes
+    # are not the coordinates of separate lat and lon dimensions.
+    @property
+    def curvilinear(self):
+        return self.dims != ('lat', 'lon')
+
+    # The shape of the data on the grid, in the order of dims.
+    @property
+    def shape(self):
+        if self.curvilinear:
+            return np.shape(self._lats)
+        return (len(self._lats), len(self._lons))
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
     @property
     def latlen(self):
         return len(self._lats)
@@ -104,11 +161,66 @@ class Grid(object):
     def lonlen(self):
         return len(self._lons)
 
+    # The (lat, lon) of every point, in the order the data is flattened.
     @property
     def cartesian(self):
+        if self.curvilinear:
+            return np.c_[np.ravel(self._lats), np.ravel(self._lons)]
         ret = cartesian(( [self._lats, self._lons] ))
         return ret
+
+    # The (x, y, z) of every point on the unit sphere, in the same order.
+    # Unlike (lat, lon), these don't depend on the longitude convention, and
+    # have no seam.
+    @property
+    def xyz(self):
+        return unit_sphere(np.asarray(self.cartesian, dtype=np.float64))
+
+    def coords(self):
+        """The coordinates of a DataArray on this grid."""
+        if self.curvilinear:
+            return {'lat': (self.dims, self._lats),
+                    'lon': (self.dims, self._lons)}
+        return {'lat': self._lats, 'lon': self._lons}
+
+    # Two grids with the same coordinates have the same digest, regardless of
+    # their names.  The digest is the key for caching regrid weights.
+    @property
+    def digest(self):
+        sha = hashlib.sha1()
+        for coords in (self._lats, self._lons):
+            values = np.ascontiguousarray(coords, dtype=np.float64)
+            sha.update(str(values.shape).encode('utf-8'))
+            sha.update(values.tostring())
+        return sha.hexdigest()
     
+    # A grid is rectilinear if the latitudes and longitudes are each strictly
+    # increasing or strictly decreasing.  Such grids can be interpolated one
+    # axis at a time, without a triangulation.
+    @property
+    def rectilinear(self):
+        if self.curvilinear:
+            return False
+        for coords in (self._lats, self._lons):
+            steps = np.diff(np.asarray(coords, dtype=np.float64))
+            if len(steps) == 0:
+                return False
+            if not (np.all(steps > 0) or np.all(steps < 0)):
+                return False
+        return True
+
+    # The longitudes may wrap, or not.  Typically, for small regions, the
+    # longitude does not wrap.  Here, if the distance between the two
+    # longitude extremes is close to the spacing, we assume the longitudes
+    # wrap.  This is not perfect.
+    @property
+    def lon_wraps(self):
+        if self.curvilinear:
+            return False
+        wrap_space = self._lons[0] + 360 - self._lons[-1]
+        common_space = self._lons[1] - self._lons[0]
+        return (wrap_space < 1.1*common_space)
+
     # An iterator to iterate through the grid points.
     def grid_points(self):
         for i in range(0, self.latlen):
@@ -118,20 +230,18 @@ class Grid(object):
     # Create a string nxm, where n (m) is the distance in degrees between lines
     # of latitude (longitude).
     def __str__(self):
+        if self.curvilinear:
+            return "{0} points on {1}".format(
+                'x'.join(str(n) for n in self.shape), ', '.join(self.dims))
+
         # latitudes may or may not exclude the pole.  The numerator for the
         # latitude calculation must consider this.  Furthermore, the because
         # the latitudes have end points, the number of spaces is one less than
         # the number of latitudes.
         width_lat = (self._lats[-1] - self._lats[0])/(self.latlen - 1)
 
-        # The longitudes may wrap, or not.  Typically, for small regions, the
-        # longitude does not wrap.  Here, if the distance between the two
-        # longitude extremes is close to the spacing, we assume the longitudes
-        # wrap.  This is not perfect.
-        wrap_space = self._lons[0] + 360 - self._lons[-1]
-        common_space = self._lons[1] - self._lons[0]
-        wrap_case = (wrap_space < 1.1*common_space)
-        if wrap_case: 
+        # The longitudes may wrap, or not.  See lon_wraps.
+        if self.lon_wraps:
             width_lon = 360.0/self.lonlen
         else:
             width_lon = (self._lons[-1] - self._lons[0])/(self.lonlen - 1)
@@ -242,7 +352,14 @@ def union_coords(variables):
 # likely to be correct.  Also, the ESMFPy API supports parallelizing the
 # regridding operation.
 #
-def regrid(variables, lattice='union', tl=None, pl=None):
+# With workers greater than one, the (time, plev) slabs are regridded in
+# parallel by a pool of processes.  See parallel_apply().
+#
+# The slabs are interpolated linearly on a triangulation of the source grid,
+# as they always have been, unless method says otherwise (any method of
+# regrid_weights(), e.g. 'auto').
+def regrid(variables, lattice='union', tl=None, pl=None, workers=None,
+           method='linear'):
 
     # At present, only one method of prescribing the destination lattice is
     # supported.  That is, the destination lattice if formed by the union over
@@ -274,9 +391,10 @@ def regrid(variables, lattice='union', tl=None, pl=None):
         raise NotImplementedError(errMsg)
 
     # The destination lattice won't change.  Now is a good time to build the
-    # indexing structure on it.
-    coords = cartesian(( [coords_lat, coords_lon] ))
-#    coordtree = KDTree(coords)
+    # grid for it.
+    to_grid = Grid(lat=np.asarray(coords_lat),
+                   lon=np.asarray(coords_lon),
+                   name=lattice)
 
     # This point starts the process of regridding.
     newvars = []
@@ -302,48 +420,34 @@ def regrid(variables, lattice='union', tl=None, pl=None):
         # values of those dimensions.
         newdata = np.empty( (len(time_levels), len(plev_levels), len(coords_lat), len(coords_lon)) )
         newdata[:] = np.NaN
-        
-        # This aspect of Python cost me an afternoon.  if you create an
-        # iterator like this:
-        #  myiterator = enumerate(var['plev'].values[plev_levels])
-        # ...then that iterator can only be used once.  Once the code
-        # iterfaces through it's values, it's done.  So nested loops using
-        # these DO NOT WORK.
-        for t, time_ in enumerate(var['time'].values[time_levels]):
-            for p, plev in enumerate(var['plev'].values[plev_levels]):
-                
-                # Impose a Delaunay triangulation and an indexing structure
-                # on the variable.
-                varcoords = cartesian(( [var['lat'], var['lon']] ))
-                vartri = Delaunay(varcoords)
-
-                # Flatten the variable on lat and lon.
-                # CHECK THAT var[time,plev].values.flatten()
-                # has the same shape (N,2) as varcoords
-                # and that they are in the same order.
-                x = var[t,p].values.flatten()
-                
-                # Loop on the destination lattice dimensions.
-                numcoords = len(coords)
-                print "[Time: %s][Plev: %s] %s(%s points)" % (time_, plev, '-'*int(numcoords/1000), numcoords)
-                print "[Time: %s][Plev: %s] " % (time_, plev),
-                
-                tmp = np.empty(len(coords))
-                for i, lattice_point in enumerate(coords):
-                    n = vartri.find_simplex(lattice_point)
-                    pts = vartri.simplices[n]
-                    spts = vartri.points[pts]
-                    
-                    f = LinearNDInterpolator(spts, x[pts])
-                    tmp[i] = f(lattice_point)
-                    
-                    if (i + 1)%1000 == 0:
-                        sys.stdout.write(".")
-                print ""
-                
-                # Reshape the tmp array to organize it by lat, lon.
-                tmp = np.reshape( tmp, (len(coords_lat), len(coords_lon)) )
-                newdata[t,p,:,:] = tmp
+
+        # The lattice of the variable is the same at every time and plev, so
+        # the interpolation weights are computed once, or found in the cache
+        # if this grid has been regridded before.
+        weights = regrid_weights(Grid(array=var), to_grid, method=method)
+
+        if workers is not None and workers > 1:
+            # The slabs are read one at a time, straight into the shared
+            # memory the workers read, rather than all at once first.
+            slabs = (var[t, p].values
+                     for t in time_levels for p in plev_levels)
+            print "[{0}] Regridding {1} slabs with {2} workers.".format(
+                var.name, len(time_levels)*len(plev_levels), workers)
+            newdata[:] = parallel_apply(
+                weights, slabs, workers=workers,
+                leading=(len(time_levels), len(plev_levels)))
+        else:
+            # This aspect of Python cost me an afternoon.  if you create an
+            # iterator like this:
+            #  myiterator = enumerate(var['plev'].values[plev_levels])
+            # ...then that iterator can only be used once.  Once the code
+            # iterfaces through it's values, it's done.  So nested loops using
+            # these DO NOT WORK.
+            for t, time_ in enumerate(var['time'].values[time_levels]):
+                for p, plev in enumerate(var['plev'].values[plev_levels]):
+                    print "[Time: %s][Plev: %s]" % (time_, plev)
+                    x = var[time_levels[t], plev_levels[p]].values
+                    newdata[t,p,:,:] = weights.apply(x)
                 
         # Package the new variable, defined on the destination lattice, into an
         # xarray DataArray.
@@ -361,239 +465,2495 @@ def regrid(variables, lattice='union', tl=None, pl=None):
 
     return newvars
 
-def simple_regrid(var, grid=None, likevar=None, progressbar=None):
+# The shape of the axes of data that are not horizontal dimensions of grid.
+def leading_shape(data, grid):
+    return data.shape[:data.ndim - len(grid.shape)]
 
-    # Check for regrid capability.  If there are more than three dimensions,
-    # it's not feasible yet.  If there are exactly three, the third must be
-    # time.
-    have_time_dim = (len(var.shape) == 3 and 'time' in var.dims)
 
-    if grid is not None:
-        to_coords = grid
-    elif likevar is not None:
-        to_coords = Grid(array=likevar)
-    else:
-        to_coords = GRID_025
-    
-    # Display the ranges involved in the regrid, for confidence.
-    from_coords = Grid(array=var)
-    print "Regridding from {0} to {1}.".format(str(from_coords),
-                                               str(to_coords))
+# The interpolation weights depend only on the source and destination grids,
+# not on the data.  Computing them once and storing them in a sparse matrix
+# turns the regrid of every time step into a single matrix product.
+class RegridWeights(object):
+    """The weights that interpolate one grid onto another.
 
-    # Impose a Delaunay triangulation and an indexing structure
-    # on the variable.
-    varcoords = from_coords.cartesian
-    vartri = Delaunay(varcoords)
+    Parameters
+    ----------
+        matrix (scipy.sparse.csr_matrix): A matrix of shape (M, N), where M is
+        the number of points in the destination grid and N is the number of
+        points in the source grid.  Both grids are flattened latitude first,
+        the same order as Grid.cartesian.
 
-    # Create a DataArray object with the new shape filled with np.NaNs.  This
-    # will be filled with values interpolation from the variable var.
-    if have_time_dim:
-        blankdata = np.empty((len(var.time),
-                              to_coords.latlen,
-                              to_coords.lonlen))
-        blankdata.fill(np.NaN)
-        newvar = xr.DataArray(blankdata,
-                              name=var.name,
-                              attrs=var.attrs,
-                              coords={'time': var.time,
-                                      'lat': to_coords.lat,
-                                      'lon': to_coords.lon},
-                              dims=['time', 'lat', 'lon'])
-    else:
-        blankdata = np.empty((to_coords.latlen, to_coords.lonlen))
-        blankdata.fill(np.NaN)
-        newvar = xr.DataArray(blankdata,
-                              name=var.name,
-                              attrs=var.attrs,
-                              coords={'lat': to_coords.lat,
-                                      'lon': to_coords.lon},
-                              dims=['lat', 'lon'])
-    
-    # Set the missing_value attribute to 'NaN (numpy)'.  Set the grid attribute
-    # to the new grid.
-    newvar.attrs['missing_value'] = 'nan'
-    newvar.attrs['grid'] = str(to_coords)
+        valid (ndarray of bool): For each of the M destination points, True if
+        the point falls inside the source grid.  Points outside the source
+        grid are assigned np.NaN.
 
-    # Show progress at the latitudes.  Otherwise it's too many.
-    if progressbar is not None:
-        progressbar.start(to_coords.latlen*to_coords.lonlen)
+        from_grid, to_grid (Grid): The source and destination grids.
+    """
+    def __init__(self, matrix, valid, from_grid, to_grid):
+        self.matrix = matrix
+        self.valid = valid
+        self.from_grid = from_grid
+        self.to_grid = to_grid
 
-    # Iterate the new variable's grid, calculating the value from an
-    # interpolation of the simplices in the original variable.
-    # FIX ME: The interpolation function is calculated for as many points of
-    # the new variable that fall in a single simplex.  It only needs to be
-    # calculated once per simplex.
-    for i,j in to_coords.grid_points():
-        
-        # These steps produce the i-th simplex (triangle) in the variable.
-        lattice_point = [to_coords.lat[i], to_coords.lon[j]]
-        simplex_number = vartri.find_simplex(lattice_point)
-        if simplex_number >= 0:
-            simplex_points = vartri.simplices[simplex_number]
-            simplex = vartri.points[simplex_points]
-            
-            # These steps produce the n-values of the variable for the
-            # n-simplex.  Since the simplices are triangles, these steps
-            # produce three values.
-            if have_time_dim:
-                for t in range(0, len(var.time)):
-#                for t in range(0, 3):
-                    vals = []
-                    for k, vertex in enumerate(simplex):
-                        val = var.sel(time=var.time[t],
-                                      lat=vertex[0],
-                                      lon=vertex[1])
-                        vals.append(val)
-        
-                    # These steps produce the function f that calculates the
-                    # interpolated value anywhere in the simplex (triangle),
-                    # and then calculates that value at the lattice point, and
-                    # assigns it.
-                    f = LinearNDInterpolator(simplex, vals)
-                    x = f(lattice_point)
-                    newvar[t, i, j] = x 
-            else:
-                vals = []
-                for k, vertex in enumerate(simplex):
-                    val = var.sel(lat=vertex[0], lon=vertex[1])
-                    vals.append(val)
-    
-                # These steps produce the function f that calculates the
-                # interpolated value anywhere in the simplex (triangle), and
-                # then calculates that value at the lattice point, and assigns
-                # it.
-                f = LinearNDInterpolator(simplex, vals)
-                x = f(lattice_point)
-                newvar[i, j] = x 
-    
-        # Show progress.
-        if progressbar is not None:
-            msg = ("Calculated values for ({:2.3f}, {:2.3f}).").format(
-                to_coords.lat[i], to_coords.lon[j])
-            progressbar.update(msg)
+    def apply(self, data):
+        """Interpolate data defined on the source grid.
 
-    return newvar
+        The last axes of data must be the horizontal dimensions of the source
+        grid (latitude and longitude, in that order, for a rectilinear grid).
+        Any leading axes (e.g. time) are interpolated all at once.  Returns
+        an array with the same leading axes, and the horizontal dimensions
+        of the destination grid.
+        """
+        data = np.asarray(data)
+        leading = leading_shape(data, self.from_grid)
+        batch = int(np.prod(leading))
+        flat = np.reshape(data, (batch, -1))
 
-def standardize_latlon(var):
-    """Standardizes the latitudes and longitudes.
-    
-    Returns the data in a DataArray where the latitudes range from [-90,90] and
-    the longitudes range from (-180, 180].
+        # The product (M, N) x (N, batch) interpolates every time step in one
+        # pass over the sparse matrix.
+        out = self.matrix.dot(flat.T).T
+        out[:, ~self.valid] = np.NaN
+        return np.reshape(out, leading + self.to_grid.shape)
+
+    # The weight cache stores plain arrays, so the weights can be saved to
+    # disk and shared between sessions.
+    def arrays(self):
+        """Return the weights as a dictionary of arrays."""
+        return {'matrix': self.matrix, 'valid': self.valid}
+
+    @classmethod
+    def from_arrays(cls, arrays, from_grid, to_grid):
+        """Create the weights from the output of arrays()."""
+        return cls(arrays['matrix'], arrays['valid'].astype(bool),
+                   from_grid, to_grid)
+
+
+# A triangulation in (lat, lon) degrees is cut at the longitude seam, and at
+# the seams and folds of ocean grids, and can't find destination points in
+# another longitude convention (0..360 against -280..80).  On the unit sphere
+# there are no seams:  the Delaunay triangulation of points on a sphere is
+# their convex hull.
+class SphericalTriangulation(object):
+    """A triangulation of the points of a grid on the unit sphere.
+
+    Parameters
+    ----------
+        grid (Grid): The grid to triangulate.  Any arrangement of points
+        will do: rectilinear, curvilinear or unstructured, global or
+        regional.
     """
-    # Ensure the variable order is lat,lon, time.
-    retvar = var.transpose('lat', 'lon', 'time')
-    
-    if retvar.lat[1] - var.lat[0] < 0:
-        data = retvar[::-1,:,:]
-        lats = retvar.lat[::-1]
-    else:
-        data = retvar[:,:,:]
-        lats = retvar.lat
+    def __init__(self, grid):
+        points = grid.xyz
+        simplices = ConvexHull(points, qhull_options='QJ').simplices
 
-    need_longitude_roll = (max(retvar.lon) > 180)
-    if need_longitude_roll:
-        lons = np.mod(retvar.lon + 180, 360) - 180
-    else:
-        lons = retvar.lon
-    
-    retvar = xr.DataArray(data,
-                          name=var.name,
-                          attrs=var.attrs,
-                          coords={'lat': lats, 'lon': lons, 'time': var.time},
-                          dims=['lat', 'lon', 'time'])
-    
-    # The negative longitudes may be at the nd of the lon array.  This moves
-    # them to the front.
-    if need_longitude_roll:
-        negvals = np.where(retvar.lon.values < 0)
-        if negvals[0].size > 0:
-            offset = negvals[0][0]
-            retvar = retvar.roll(lon=offset)
+        # Orient every triangle counterclockwise, seen from outside.
+        a, b, c = [points[simplices[:, i]] for i in range(3)]
+        flip = np.einsum('ij,ij->i', np.cross(a, b), c) < 0
+        simplices[flip] = simplices[flip][:, ::-1]
 
-    return retvar
+        # The hull of a grid that doesn't cover the sphere has a lid of long
+        # triangles across the hole, which are not triangles of the grid.
+        # A triangle of the grid is no longer than twice the distance from
+        # any point to its 8th nearest neighbour.
+        neighbours = min(9, len(points))
+        spacing = cKDTree(points).query(points, k=neighbours)[0][:, -1].max()
+        a, b, c = [points[simplices[:, i]] for i in range(3)]
+        longest = np.max([np.sqrt(np.sum((u - v)**2, axis=1))
+                          for u, v in ((a, b), (b, c), (c, a))], axis=0)
+        self.points = points
+        self.simplices = simplices[longest <= 2*spacing]
 
-def transpose_var(data):
-    """Determines if the data in an Xarray DataArray is transposed.
-    
-    Occasionally, the data in a dataset is organized with the longitude
-    coordinate first and the latitude coordinate second.  This is causing
-    problems with the matplotlib contourf and addcyclic methods.
-    
-    This function determines the lon dimension by comparing the shape of the
-    data to the lengths of the latitude and longitude coordinates.  If the
-    shape is such that the longitude is first, the data is transposed and the
-    new DataArray is returned.
+        centres = points[self.simplices].mean(axis=1)
+        centres /= np.sqrt(np.sum(centres**2, axis=1))[:, np.newaxis]
+        self._centres = cKDTree(centres)
+        # No point of a triangle is further than this from its centre.
+        self._radius = np.max(np.sqrt(np.sum(
+            (points[self.simplices] - centres[:, np.newaxis, :])**2,
+            axis=-1)))
+
+    def locate(self, targets, candidates=8, block=65536):
+        """Find the triangle of each target point.
+
+        targets is an (M, 3) array of points on the unit sphere.  Returns
+        the number of each point's triangle (-1 if it falls in none), and an
+        (M, 3) array of its weights for the triangle's vertices: its
+        barycentric coordinates, projected from the centre of the sphere.
+        Each point is looked for among the candidates triangles with the
+        nearest centres.  The few points not found there (in long, thin
+        triangles) are looked for in every triangle that might hold them.
+        """
+        targets = np.asarray(targets, dtype=np.float64)
+        found = -np.ones(len(targets), dtype=np.intp)
+        weights = np.zeros((len(targets), 3))
+        k = min(candidates, len(self.simplices))
+        for start in range(0, len(targets), block):
+            rows = np.arange(start, min(start + block, len(targets)))
+            nearest = self._centres.query(targets[rows], k=k)[1]
+            if k == 1:
+                nearest = nearest[:, np.newaxis]
+            self._choose(targets[rows], nearest, rows, found, weights)
+
+        for row in np.nonzero(found < 0)[0]:
+            nearest = self._centres.query_ball_point(targets[row],
+                                                     self._radius)
+            if len(nearest) > 0:
+                self._choose(targets[row:row + 1], np.array([nearest]),
+                             np.array([row]), found, weights)
+        return found, weights
+
+    def _choose(self, targets, nearest, rows, found, weights):
+        # Test each target against its (N, k) nearest triangles.
+        a, b, c = [self.points[self.simplices[nearest, i]] for i in range(3)]
+        p = targets[:, np.newaxis, :]
+
+        # Cramer's rule:  p = la*a + lb*b + lc*c.  A degenerate (flat)
+        # triangle has a zero determinant, and contains nothing.
+        det = np.einsum('ijk,ijk->ij', a, np.cross(b, c))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bary = np.stack(
+                [np.einsum('ijk,ijk->ij', p, np.cross(b, c)),
+                 np.einsum('ijk,ijk->ij', a, np.cross(p, c)),
+                 np.einsum('ijk,ijk->ij', a, np.cross(b, p))],
+                axis=-1)/det[:, :, np.newaxis]
+        inside = ((det > 1e-15)[:, :, np.newaxis] &
+                  (bary >= -1e-10)).all(axis=-1)
+
+        hit = inside.any(axis=1)
+        first = np.argmax(inside, axis=1)[hit]
+        chosen = np.clip(bary[hit, first], 0, None)
+        found[rows[hit]] = nearest[hit, first]
+        weights[rows[hit]] = chosen/chosen.sum(axis=1)[:, np.newaxis]
+
+
+def barycentric_weights(from_grid, to_grid):
+    """Compute linear interpolation weights from a triangulation.
+
+    The source grid is triangulated once, on the unit sphere (see
+    SphericalTriangulation), and every point of the destination grid is
+    located in it at once.  The barycentric coordinates of each point in its
+    triangle are the interpolation weights of the triangle's three vertices.
+    Destination points outside the source grid are NaN.
+
+    Returns a RegridWeights object.
     """
-    data_shape = data.shape
-    if data_shape[0] == len(data.lon.values):
-        # Longitude is first.  It needs to be transposed.
-        var_name = data.name
-        var_data = data.values
-        new_var_data = np.transpose(var_data)
-        new_array = xr.DataArray(new_var_data,
-                                 coords=[data.lat.values, data.lon.values],
-                                 dims=['lat', 'lon'])
-        new_array.name = var_name
-        return new_array
-    else:
-        return data
+    triangulation = SphericalTriangulation(from_grid)
+    simplex_numbers, bary = triangulation.locate(to_grid.xyz)
+    valid = (simplex_numbers >= 0)
 
-def get_urs_file(url):
-    username = 'godfrey4000'
-    password = 'J#bunan0'
-#    the_url = 'https://disc2.gesdisc.eosdis.nasa.gov:443/opendap/TRMM_L3/TRMM_3B42.7/1998/001/3B42.19980101.03.7.HDF'
-    session = setup_session(username, password, check_url=url)
-#    dataset = open_url(the_url, session=session)
-    ds = xr.open_dataset(url, decode_cf=False, engine='pydap', session=session)
-    return ds
+    rows = np.repeat(np.nonzero(valid)[0], 3)
+    cols = triangulation.simplices[simplex_numbers[valid]]
+    matrix = sparse.csr_matrix((bary[valid].ravel(), (rows, cols.ravel())),
+                               shape=(to_grid.size, from_grid.size))
+    return RegridWeights(matrix, valid, from_grid, to_grid)
 
-def gaussian_smooth(var, sigma):
-    """Apply a filter, along the time dimension.
-    
-    Applies a gaussian filter to the data along the time dimension.  if the
-    time dimension is missing, raises an exception.  The DataArray that is
-    returned is shortened along the time dimension by sigma, half of sigma on
-    each end.
-    
-    The width of the window is 2xsigma + 1.
+
+# On a rectilinear grid, bilinear interpolation is separable:  interpolate
+# along longitude, then along latitude.  Each axis needs only the two
+# neighbouring indices and a weight for every destination coordinate, so the
+# cost is linear in the size of the data.
+class SeparableWeights(object):
+    """The weights that interpolate one rectilinear grid onto another.
+
+    For each axis, index holds the two neighbouring source indices of every
+    destination coordinate, weight is the fraction of the way from the first
+    to the second, and valid is False where the destination coordinate is
+    outside the source grid.
     """
-    if type(var) is not xr.DataArray:
-        raise TypeError("First argument must be an Xarray DataArray.")
-    if 'time' not in var.dims:
-        raise IndexError("Time coordinate not found.")
+    def __init__(self, lat_index, lat_weight, lat_valid,
+                 lon_index, lon_weight, lon_valid, from_grid, to_grid):
+        self.lat_index = lat_index
+        self.lat_weight = lat_weight
+        self.lat_valid = lat_valid
+        self.lon_index = lon_index
+        self.lon_weight = lon_weight
+        self.lon_valid = lon_valid
+        self.from_grid = from_grid
+        self.to_grid = to_grid
 
-    # The convolution window must have the same number of dimensions as the
-    # variable.  The length of every dimension is one, except time, which is
-    # 2xsigma + 1.
-    var_dimensions = np.ones( len(var.coords), dtype=np.int )
-    timepos = var.dims.index('time')
-    var_dimensions[timepos] = 2*sigma + 1
-    
-    # Use a normalized gaussian so the average of the variable does not change.
-    gausswin = gaussian(2*sigma + 1, sigma)
-    gausswin = gausswin/np.sum(gausswin)
+    def apply(self, data):
+        """Interpolate data defined on the source grid.
+
+        The last two axes of data must be latitude and longitude, in that
+        order.  Any leading axes (e.g. time) are interpolated all at once.
+        """
+        data = np.asarray(data)
+        w = self.lon_weight
+        tmp = (data[..., self.lon_index[:, 0]]*(1 - w) +
+               data[..., self.lon_index[:, 1]]*w)
+
+        w = self.lat_weight[:, np.newaxis]
+        out = (tmp[..., self.lat_index[:, 0], :]*(1 - w) +
+               tmp[..., self.lat_index[:, 1], :]*w)
+        out[..., ~self.lat_valid, :] = np.NaN
+        out[..., ~self.lon_valid] = np.NaN
+        return out
+
+    def arrays(self):
+        """Return the weights as a dictionary of arrays."""
+        return {'lat_index': self.lat_index,
+                'lat_weight': self.lat_weight,
+                'lat_valid': self.lat_valid,
+                'lon_index': self.lon_index,
+                'lon_weight': self.lon_weight,
+                'lon_valid': self.lon_valid}
+
+    @classmethod
+    def from_arrays(cls, arrays, from_grid, to_grid):
+        """Create the weights from the output of arrays()."""
+        return cls(arrays['lat_index'], arrays['lat_weight'],
+                   arrays['lat_valid'].astype(bool),
+                   arrays['lon_index'], arrays['lon_weight'],
+                   arrays['lon_valid'].astype(bool),
+                   from_grid, to_grid)
+
+
+def axis_weights(source, target, period=None):
+    """Linear interpolation indices and weights along one axis.
+
+    The source coordinates must be strictly monotonic, in either direction.
+    If period is given (360 for longitudes that wrap), a target coordinate
+    between the last and first source coordinates is interpolated across the
+    seam, and target coordinates are compared modulo the period.
+
+    Returns (index, weight, valid) as described in SeparableWeights.
+    """
+    source = np.asarray(source, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    order = np.argsort(source)
+    axis = source[order]
+
+    # Append the first coordinate one period later, so the seam is just
+    # another interval.
+    if period is not None:
+        order = np.append(order, order[0])
+        axis = np.append(axis, axis[0] + period)
+        target = axis[0] + np.mod(target - axis[0], period)
+
+    k = np.searchsorted(axis, target, side='right') - 1
+    k = np.clip(k, 0, len(axis) - 2)
+    weight = (target - axis[k])/(axis[k + 1] - axis[k])
+    valid = (target >= axis[0]) & (target <= axis[-1])
+    index = np.c_[order[k], order[k + 1]]
+    return index, weight, valid
+
+
+def bilinear_weights(from_grid, to_grid):
+    """Compute separable bilinear weights between rectilinear grids.
+
+    Returns a SeparableWeights object.
+    """
+    if not from_grid.rectilinear or not to_grid.rectilinear:
+        msg = "Bilinear regridding requires rectilinear grids."
+        raise ValueError(msg)
+
+    lat_index, lat_weight, lat_valid = axis_weights(from_grid.lat,
+                                                    to_grid.lat)
+    period = 360.0 if from_grid.lon_wraps else None
+    lon_index, lon_weight, lon_valid = axis_weights(from_grid.lon,
+                                                    to_grid.lon,
+                                                    period=period)
+    return SeparableWeights(lat_index, lat_weight, lat_valid,
+                            lon_index, lon_weight, lon_valid,
+                            from_grid, to_grid)
+
+
+# First-order conservative remapping.  The value of a destination cell is the
+# area-weighted mean of the source cells it overlaps, so area integrals (e.g.
+# of precipitation or flux) are preserved.
+class ConservativeWeights(object):
+    """The overlap areas between the cells of two grids.
+
+    Parameters
+    ----------
+        matrix (scipy.sparse.csr_matrix): A matrix of shape (M, N).  Entry
+        (m, n) is the area, in steradians, of the overlap of destination cell
+        m and source cell n.  Both grids are flattened latitude first.
+
+        from_grid, to_grid (Grid): The source and destination grids.
+
+    Source cells that are NaN are left out, and the weights of the remaining
+    cells are renormalized.  A destination cell that overlaps no valid
+    source cell is NaN.
+    """
+    def __init__(self, matrix, from_grid, to_grid):
+        self.matrix = matrix
+        self.from_grid = from_grid
+        self.to_grid = to_grid
+
+        # The area of each destination cell covered by the source grid.
+        self.coverage = np.asarray(matrix.sum(axis=1)).ravel()
+
+    def apply(self, data):
+        """Remap data defined on the source grid.
+
+        The last two axes of data must be latitude and longitude, in that
+        order.  Any leading axes (e.g. time) are remapped all at once.
+        """
+        data = np.asarray(data, dtype=np.float64)
+        leading = leading_shape(data, self.from_grid)
+        batch = int(np.prod(leading))
+        flat = np.reshape(data, (batch, -1))
+
+        # Without missing values, every time step has the same covered area.
+        missing = np.isnan(flat)
+        if missing.any():
+            total = self.matrix.dot(np.where(missing, 0, flat).T).T
+            area = self.matrix.dot((~missing).T.astype(np.float64)).T
+        else:
+            total = self.matrix.dot(flat.T).T
+            area = np.broadcast_to(self.coverage, total.shape)
+
+        out = np.empty(total.shape)
+        out.fill(np.NaN)
+        np.divide(total, area, out=out, where=(area > 0))
+        return np.reshape(out, leading + self.to_grid.shape)
+
+    def arrays(self):
+        """Return the weights as a dictionary of arrays."""
+        return {'matrix': self.matrix}
+
+    @classmethod
+    def from_arrays(cls, arrays, from_grid, to_grid):
+        """Create the weights from the output of arrays()."""
+        return cls(arrays['matrix'], from_grid, to_grid)
+
+
+def cell_bounds(centers, lower=None, upper=None):
+    """The edges of the cells with the given centers.
+
+    The edges are halfway between the centers, and the outer edges are half
+    a cell beyond the first and last centers, clipped to [lower, upper].
+    Works for increasing and decreasing centers.  Returns arrays of the
+    lower and upper edge of each cell.
+    """
+    centers = np.asarray(centers, dtype=np.float64)
+    edges = np.empty(len(centers) + 1)
+    edges[1:-1] = 0.5*(centers[:-1] + centers[1:])
+    edges[0] = centers[0] - 0.5*(centers[1] - centers[0])
+    edges[-1] = centers[-1] + 0.5*(centers[-1] - centers[-2])
+    if lower is not None or upper is not None:
+        edges = np.clip(edges, lower, upper)
+    return np.minimum(edges[:-1], edges[1:]), np.maximum(edges[:-1], edges[1:])
+
+
+def _interval_overlap(to_lower, to_upper, from_lower, from_upper):
+    # An (M, N) array of the lengths of overlap of M and N intervals.
+    low = np.maximum(to_lower[:, np.newaxis], from_lower[np.newaxis, :])
+    high = np.minimum(to_upper[:, np.newaxis], from_upper[np.newaxis, :])
+    return np.maximum(high - low, 0)
 
-    # The window series used in the convolve operation is the gaussion for the
-    # time dimension and a singleton zero for the other dimensions.  This way
-    # the multidimension covolve is:
-    #
-    #    g(m,n,...) = \sum_k \sum_l ... f[k,l,...]h[k-m]\delta_l0...
-    #
-    timeslice_specification = [0 for x in range(len(var.coords))]
-    timeslice_specification[timepos] = slice(None)
-    win = np.zeros(var_dimensions)
-    win[timeslice_specification] = gausswin
-    
-    # The third parameter 'same' specifies a return array of the same shape as
-    # var.
-    out = convolve(var, win, 'same')
-    outda = xr.DataArray(out,
-                         name=var.name,
-                         coords=var.coords,
-                         dims=var.dims)
-    outda.attrs = var.attrs
 
-#    # Append "(Gaussian filtered: sigma = ###" to the end of th variable name.
-#    newname = "{0} (Gaussian filtered: sigma = {1})".format(var.name, sigma)
-#    outda.name = newname
-    return outda
+def conservative_weights(from_grid, to_grid):
+    """Compute the cell overlap areas between rectilinear grids.
+
+    On the sphere, the area of a latitude-longitude cell is proportional to
+    the difference of the sines of its bounding latitudes times its width in
+    longitude.  So the overlap of two cells is the product of an overlap in
+    sin(latitude) and an overlap in longitude, and the overlap matrix is the
+    Kronecker product of the two axis overlap matrices.
+
+    Returns a ConservativeWeights object.
+    """
+    if not from_grid.rectilinear or not to_grid.rectilinear:
+        msg = "Conservative regridding requires rectilinear grids."
+        raise ValueError(msg)
+
+    sin_from = [np.sin(np.radians(b))
+                for b in cell_bounds(from_grid.lat, -90, 90)]
+    sin_to = [np.sin(np.radians(b))
+              for b in cell_bounds(to_grid.lat, -90, 90)]
+    lat_overlap = _interval_overlap(sin_to[0], sin_to[1],
+                                    sin_from[0], sin_from[1])
+
+    # Longitudes are compared modulo 360, so a source cell is also tried one
+    # turn east and one turn west of where it is.
+    from_lower, from_upper = cell_bounds(from_grid.lon)
+    to_lower, to_upper = cell_bounds(to_grid.lon)
+    lon_overlap = sum(_interval_overlap(to_lower, to_upper,
+                                        from_lower + shift,
+                                        from_upper + shift)
+                      for shift in (-360.0, 0.0, 360.0))
+    lon_overlap = np.radians(lon_overlap)
+
+    matrix = sparse.kron(sparse.csr_matrix(lat_overlap),
+                         sparse.csr_matrix(lon_overlap), format='csr')
+    return ConservativeWeights(matrix, from_grid, to_grid)
+
+
+# Nearest-neighbour and inverse-distance weights are found in a k-d tree of
+# the source points.  The points are placed on the unit sphere first, so the
+# distances are correct across the poles and the dateline.
+class NeighbourWeights(object):
+    """The weights of the nearest source points of each destination point.
+
+    index is an (M, k) array of the k nearest source points of each of the
+    M destination points, and weight is an (M, k) array of their weights.
+    Both grids are flattened latitude first.
+    """
+    def __init__(self, index, weight, from_grid, to_grid):
+        self.index = index
+        self.weight = weight
+        self.from_grid = from_grid
+        self.to_grid = to_grid
+
+    def apply(self, data):
+        """Interpolate data defined on the source grid.
+
+        The last axes of data must be the horizontal dimensions of the source
+        grid.  Any leading axes (e.g. time) are interpolated all at once.
+        """
+        data = np.asarray(data)
+        leading = leading_shape(data, self.from_grid)
+        batch = int(np.prod(leading))
+        flat = np.reshape(data, (batch, -1))
+
+        out = np.zeros((batch, len(self.index)))
+        for j in range(self.index.shape[1]):
+            out += flat[:, self.index[:, j]]*self.weight[:, j]
+        return np.reshape(out, leading + self.to_grid.shape)
+
+    def arrays(self):
+        """Return the weights as a dictionary of arrays."""
+        return {'index': self.index, 'weight': self.weight}
+
+    @classmethod
+    def from_arrays(cls, arrays, from_grid, to_grid):
+        """Create the weights from the output of arrays()."""
+        return cls(arrays['index'], arrays['weight'], from_grid, to_grid)
+
+
+def unit_sphere(points):
+    """Convert (lat, lon) points in degrees to (x, y, z) on the unit sphere."""
+    lat = np.radians(points[:, 0])
+    lon = np.radians(points[:, 1])
+    return np.c_[np.cos(lat)*np.cos(lon),
+                 np.cos(lat)*np.sin(lon),
+                 np.sin(lat)]
+
+
+def _neighbour_cutoff(tree, max_distance):
+    # The chord distance on the unit sphere beyond which a source point is
+    # not a neighbour.  By default it is twice the spacing of the source
+    # points: the largest distance from a point to its nearest neighbour.
+    if max_distance is None:
+        if tree.n < 2:
+            return np.inf
+        return 2*tree.query(tree.data, k=2)[0][:, 1].max()
+    if np.isinf(max_distance):
+        return np.inf
+    return 2*np.sin(np.radians(max_distance)/2)
+
+
+def nearest_weights(from_grid, to_grid, max_distance=None):
+    """Compute nearest-neighbour weights.
+
+    A destination point with no source point within max_distance (in
+    degrees of arc) is NaN, as it is outside the source grid for the linear
+    methods.  The default is twice the spacing of the source points.  If
+    max_distance is np.inf, every point takes the value of the nearest.
+
+    Returns a NeighbourWeights object.
+    """
+    tree = cKDTree(from_grid.xyz)
+    distance, index = tree.query(to_grid.xyz, k=1)
+    weight = np.where(distance <= _neighbour_cutoff(tree, max_distance),
+                      1.0, np.NaN)
+    return NeighbourWeights(index[:, np.newaxis], weight[:, np.newaxis],
+                            from_grid, to_grid)
+
+
+def idw_weights(from_grid, to_grid, k=4, power=2, max_distance=None):
+    """Compute inverse-distance weights of the k nearest source points.
+
+    The weight of a source point is proportional to 1/d**power, where d is
+    the chord distance on the unit sphere.  A destination point that falls
+    exactly on a source point takes that point's value.  Source points
+    farther than max_distance are left out, as for nearest_weights, and a
+    destination point with none is NaN.
+
+    Returns a NeighbourWeights object.
+    """
+    tree = cKDTree(from_grid.xyz)
+    distance, index = tree.query(to_grid.xyz, k=k)
+    if k == 1:
+        distance = distance[:, np.newaxis]
+        index = index[:, np.newaxis]
+    near = distance <= _neighbour_cutoff(tree, max_distance)
+
+    exact = (distance[:, 0] == 0)
+    distance[exact] = 1
+    weight = 1.0/distance**power
+    weight[~near] = 0
+    weight[exact] = 0
+    weight[exact, 0] = 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = weight/weight.sum(axis=1)[:, np.newaxis]
+
+    # The index of a missing neighbour is out of range for a small source.
+    index = np.where(near, index, 0)
+    return NeighbourWeights(index, weight, from_grid, to_grid)
+
+
+# Every kind of weights is linear in the data.  So applying the weights to
+# the source with missing values set to zero, and to the mask of valid
+# values, gives the weighted sum of the valid values and the sum of their
+# weights.  Their ratio is the interpolation renormalized around the missing
+# values.
+def apply_weights(weights, data, min_coverage=None):
+    """Apply regrid weights, optionally renormalizing around NaN values.
+
+    If min_coverage is None, the weights are applied as they are, and any
+    NaN source value makes the destination values that depend on it NaN.
+    Otherwise, NaN source values are left out and the weights of the rest
+    are renormalized.  A destination value is NaN if the weight of the valid
+    source values is less than min_coverage (a fraction from 0 to 1), e.g.
+    0.5 requires at least half the weight to come from valid values.
+    """
+    if min_coverage is None:
+        return weights.apply(data)
+
+    data = np.asarray(data, dtype=np.float64)
+    missing = np.isnan(data)
+    if not missing.any():
+        return weights.apply(data)
+
+    # The values and the mask are regridded in the same product.
+    stacked = np.stack([np.where(missing, 0, data),
+                        (~missing).astype(np.float64)])
+    total, coverage = weights.apply(stacked)
+
+    out = np.empty(total.shape)
+    out.fill(np.NaN)
+    # Destination points outside the source grid have NaN coverage.
+    with np.errstate(invalid='ignore'):
+        keep = (coverage > 0) & (coverage >= min_coverage - 1e-12)
+    np.divide(total, coverage, out=out, where=keep)
+    return out
+
+
+# When the destination grid is an exact integer coarsening of the source grid
+# (e.g. 0.5 degree to 2.5 degrees), each destination cell is the mean of a
+# block of source cells.  No interpolation is needed.
+class BlockWeights(object):
+    """The blocks of source cells that make up each destination cell.
+
+    lat_index is an (M, f) array of the f source latitudes in each of the M
+    destination latitudes, and lon_index likewise for longitudes.
+    lat_weight is an (M, f) array of the weight of each source latitude:
+    all ones for a plain mean, or the cell areas for an area-weighted mean.
+    """
+    def __init__(self, lat_index, lon_index, lat_weight, from_grid, to_grid):
+        self.lat_index = lat_index
+        self.lon_index = lon_index
+        self.lat_weight = lat_weight
+        self.from_grid = from_grid
+        self.to_grid = to_grid
+
+    def apply(self, data):
+        """Average the blocks of data defined on the source grid.
+
+        The last two axes of data must be latitude and longitude, in that
+        order.  Any leading axes (e.g. time) are averaged all at once.  NaN
+        values are left out of the mean.
+        """
+        data = np.asarray(data, dtype=np.float64)
+        leading = leading_shape(data, self.from_grid)
+        mlat, flat = self.lat_index.shape
+        mlon, flon = self.lon_index.shape
+
+        # Gather the blocks into axes of their own:  (..., M, f, M, f).
+        blocks = data[..., self.lat_index.ravel(), :]
+        blocks = blocks[..., self.lon_index.ravel()]
+        blocks = np.reshape(blocks, leading + (mlat, flat, mlon, flon))
+
+        valid = ~np.isnan(blocks)
+        weight = valid*self.lat_weight[:, :, np.newaxis, np.newaxis]
+        total = np.sum(np.where(valid, blocks, 0)*weight, axis=(-3, -1))
+        weight = np.sum(weight, axis=(-3, -1))
+
+        out = np.empty(total.shape)
+        out.fill(np.NaN)
+        np.divide(total, weight, out=out, where=(weight > 0))
+        return out
+
+    def arrays(self):
+        """Return the weights as a dictionary of arrays."""
+        return {'lat_index': self.lat_index,
+                'lon_index': self.lon_index,
+                'lat_weight': self.lat_weight}
+
+    @classmethod
+    def from_arrays(cls, arrays, from_grid, to_grid):
+        """Create the weights from the output of arrays()."""
+        return cls(arrays['lat_index'], arrays['lon_index'],
+                   arrays['lat_weight'], from_grid, to_grid)
+
+
+def block_index(source, target, period=None):
+    """The blocks of source coordinates that average to the targets.
+
+    Both axes must be evenly spaced, and the target spacing an integer
+    multiple f of the source spacing.  Source coordinates beyond the last
+    whole block are left out.  If period is given (360 for longitudes that
+    wrap), blocks may straddle the seam.
+
+    Returns an (M, f) array of source indices, or None if the target is not
+    an exact coarsening of the source.
+    """
+    source = np.asarray(source, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    if len(source) < 2 or len(target) < 2:
+        return None
+
+    step = source[1] - source[0]
+    target_step = target[1] - target[0]
+    if not (np.allclose(np.diff(source), step) and
+            np.allclose(np.diff(target), target_step)):
+        return None
+
+    # Work on an increasing source axis.  order maps back to the original.
+    order = np.arange(len(source))
+    if step < 0:
+        order = order[::-1]
+        source = source[::-1]
+        step = -step
+    descending = target_step < 0
+    if descending:
+        target = target[::-1]
+        target_step = -target_step
+
+    factor = int(round(target_step/step))
+    if factor < 1 or abs(target_step - factor*step) > 1e-6*step:
+        return None
+
+    # The first source cell of the first block.
+    offset = (target[0] - 0.5*(factor - 1)*step - source[0])/step
+    if period is not None:
+        if abs(period - len(source)*step) > 1e-6*step:
+            return None
+        offset = np.mod(offset, len(source))
+    start = int(round(offset))
+    if abs(offset - start) > 1e-6:
+        return None
+
+    index = (start + factor*np.arange(len(target))[:, np.newaxis] +
+             np.arange(factor)[np.newaxis, :])
+    if period is not None:
+        if len(target)*factor > len(source):
+            return None
+        index = np.mod(index, len(source))
+    elif start < 0 or index[-1, -1] >= len(source):
+        return None
+
+    index = order[index]
+    if descending:
+        index = index[::-1]
+    return index
+
+
+# A curvilinear grid is coarsened in blocks of its (y, x) cells.  The centre
+# of a block is the mean of its points on the sphere, so that blocks across
+# the longitude seam, or at the pole, are in the right place.
+def _curvilinear_blocks(grid, factor):
+    # The y and x blocks of grid, and the latitudes and longitudes of the
+    # coarse grid.
+    if len(grid.dims) != 2:
+        msg = "An unstructured grid has no blocks of cells to coarsen."
+        raise ValueError(msg)
+    indexes = []
+    for size, f in zip(grid.shape, factor):
+        f = int(f)
+        nblocks = size//f if f > 0 else 0
+        if nblocks == 0:
+            msg = "Cannot coarsen {0} points by a factor of {1}.".format(
+                size, f)
+            raise ValueError(msg)
+        indexes.append(np.arange(nblocks*f).reshape(nblocks, f))
+    y_index, x_index = indexes
+
+    xyz = np.reshape(grid.xyz, grid.shape + (3,))
+    blocks = xyz[y_index.ravel()][:, x_index.ravel()]
+    blocks = np.reshape(blocks, y_index.shape + x_index.shape + (3,))
+    centre = blocks.sum(axis=(1, 3))
+    centre /= np.sqrt(np.sum(centre**2, axis=-1))[..., np.newaxis]
+    lat = np.degrees(np.arcsin(np.clip(centre[..., 2], -1, 1)))
+    lon = np.degrees(np.arctan2(centre[..., 1], centre[..., 0]))
+    return y_index, x_index, lat, lon
+
+
+def _coarsen_blocks(from_grid, to_grid):
+    # The lat and lon blocks (y and x for a curvilinear grid), or None if
+    # to_grid is not an exact coarsening.
+    if from_grid.curvilinear or to_grid.curvilinear:
+        if (from_grid.dims != to_grid.dims or len(from_grid.dims) != 2 or
+                np.ndim(to_grid.lat) != 2):
+            return None
+        factor = [size//coarse if coarse > 0 else 0
+                  for size, coarse in zip(from_grid.shape, to_grid.shape)]
+        try:
+            y_index, x_index, lat, lon = _curvilinear_blocks(from_grid,
+                                                             factor)
+        except ValueError:
+            return None
+        if lat.shape != to_grid.shape:
+            return None
+        lon_error = np.mod(lon - to_grid.lon + 180, 360) - 180
+        if not (np.allclose(lat, to_grid.lat, atol=1e-6) and
+                np.allclose(lon_error, 0, atol=1e-6)):
+            return None
+        return y_index, x_index
+
+    if not from_grid.rectilinear or not to_grid.rectilinear:
+        return None
+    lat_index = block_index(from_grid.lat, to_grid.lat)
+    period = 360.0 if from_grid.lon_wraps else None
+    lon_index = block_index(from_grid.lon, to_grid.lon, period=period)
+    if lat_index is None or lon_index is None:
+        return None
+    return lat_index, lon_index
+
+
+def is_coarsening(from_grid, to_grid):
+    """True if to_grid is an exact integer coarsening of from_grid."""
+    return _coarsen_blocks(from_grid, to_grid) is not None
+
+
+def coarsen_weights(from_grid, to_grid, area_weighted=False):
+    """Compute the blocks for coarsening from_grid to to_grid.
+
+    With area_weighted, each source cell is weighted by its area on the
+    sphere.  Otherwise the blocks are plain means.  The cells of a
+    curvilinear grid have no bounds to weight them by, so their blocks are
+    always plain means.
+
+    Returns a BlockWeights object.
+    """
+    blocks = _coarsen_blocks(from_grid, to_grid)
+    if blocks is None:
+        msg = "Grid {0} is not an exact coarsening of grid {1}.".format(
+            str(to_grid), str(from_grid))
+        raise ValueError(msg)
+    lat_index, lon_index = blocks
+
+    if area_weighted and from_grid.curvilinear:
+        msg = "Area weighted coarsening requires a rectilinear grid."
+        raise ValueError(msg)
+    if area_weighted:
+        lower, upper = cell_bounds(from_grid.lat, -90, 90)
+        area = np.sin(np.radians(upper)) - np.sin(np.radians(lower))
+        lat_weight = area[lat_index]
+    else:
+        lat_weight = np.ones(lat_index.shape)
+    return BlockWeights(lat_index, lon_index, lat_weight, from_grid, to_grid)
+
+
+# The state of a worker process in parallel_apply().  The pool initializer
+# sets it once per process, so the weights are not sent with every task, and
+# the slabs are read from, and written to, shared memory.
+_worker_state = {}
+
+
+def _init_regrid_worker(weights, source, source_shape, target, target_shape):
+    _worker_state['weights'] = weights
+    _worker_state['source'] = np.frombuffer(
+        source, dtype=np.float64).reshape(source_shape)
+    _worker_state['target'] = np.frombuffer(
+        target, dtype=np.float64).reshape(target_shape)
+
+
+def _regrid_slabs(bounds):
+    start, stop = bounds
+    source = _worker_state['source']
+    target = _worker_state['target']
+    target[start:stop] = _worker_state['weights'].apply(source[start:stop])
+    return stop - start
+
+
+def parallel_apply(weights, data, workers=None, slabs_per_task=None,
+                   leading=None):
+    """Apply regrid weights to data with a pool of processes.
+
+    The last axes of data must be the horizontal dimensions of the source
+    grid.  The leading axes (e.g. time and plev) are flattened into slabs, and groups of slabs
+    are handed to the workers.  The source and the result are held in shared
+    memory, so the workers neither receive nor return copies of the data.
+
+    Parameters
+    ----------
+        weights (RegridWeights): The weights to apply.
+
+        data (ndarray): The values on the source grid.  If leading is
+        given, data is instead an iterable of the slabs, each on the source
+        grid, in order; they are copied into shared memory as they come.
+
+        workers (int) optional: The number of processes.  Defaults to the
+        number of CPUs.
+
+        slabs_per_task (int) optional: The number of slabs in each task.  By
+        default the slabs are split into four tasks per worker, which evens
+        out the load without much overhead.
+
+        leading (tuple) optional: The shape of the leading axes, when data
+        is an iterable of slabs.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    if leading is None:
+        data = np.asarray(data)
+        leading = leading_shape(data, weights.from_grid)
+        data = data.reshape((-1,) + weights.from_grid.shape)
+    leading = tuple(leading)
+    nslabs = int(np.prod(leading))
+    source_shape = (nslabs,) + weights.from_grid.shape
+    target_shape = (nslabs,) + weights.to_grid.shape
+
+    source = RawArray('d', int(np.prod(source_shape)))
+    shared = np.frombuffer(source, dtype=np.float64).reshape(source_shape)
+    count = 0
+    for number, slab in enumerate(data):
+        shared[number] = slab
+        count = number + 1
+    if count != nslabs:
+        msg = "Expected {0} slabs, got {1}.".format(nslabs, count)
+        raise ValueError(msg)
+    target = RawArray('d', int(np.prod(target_shape)))
+
+    if slabs_per_task is None:
+        slabs_per_task = max(1, -(-nslabs//(4*workers)))
+    tasks = [(start, min(start + slabs_per_task, nslabs))
+             for start in range(0, nslabs, slabs_per_task)]
+
+    pool = multiprocessing.Pool(workers,
+                                initializer=_init_regrid_worker,
+                                initargs=(weights, source, source_shape,
+                                          target, target_shape))
+    try:
+        done = 0
+        for count in pool.imap_unordered(_regrid_slabs, tasks):
+            done += count
+            sys.stdout.write("\r[{0}/{1}] slabs".format(done, nslabs))
+        print ""
+    finally:
+        pool.close()
+        pool.join()
+
+    result = np.frombuffer(target, dtype=np.float64)
+    return result.reshape(leading + target_shape[1:]).copy()
+
+
+# The functions that compute the weights for each regrid method.
+_weight_methods = {
+    'linear': (barycentric_weights, RegridWeights),
+    'bilinear': (bilinear_weights, SeparableWeights),
+    'conservative': (conservative_weights, ConservativeWeights),
+    'nearest': (nearest_weights, NeighbourWeights),
+    'idw': (idw_weights, NeighbourWeights),
+    'coarsen': (coarsen_weights, BlockWeights),
+    }
+
+
+def choose_method(from_grid, to_grid):
+    """Choose the fastest interpolation method the grids allow.
+
+    A destination grid that is an exact coarsening of the source is made of
+    block means.  Curvilinear and unstructured grids are triangulated.
+    """
+    if is_coarsening(from_grid, to_grid):
+        return 'coarsen'
+    if from_grid.rectilinear and to_grid.rectilinear:
+        return 'bilinear'
+    return 'linear'
+
+
+def regrid_weights(from_grid, to_grid, method='auto', cache=None,
+                   **options):
+    """Return the weights to regrid from one grid to another.
+
+    The weights are looked up in the cache first, and computed only if the
+    pair of grids has not been seen before.  If cache is None, the shared
+    weight cache is used.  The method 'auto' chooses bilinear weights for
+    rectilinear grids, block means when the destination is an exact
+    coarsening of the source, and linear (triangulated) weights otherwise.
+
+    Any options (e.g. k and power for 'idw') are passed to the function that
+    computes the weights, and are part of the cache key.
+    """
+    if method == 'auto':
+        method = choose_method(from_grid, to_grid)
+    if method not in _weight_methods:
+        msg = "Regrid method {0} is not supported.".format(method)
+        raise NotImplementedError(msg)
+    compute, weights_class = _weight_methods[method]
+
+    if cache is None:
+        cache = weight_cache
+    name = method
+    for option in sorted(options):
+        name = name + "-{0}{1}".format(option, options[option])
+    key = cache.key(name, from_grid, to_grid)
+    arrays = cache.get(key)
+    if arrays is not None:
+        return weights_class.from_arrays(arrays, from_grid, to_grid)
+
+    weights = compute(from_grid, to_grid, **options)
+    cache.put(key, weights.arrays())
+    return weights
+
+
+def simple_regrid(var, grid=None, likevar=None, progressbar=None,
+                  method='auto', min_coverage=None, **options):
+    """Regrid a DataArray on a latitude-longitude grid.
+
+    Every dimension other than lat and lon (time, plev, realization, ...) is
+    kept, along with its coordinates.  The same weights are applied to all of
+    them at once.
+
+    Parameters
+    ----------
+        var (DataArray): The variable to regrid.
+
+        grid (Grid) optional: The destination grid.
+
+        likevar (DataArray) optional: A variable whose grid is used as the
+        destination grid, if grid is not specified.  If neither is specified,
+        GRID_025 is used.
+
+        progressbar optional: A progress bar to show progress.
+
+        method (str) optional: 'bilinear' interpolates one axis at a time,
+        and requires rectilinear grids.  'linear' interpolates in the
+        triangles of a triangulation of the source grid on the sphere, so
+        any arrangement of points and any longitude convention will do.
+        'auto' (the default) chooses bilinear when the grids allow it.
+        Either way all points and all time steps are interpolated at once
+        with precomputed weights.  'conservative' is a first-order,
+        area-weighted remap that preserves area integrals, for fluxes and
+        precipitation.
+        'coarsen' averages blocks of source cells, when the destination is
+        an exact integer coarsening of the source; 'auto' chooses it then.
+        'nearest' takes the value of the nearest source point, and 'idw'
+        takes the inverse-distance weighted mean of the k nearest.  These
+        are cheap, and work for any arrangement of the source points.  A
+        destination point with no source point within max_distance degrees
+        (by default twice the source spacing) is NaN.
+        'pointwise' interpolates one point and one time step at a time, in
+        a triangulation of the lat-lon plane.  It is very slow, and is
+        retained as the reference the tests check the weights against.
+
+        min_coverage (float) optional: If given, missing (NaN) source values
+        are left out and the weights of the others renormalized, so NaNs
+        (e.g. over land in an ocean field) don't spread.  A destination value
+        is NaN unless at least this fraction of its weight is valid.  See
+        apply_weights.
+
+        options optional: Passed to the function that computes the weights,
+        e.g. k=8 or power=1 for 'idw', or max_distance for 'nearest' and
+        'idw'.
+    """
+    if method == 'pointwise':
+        return _pointwise_regrid(var, grid=grid, likevar=likevar,
+                                 progressbar=progressbar)
+
+    if grid is not None:
+        to_coords = grid
+    elif likevar is not None:
+        to_coords = Grid(array=likevar)
+    else:
+        to_coords = GRID_025
+
+    from_coords = Grid(array=var)
+    print "Regridding from {0} to {1}.".format(str(from_coords),
+                                               str(to_coords))
+
+    if progressbar is not None:
+        progressbar.start(2)
+
+    weights = regrid_weights(from_coords, to_coords, method=method,
+                             **options)
+    if progressbar is not None:
+        progressbar.update("Calculated the interpolation weights.")
+
+    # The weights expect the horizontal dimensions to be the last axes.  All
+    # the other axes are regridded in the same product.
+    dims = batch_dims(var, from_coords.dims)
+    data = var.transpose(*(dims + list(from_coords.dims))).values
+    newvar = xr.DataArray(apply_weights(weights, data, min_coverage),
+                          name=var.name,
+                          attrs=var.attrs,
+                          coords=regridded_coords(var, to_coords,
+                                                  from_coords.dims),
+                          dims=dims + list(to_coords.dims))
+
+    newvar.attrs['missing_value'] = 'nan'
+    newvar.attrs['grid'] = str(to_coords)
+
+    if progressbar is not None:
+        progressbar.update("Interpolated {0} values.".format(newvar.size))
+    return newvar
+
+
+def coarse_grid(grid, factor):
+    """The grid made of blocks of factor by factor cells of grid.
+
+    factor is an int, or a (lat, lon) pair of ints ((y, x) for a
+    curvilinear grid).  Cells left over at the end of an axis that don't
+    make a whole block are dropped.
+    """
+    if np.isscalar(factor):
+        factor = (factor, factor)
+    if grid.curvilinear:
+        y_index, x_index, lat, lon = _curvilinear_blocks(grid, factor)
+        return Grid(lat=lat, lon=lon, dims=grid.dims)
+    axes = []
+    for coord, f in zip((grid.lat, grid.lon), factor):
+        f = int(f)
+        nblocks = len(coord)//f
+        if f < 1 or nblocks == 0:
+            msg = "Cannot coarsen {0} points by a factor of {1}.".format(
+                len(coord), f)
+            raise ValueError(msg)
+        blocks = np.reshape(np.asarray(coord[:nblocks*f], dtype=np.float64),
+                            (nblocks, f))
+        axes.append(blocks.mean(axis=1))
+    return Grid(lat=axes[0], lon=axes[1])
+
+
+def coarsen(var, factor=None, grid=None, likevar=None, area_weighted=False,
+            progressbar=None, min_coverage=None):
+    """Coarsen a DataArray by averaging blocks of grid cells.
+
+    This is much faster than interpolating, and is the natural way to reduce
+    the resolution of a field.  NaN values are left out of the means.
+
+    Parameters
+    ----------
+        var (DataArray): The variable to coarsen.  Its grid must be
+        rectilinear and evenly spaced, or curvilinear, with 2-D latitudes
+        and longitudes.
+
+        factor (int or (int, int)) optional: The number of cells in each
+        block, along latitude and longitude (or along the two dimensions of
+        a curvilinear grid).
+
+        grid (Grid) optional: The destination grid, if factor is not given.
+        It must be an exact coarsening of the grid of var, e.g. GRID_025
+        for a 0.5 degree variable.  Blocks may straddle the longitude seam.
+
+        likevar (DataArray) optional: A variable whose grid is used as the
+        destination grid, if neither factor nor grid is given.
+
+        area_weighted (bool) optional: Weight each cell by its area on the
+        sphere, rather than taking a plain mean.
+
+        progressbar, min_coverage optional: As for simple_regrid.
+    """
+    if factor is not None:
+        grid = coarse_grid(Grid(array=var), factor)
+    elif grid is None:
+        if likevar is None:
+            raise ValueError("Coarsening requires a factor or a grid.")
+        grid = Grid(array=likevar)
+
+    return simple_regrid(var,
+                         grid=grid,
+                         progressbar=progressbar,
+                         method='coarsen',
+                         min_coverage=min_coverage,
+                         area_weighted=area_weighted)
+
+
+# Every dimension but the horizontal ones is a batch dimension: the same
+# horizontal weights apply at every time, level, ensemble member, etc.
+def batch_dims(var, horizontal=('lat', 'lon')):
+    """The dimensions of var other than the horizontal ones, in order."""
+    return [dim for dim in var.dims if dim not in horizontal]
+
+
+def regridded_coords(var, to_grid, horizontal=('lat', 'lon')):
+    """The coordinates of var regridded onto to_grid.
+
+    Keeps every coordinate that does not depend on the horizontal dimensions
+    of var.
+    """
+    coords = {}
+    for name, coord in var.coords.items():
+        if name in ('lat', 'lon'):
+            continue
+        if not set(coord.dims) & set(horizontal):
+            coords[name] = coord
+    coords.update(to_grid.coords())
+    return coords
+
+
+def regridded_attrs(var, to_grid):
+    """The attributes of var regridded onto to_grid, for writing to a file.
+
+    The attributes that describe how the source was packed don't apply to
+    the regridded values.  Missing values are NaN in the output.
+    """
+    attrs = dict((key, value) for key, value in var.attrs.items()
+                 if key not in ('missing_value', '_FillValue',
+                                'scale_factor', 'add_offset'))
+    attrs['grid'] = str(to_grid)
+    return attrs
+
+
+# The default memory budget, in bytes, for a chunked regrid.
+REGRID_MEMORY_BUDGET = 512*1024*1024
+
+
+def time_block_length(from_grid, to_grid, memory_budget=None, slabs=1):
+    """The number of time steps to regrid at once within a memory budget.
+
+    A block needs room for the source values, a float64 copy of them for the
+    matrix product, and the regridded values.  Each time step has slabs
+    latitude-longitude slabs (e.g. the number of pressure levels).  If
+    to_grid is a list of grids, the block holds the values for all of them.
+    """
+    if memory_budget is None:
+        memory_budget = REGRID_MEMORY_BUDGET
+    if isinstance(to_grid, Grid):
+        to_grid = [to_grid]
+    from_points = from_grid.size
+    to_points = sum(grid.size for grid in to_grid)
+    bytes_per_step = 8*slabs*(2*from_points + to_points)
+    return max(1, int(memory_budget//bytes_per_step))
+
+
+# Blocks of time steps [start, stop) of at most length steps.
+def time_blocks(ntimes, length):
+    for start in range(0, ntimes, length):
+        yield start, min(start + length, ntimes)
+
+
+def chunked_regrid(var, filespec, grid=None, likevar=None, progressbar=None,
+                   method='auto', memory_budget=None, min_coverage=None,
+                   **options):
+    """Regrid a DataArray with a time dimension, block by block.
+
+    Reads the variable a block of time steps at a time, and writes each
+    regridded block straight to disk, so the regrid never holds more than a
+    block in memory.  The size of the block is chosen from memory_budget, in
+    bytes.  This is meant for variables read lazily from a file, which are
+    too big to load.
+
+    The other parameters are as for simple_regrid.  The format of the output
+    is chosen from the extension of filespec:
+
+        .nc     A NetCDF file.  The coordinates are written first, then the
+                file is opened in append mode for each block.
+        .zarr   A Zarr directory store (requires the zarr package).
+        other   A numpy .npy file, written through np.memmap.
+
+    Returns a DataArray backed by the file.  It is loaded on demand.
+    """
+    if 'time' not in var.dims:
+        msg = "A chunked regrid requires a time dimension."
+        raise IndexError(msg)
+
+    if grid is not None:
+        to_coords = grid
+    elif likevar is not None:
+        to_coords = Grid(array=likevar)
+    else:
+        to_coords = GRID_025
+
+    from_coords = Grid(array=var)
+    print "Regridding from {0} to {1} into {2}.".format(
+        str(from_coords), str(to_coords), filespec)
+
+    # Time is the first dimension of the output, so that each block is a
+    # contiguous piece of the file.
+    dims = ['time'] + [dim for dim in batch_dims(var, from_coords.dims)
+                       if dim != 'time']
+    slabs = int(np.prod([var.sizes[dim] for dim in dims[1:]]))
+
+    weights = regrid_weights(from_coords, to_coords, method=method,
+                             **options)
+    block_length = time_block_length(from_coords, to_coords, memory_budget,
+                                     slabs=slabs)
+    ntimes = len(var.time)
+    nblocks = -(-ntimes//block_length)
+    if progressbar is not None:
+        progressbar.start(nblocks)
+
+    name = var.name if var.name is not None else 'regridded'
+    attrs = regridded_attrs(var, to_coords)
+    shape = tuple(var.sizes[dim] for dim in dims) + to_coords.shape
+    to_dims = dims + list(to_coords.dims)
+
+    # A template holds the coordinates, so every format gets them the same
+    # way, including the encoding of the times.
+    template = xr.Dataset(coords=regridded_coords(var, to_coords,
+                                                  from_coords.dims))
+
+    writer = _block_writer(filespec, template, name, to_dims, shape, attrs,
+                           block_length)
+
+    source = var.transpose(*(dims + list(from_coords.dims)))
+    try:
+        for start, stop in time_blocks(ntimes, block_length):
+            block = source[start:stop].values
+            writer.write(start, stop,
+                         apply_weights(weights, block, min_coverage))
+            if progressbar is not None:
+                msg = "Regridded time steps {0} to {1} of {2}.".format(
+                    start, stop - 1, ntimes)
+                progressbar.update(msg)
+    finally:
+        writer.close()
+
+    newvar = writer.open()
+    newvar.attrs['missing_value'] = 'nan'
+    return newvar
+
+
+def multi_regrid(var, grids, progressbar=None, method='auto',
+                 memory_budget=None, min_coverage=None, **options):
+    """Regrid a DataArray onto several grids in a single pass.
+
+    The source is read once, a block of time steps at a time, and every
+    grid's weights are applied to the block while it is in memory.  This is
+    cheaper than a regrid per grid when reading or decoding the source is
+    the expensive part, as it is for files on a network or compressed files.
+
+    Parameters are as for simple_regrid, except grids is a list of Grids.
+    Returns a list of DataArrays, one per grid, in the same order.
+    """
+    from_coords = Grid(array=var)
+    print "Regridding from {0} to {1}.".format(
+        str(from_coords), ", ".join(str(grid) for grid in grids))
+
+    weights = [regrid_weights(from_coords, grid, method=method, **options)
+               for grid in grids]
+
+    dims = batch_dims(var, from_coords.dims)
+    source = var.transpose(*(dims + list(from_coords.dims)))
+    shape = tuple(var.sizes[dim] for dim in dims)
+    outputs = [np.empty(shape + grid.shape) for grid in grids]
+
+    # Without a time dimension the whole variable is one block.
+    if 'time' in dims:
+        axis = dims.index('time')
+        slabs = int(np.prod(shape))//var.sizes['time']
+        block_length = time_block_length(from_coords, grids, memory_budget,
+                                         slabs=slabs)
+        blocks = list(time_blocks(var.sizes['time'], block_length))
+    else:
+        axis = None
+        blocks = [(None, None)]
+
+    if progressbar is not None:
+        progressbar.start(len(blocks))
+    for start, stop in blocks:
+        if axis is None:
+            block = source.values
+            index = Ellipsis
+        else:
+            block = source.isel(time=slice(start, stop)).values
+            index = (slice(None),)*axis + (slice(start, stop),)
+        for output, weight in zip(outputs, weights):
+            output[index] = apply_weights(weight, block, min_coverage)
+        if progressbar is not None:
+            msg = "Regridded block {0} to {1} onto {2} grids.".format(
+                start, stop, len(grids))
+            progressbar.update(msg)
+
+    newvars = []
+    for output, grid in zip(outputs, grids):
+        newvar = xr.DataArray(output,
+                              name=var.name,
+                              attrs=var.attrs,
+                              coords=regridded_coords(var, grid,
+                                                      from_coords.dims),
+                              dims=dims + list(grid.dims))
+        newvar.attrs['missing_value'] = 'nan'
+        newvar.attrs['grid'] = str(grid)
+        newvars.append(newvar)
+    return newvars
+
+
+# The block writers for chunked_regrid and gaussian_smooth.  Each writes the
+# blocks to a different kind of file, and opens the file as a DataArray when
+# done.  The format is chosen from the extension of filespec.
+def _block_writer(filespec, template, name, dims, shape, attrs, block_length):
+    if filespec.endswith('.nc'):
+        writer_class = _NetCDFBlockWriter
+    elif is_zarr(filespec):
+        writer_class = _ZarrBlockWriter
+    else:
+        writer_class = _MemmapBlockWriter
+    return writer_class(filespec, template, name, dims, shape, attrs,
+                        block_length)
+
+
+class _MemmapBlockWriter(object):
+    def __init__(self, filespec, template, name, dims, shape, attrs,
+                 block_length):
+        self._filespec = filespec
+        self._template = template
+        self._name = name
+        self._dims = dims
+        self._attrs = attrs
+        self._out = np.lib.format.open_memmap(filespec, mode='w+',
+                                              dtype=np.float64, shape=shape)
+
+    def write(self, start, stop, block):
+        self._out[start:stop] = block
+
+    def close(self):
+        self._out.flush()
+        del self._out
+
+    def open(self):
+        data = np.load(self._filespec, mmap_mode='r')
+        return xr.DataArray(data,
+                            name=self._name,
+                            attrs=self._attrs,
+                            coords=self._template.coords,
+                            dims=self._dims)
+
+
+class _NetCDFBlockWriter(object):
+    def __init__(self, filespec, template, name, dims, shape, attrs,
+                 block_length):
+        import netCDF4
+        self._filespec = filespec
+        self._name = name
+        template.to_netcdf(filespec, mode='w', format='NETCDF4')
+
+        # The template only has the dimensions of its coordinates.  A batch
+        # dimension without a coordinate (e.g. member) is added here.
+        self._nc = netCDF4.Dataset(filespec, mode='a')
+        for dim, size in zip(dims, shape):
+            if dim not in self._nc.dimensions:
+                self._nc.createDimension(dim, size)
+        ncvar = self._nc.createVariable(
+            name, 'f8', tuple(dims), zlib=True,
+            chunksizes=(min(block_length, shape[0]),) + shape[1:],
+            fill_value=np.NaN)
+        for key, value in attrs.items():
+            if key not in ('_FillValue',):
+                ncvar.setncattr(key, value)
+        self._ncvar = ncvar
+
+    def write(self, start, stop, block):
+        self._ncvar[start:stop] = block
+        self._nc.sync()
+
+    def close(self):
+        self._nc.close()
+
+    def open(self):
+        return xr.open_dataset(self._filespec)[self._name]
+
+
+class _ZarrBlockWriter(object):
+    def __init__(self, filespec, template, name, dims, shape, attrs,
+                 block_length):
+        import zarr
+        self._filespec = filespec
+        self._name = name
+        template.to_zarr(filespec, mode='w')
+
+        # The _ARRAY_DIMENSIONS attribute is how xarray names the dimensions
+        # of a Zarr array.
+        group = zarr.open_group(filespec, mode='a')
+        self._zvar = group.create(
+            name, shape=shape, dtype='f8', fill_value=np.NaN,
+            chunks=(min(block_length, shape[0]),) + shape[1:])
+        # Zarr attributes are JSON, which has no numpy types.
+        for key, value in attrs.items():
+            if hasattr(value, 'tolist'):
+                value = value.tolist()
+            self._zvar.attrs[key] = value
+        self._zvar.attrs['_ARRAY_DIMENSIONS'] = list(dims)
+
+    def write(self, start, stop, block):
+        self._zvar[start:stop] = block
+
+    def close(self):
+        pass
+
+    def open(self):
+        return xr.open_zarr(self._filespec)[self._name]
+
+
+# HDF5 reads and writes whole chunks, and caches 1 MB of them per variable by
+# default.  Chunks about that size suit both reading a map and reading a time
+# series, if they are shaped for it.
+NETCDF_CHUNK_BYTES = 1024*1024
+
+# Each chunk of a Zarr store is a file of its own, so they are bigger: a small
+# chunk costs a file system call to read.
+ZARR_CHUNK_BYTES = 8*1024*1024
+
+# The chunk size for each kind of store that write_netcdf and write_zarr
+# write.
+STORE_CHUNK_BYTES = {'netcdf': NETCDF_CHUNK_BYTES,
+                     'zarr': ZARR_CHUNK_BYTES}
+
+# The most data written to a file at once, in bytes.
+WRITE_BLOCK_BYTES = 64*1024*1024
+
+
+def is_zarr(filespec):
+    """Is filespec a Zarr directory store (by its extension)?"""
+    return filespec.rstrip('/').endswith('.zarr')
+
+
+def open_local(filespec, decode_cf=True):
+    """Open a NetCDF file or a Zarr directory store as a Dataset.
+
+    Only the header is read.  The variables of a Zarr store are dask arrays,
+    with the chunks of the store.  The file is recorded as the 'source' in
+    the encoding of every variable, which identifies the data for the
+    product cache (see products.fingerprint).
+    """
+    if is_zarr(filespec):
+        ds = xr.open_zarr(filespec, decode_cf=decode_cf)
+    else:
+        ds = xr.open_dataset(filespec, decode_cf=decode_cf)
+    for var in ds.variables.values():
+        var.encoding['source'] = filespec
+    return ds
+
+
+def chunk_sizes(var, access='auto', chunk_bytes=None, dtype=None):
+    """The shape of the chunks of a variable in a NetCDF4 file or Zarr store.
+
+    access is how the file will mostly be read: 'map' reads whole maps at
+    one time (and level), so a chunk is one map; 'timeseries' reads the
+    whole time series at a few points, so a chunk is all the times of a
+    small tile; 'auto' shrinks every dimension in the same proportion.
+    chunk_bytes is the size of a chunk (NETCDF_CHUNK_BYTES if None).  dtype
+    is the type written, if not the type of var.  Returns None (no chunking)
+    for an empty variable.
+    """
+    if var.size == 0:
+        return None
+    if chunk_bytes is None:
+        chunk_bytes = NETCDF_CHUNK_BYTES
+    if dtype is None:
+        dtype = var.dtype
+    target = max(1, chunk_bytes//np.dtype(dtype).itemsize)
+    sizes = [var.sizes[dim] for dim in var.dims]
+    horizontal = [i for i, dim in enumerate(var.dims)
+                  if dim in ('lat', 'lon', 'y', 'x', 'cell')]
+    if not horizontal:
+        horizontal = list(range(max(0, var.ndim - 2), var.ndim))
+
+    if access == 'map':
+        return tuple(size if i in horizontal else 1
+                     for i, size in enumerate(sizes))
+
+    if access == 'timeseries' and 'time' in var.dims:
+        along = var.dims.index('time')
+        rest = max(1, target//sizes[along])
+        side = max(1, int(rest**(1.0/max(1, len(horizontal)))))
+        return tuple(size if i == along else
+                     (min(size, side) if i in horizontal else 1)
+                     for i, size in enumerate(sizes))
+
+    if access not in ('auto', 'timeseries'):
+        raise ValueError("Unknown access pattern {0}.".format(access))
+    scale = min(1.0, (float(target)/var.size)**(1.0/var.ndim))
+    return tuple(max(1, min(size, int(round(size*scale)))) for size in sizes)
+
+
+def write_blocks(var, block_bytes=None, align=1):
+    """The blocks, along its first dimension, in which a variable is written.
+
+    The length of a block is a multiple of align, the length of a chunk, so
+    that every chunk is written once, whole.  Returns a list of (start,
+    stop) pairs.
+    """
+    if block_bytes is None:
+        block_bytes = WRITE_BLOCK_BYTES
+    if var.ndim == 0 or var.shape[0] == 0:
+        return [(0, 0)]
+    row_bytes = max(1, var.dtype.itemsize*var.size//var.shape[0])
+    length = max(1, block_bytes//row_bytes)
+    length = max(align, length - length % align)
+    return list(time_blocks(var.shape[0], length))
+
+
+def _written_separately(var):
+    # The numeric data variables are written block by block.  xarray writes
+    # the rest (coordinates, scalars, strings, times) with the template.
+    return var.ndim > 0 and var.dtype.kind in 'iuf'
+
+
+def _write_plan(var, store, float32, access):
+    # The type, the chunks and the blocks a variable is written in.
+    if store not in STORE_CHUNK_BYTES:
+        raise ValueError("Unknown store {0}.".format(store))
+    dtype = var.dtype
+    if float32 and dtype == np.float64:
+        dtype = np.dtype(np.float32)
+    chunks = chunk_sizes(var, access, STORE_CHUNK_BYTES[store], dtype=dtype)
+    blocks = write_blocks(var, align=chunks[0] if chunks else 1)
+    return dtype, chunks, blocks
+
+
+def _written_attrs(var):
+    # The values are written as they are.  A string missing_value (e.g. 'nan'
+    # from a regrid) would break CF decoding.
+    return [(key, value) for key, value in var.attrs.items()
+            if not (key == '_FillValue' or
+                    (key == 'missing_value' and
+                     isinstance(value, basestring)))]
+
+
+def _netcdf_encoding(var, dtype, float32):
+    # The type, the fill value and the packing attributes a variable is
+    # written with.  A variable read from a file is written with the type it
+    # was stored in, unless it was a float and float32 is asked for.
+    encoding = var.encoding
+    encoded = np.dtype(encoding.get('dtype', dtype))
+    if not (float32 and encoded.kind == 'f'):
+        dtype = encoded
+    if '_FillValue' in encoding:
+        fill_value = encoding['_FillValue']
+    elif dtype.kind == 'f':
+        fill_value = np.NaN
+    else:
+        fill_value = encoding.get('missing_value')
+    # xarray moves the packing attributes to the encoding when it decodes a
+    # file.  The _FillValue is set when the variable is created.
+    attrs = [(key, encoding[key]) for key in PACKING_ATTRS
+             if key != '_FillValue' and encoding.get(key) is not None]
+
+    # The non-index coordinates are named in the coordinates attribute, as
+    # xarray does.  They are written with the template.
+    coordinates = " ".join(str(name) for name in var.coords
+                           if name not in var.dims)
+    if coordinates:
+        attrs.append(('coordinates', coordinates))
+    return dtype, fill_value, attrs
+
+
+def _packed(values, dtype, fill_value, scale_factor=None, add_offset=None):
+    # Packs decoded values as CF does: the missing values are the fill
+    # value, the others are (value - add_offset)/scale_factor.
+    values = np.asarray(values)
+    if scale_factor is None and add_offset is None:
+        if fill_value is not None and values.dtype.kind == 'f':
+            values = np.where(np.isnan(values), fill_value, values)
+        return np.asarray(values, dtype=dtype)
+
+    values = np.asarray(values, dtype=np.float64)
+    missing = np.isnan(values)
+    if add_offset is not None:
+        values = values - add_offset
+    if scale_factor is not None:
+        values = values/scale_factor
+    if dtype.kind in 'iu':
+        values = np.around(values)
+    if fill_value is not None:
+        values[missing] = fill_value
+    elif dtype.kind in 'iu':
+        values[missing] = 0
+    return values.astype(dtype)
+
+
+# The netCDF and HDF5 libraries are not thread safe.  Calls to them are made
+# under the locks xarray holds while it reads or writes a file (in the same
+# order), so that threads writing files, reading headers, and xarray reading
+# lazily never call them at the same time.  xarray doesn't hold them for
+# everything it does while writing a file (it creates the variables without
+# them), so a file is written by xarray under _write_lock, which the calls
+# made here hold too, first.
+_write_lock = threading.Lock()
+_netcdf_lock = combine_locks([_write_lock, NETCDFC_LOCK, HDF5_LOCK])
+
+
+def netcdf_lock():
+    """The lock held around calls to the netCDF library."""
+    return _netcdf_lock
+
+
+def init_netcdf_worker():
+    """Give a forked worker process netCDF locks of its own.
+
+    The locks it was forked with may be held by a thread of the parent,
+    which it doesn't have.  Use as the initializer of a process pool.
+    """
+    global _write_lock, _netcdf_lock
+    _write_lock = threading.Lock()
+    _netcdf_lock = combine_locks([_write_lock, threading.Lock()])
+
+
+def write_steps(ds, store='netcdf', float32=False, access='auto'):
+    """The number of progress updates write_netcdf (or write_zarr, if store
+    is 'zarr') makes for a Dataset written with these options."""
+    return 1 + sum(len(_write_plan(var, store, float32, access)[2])
+                   for var in ds.data_vars.values()
+                   if _written_separately(var))
+
+
+def write_netcdf(ds, filespec, progressbar=None, compress=True, complevel=4,
+                 shuffle=True, float32=False, access='auto'):
+    """Write a Dataset to a compressed, chunked NetCDF4 file.
+
+    The data variables are written a block at a time, so a lazily loaded
+    Dataset is never read into memory all at once.
+
+    Parameters
+    ----------
+        ds (Dataset): The Dataset to write.
+
+        filespec (str): The file to write.
+
+        progressbar optional: Updated after each block.  See write_steps
+        for the number of updates.
+
+        compress (bool) optional: Compress the data variables with zlib, at
+        level complevel (1 to 9), after the HDF5 shuffle filter if shuffle
+        is True.  Shuffling makes floating point data compress much better.
+
+        float32 (bool) optional: Write float64 variables as float32, which
+        halves the file for data that isn't that precise anyway.
+
+        access (str) optional: How the file will mostly be read, which sets
+        the shape of the chunks.  See chunk_sizes.
+
+    The encoding of a variable (as xarray reads it from a file) is kept: its
+    dtype, _FillValue, scale_factor and add_offset, which pack the values.
+    The non-index coordinates of a variable are named in its coordinates
+    attribute.
+
+    The netCDF library is called under netcdf_lock(), so files can be
+    written by several threads.  A block is read (and packed) outside it.
+    """
+    import netCDF4
+    separate = [name for name, var in ds.data_vars.items()
+                if _written_separately(var)]
+    with _write_lock:
+        ds.drop(separate).to_netcdf(filespec, mode='w', format='NETCDF4')
+    if progressbar is not None:
+        progressbar.update("Wrote the coordinates of {0}.".format(filespec))
+
+    with netcdf_lock():
+        nc = netCDF4.Dataset(filespec, mode='a')
+    try:
+        for name in separate:
+            var = ds[name]
+            dtype, chunks, blocks = _write_plan(var, 'netcdf', float32,
+                                                access)
+            dtype, fill_value, packing = _netcdf_encoding(var, dtype, float32)
+            with netcdf_lock():
+                for dim, size in var.sizes.items():
+                    if dim not in nc.dimensions:
+                        nc.createDimension(dim, size)
+                ncvar = nc.createVariable(
+                    name, dtype, var.dims, zlib=compress,
+                    complevel=complevel, shuffle=(compress and shuffle),
+                    chunksizes=chunks, fill_value=fill_value)
+
+                ncvar.set_auto_maskandscale(False)
+                for key, value in _written_attrs(var) + packing:
+                    ncvar.setncattr(key, value)
+
+            for start, stop in blocks:
+                block = _packed(var[start:stop].values, dtype, fill_value,
+                                var.encoding.get('scale_factor'),
+                                var.encoding.get('add_offset'))
+                with netcdf_lock():
+                    ncvar[start:stop] = block
+                    nc.sync()
+                if progressbar is not None:
+                    progressbar.update("Wrote {0} {1} to {2}.".format(
+                        name, (start, stop), filespec))
+    finally:
+        with netcdf_lock():
+            nc.close()
+
+
+def write_zarr(ds, filespec, progressbar=None, compress=True, complevel=4,
+               shuffle=True, float32=False, access='auto', threads=1):
+    """Write a Dataset to a compressed, chunked Zarr directory store.
+
+    As write_netcdf, but each chunk is a file of its own, so a window of the
+    data is read without reading the rest, and blocks can be written at the
+    same time, by threads threads.  Requires the zarr package.
+
+    Parameters
+    ----------
+        ds (Dataset): The Dataset to write.
+
+        filespec (str): The store (a directory) to write.  An existing store
+        is replaced.
+
+        progressbar optional: Updated after each block.  See write_steps
+        for the number of updates.
+
+        compress (bool) optional: Compress the chunks with Blosc (zstd), at
+        level complevel (1 to 9), after the byte shuffle filter if shuffle
+        is True.
+
+        float32 (bool) optional: Write float64 variables as float32.
+
+        access (str) optional: How the store will mostly be read, which sets
+        the shape of the chunks.  See chunk_sizes.
+
+        threads (int) optional: The number of blocks written at the same
+        time.  A block is whole chunks, so no two threads write the same
+        chunk.  Blosc and file writes release the GIL.
+    """
+    import zarr
+    from numcodecs import Blosc
+    separate = [name for name, var in ds.data_vars.items()
+                if _written_separately(var)]
+    ds.drop(separate).to_zarr(filespec, mode='w')
+    if progressbar is not None:
+        progressbar.update("Wrote the coordinates of {0}.".format(filespec))
+
+    if compress:
+        compressor = Blosc(cname='zstd', clevel=complevel,
+                           shuffle=Blosc.SHUFFLE if shuffle else
+                           Blosc.NOSHUFFLE)
+    else:
+        compressor = None
+
+    group = zarr.open_group(filespec, mode='a')
+    pool = ThreadPool(threads) if threads > 1 else None
+    try:
+        for name in separate:
+            var = ds[name]
+            dtype, chunks, blocks = _write_plan(var, 'zarr', float32, access)
+            fill_value = np.NaN if dtype.kind == 'f' else None
+            zvar = group.create(name, shape=var.shape, dtype=dtype,
+                                chunks=chunks, compressor=compressor,
+                                fill_value=fill_value, overwrite=True)
+            # Zarr attributes are JSON, which has no numpy types.  The
+            # _ARRAY_DIMENSIONS attribute is how xarray names the dimensions.
+            for key, value in _written_attrs(var):
+                if hasattr(value, 'tolist'):
+                    value = value.tolist()
+                zvar.attrs[key] = value
+            zvar.attrs['_ARRAY_DIMENSIONS'] = list(var.dims)
+
+            def write(block, var=var, zvar=zvar, dtype=dtype):
+                start, stop = block
+                zvar[start:stop] = np.asarray(var[start:stop].values,
+                                              dtype=dtype)
+                return block
+
+            if pool is None:
+                written = (write(block) for block in blocks)
+            else:
+                written = pool.imap_unordered(write, blocks)
+            for start, stop in written:
+                if progressbar is not None:
+                    progressbar.update("Wrote {0} {1} to {2}.".format(
+                        name, (start, stop), filespec))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def write_dataset(ds, filespec, store='netcdf', progressbar=None,
+                  threads=1, **options):
+    """Write a Dataset with write_netcdf, or with write_zarr if store is
+    'zarr'.  threads is used only by write_zarr; the other options are
+    passed to either."""
+    if store == 'zarr':
+        write_zarr(ds, filespec, progressbar=progressbar, threads=threads,
+                   **options)
+    else:
+        write_netcdf(ds, filespec, progressbar=progressbar, **options)
+
+
+# The original regrid.  It interpolates one point of the destination grid, and
+# one time step, at a time.  A regrid of a long time series this way takes
+# hours.
+def _pointwise_regrid(var, grid=None, likevar=None, progressbar=None):
+
+    # Check for regrid capability.  If there are more than three dimensions,
+    # it's not feasible yet.  If there are exactly three, the third must be
+    # time.
+    have_time_dim = (len(var.shape) == 3 and 'time' in var.dims)
+
+    if grid is not None:
+        to_coords = grid
+    elif likevar is not None:
+        to_coords = Grid(array=likevar)
+    else:
+        to_coords = GRID_025
+    
+    # Display the ranges involved in the regrid, for confidence.
+    from_coords = Grid(array=var)
+    print "Regridding from {0} to {1}.".format(str(from_coords),
+                                               str(to_coords))
+
+    # Impose a Delaunay triangulation and an indexing structure
+    # on the variable.
+    varcoords = from_coords.cartesian
+    vartri = Delaunay(varcoords)
+
+    # Create a DataArray object with the new shape filled with np.NaNs.  This
+    # will be filled with values interpolation from the variable var.
+    if have_time_dim:
+        blankdata = np.empty((len(var.time),
+                              to_coords.latlen,
+                              to_coords.lonlen))
+        blankdata.fill(np.NaN)
+        newvar = xr.DataArray(blankdata,
+                              name=var.name,
+                              attrs=var.attrs,
+                              coords={'time': var.time,
+                                      'lat': to_coords.lat,
+                                      'lon': to_coords.lon},
+                              dims=['time', 'lat', 'lon'])
+    else:
+        blankdata = np.empty((to_coords.latlen, to_coords.lonlen))
+        blankdata.fill(np.NaN)
+        newvar = xr.DataArray(blankdata,
+                              name=var.name,
+                              attrs=var.attrs,
+                              coords={'lat': to_coords.lat,
+                                      'lon': to_coords.lon},
+                              dims=['lat', 'lon'])
+    
+    # Set the missing_value attribute to 'NaN (numpy)'.  Set the grid attribute
+    # to the new grid.
+    newvar.attrs['missing_value'] = 'nan'
+    newvar.attrs['grid'] = str(to_coords)
+
+    # Show progress at the latitudes.  Otherwise it's too many.
+    if progressbar is not None:
+        progressbar.start(to_coords.latlen*to_coords.lonlen)
+
+    # Iterate the new variable's grid, calculating the value from an
+    # interpolation of the simplices in the original variable.
+    # FIX ME: The interpolation function is calculated for as many points of
+    # the new variable that fall in a single simplex.  It only needs to be
+    # calculated once per simplex.
+    for i,j in to_coords.grid_points():
+        
+        # These steps produce the i-th simplex (triangle) in the variable.
+        lattice_point = [to_coords.lat[i], to_coords.lon[j]]
+        simplex_number = vartri.find_simplex(lattice_point)
+        if simplex_number >= 0:
+            simplex_points = vartri.simplices[simplex_number]
+            simplex = vartri.points[simplex_points]
+            
+            # These steps produce the n-values of the variable for the
+            # n-simplex.  Since the simplices are triangles, these steps
+            # produce three values.
+            if have_time_dim:
+                for t in range(0, len(var.time)):
+#                for t in range(0, 3):
+                    vals = []
+                    for k, vertex in enumerate(simplex):
+                        val = var.sel(time=var.time[t],
+                                      lat=vertex[0],
+                                      lon=vertex[1])
+                        vals.append(float(val))
+        
+                    # These steps produce the function f that calculates the
+                    # interpolated value anywhere in the simplex (triangle),
+                    # and then calculates that value at the lattice point, and
+                    # assigns it.
+                    f = LinearNDInterpolator(simplex, vals)
+                    x = f([lattice_point])[0]
+                    newvar[t, i, j] = x
+            else:
+                vals = []
+                for k, vertex in enumerate(simplex):
+                    val = var.sel(lat=vertex[0], lon=vertex[1])
+                    vals.append(float(val))
+    
+                # These steps produce the function f that calculates the
+                # interpolated value anywhere in the simplex (triangle), and
+                # then calculates that value at the lattice point, and assigns
+                # it.
+                f = LinearNDInterpolator(simplex, vals)
+                x = f([lattice_point])[0]
+                newvar[i, j] = x
+    
+        # Show progress.
+        if progressbar is not None:
+            msg = ("Calculated values for ({:2.3f}, {:2.3f}).").format(
+                to_coords.lat[i], to_coords.lon[j])
+            progressbar.update(msg)
+
+    return newvar
+
+# The index arrays that put a grid in standard order are the same for every
+# variable on the grid, so they are computed once per grid.
+_standard_orders = WeightCache(maxsize=64)
+
+
+def standard_order(grid):
+    """The index arrays that put a grid in standard order.
+
+    Returns a dictionary of 'lat_index' and 'lon_index', the source position
+    of each standardized latitude and longitude, and 'lat' and 'lon', the
+    standardized coordinates.  The latitudes are increasing, and the
+    longitudes are in [-180, 180) and increasing.
+    """
+    key = _standard_orders.key('standard-latlon', grid)
+    order = _standard_orders.get(key)
+    if order is not None:
+        return order
+
+    if grid.curvilinear:
+        raise ValueError("Only rectilinear grids can be standardized.")
+    lats = np.asarray(grid.lat, dtype=np.float64)
+    lat_index = np.arange(len(lats))
+    if len(lats) > 1 and lats[-1] < lats[0]:
+        lat_index = lat_index[::-1]
+
+    # The negative longitudes may be at the end of the lon array.  Sorting
+    # moves them to the front.
+    lons = np.mod(np.asarray(grid.lon, dtype=np.float64) + 180, 360) - 180
+    lon_index = np.argsort(lons, kind='mergesort')
+
+    order = {'lat_index': lat_index,
+             'lon_index': lon_index,
+             'lat': lats[lat_index],
+             'lon': lons[lon_index]}
+    _standard_orders.put(key, order)
+    return order
+
+
+def standardize_latlon(var):
+    """Standardizes the latitudes and longitudes.
+    
+    Returns the data in a DataArray where the latitudes range from [-90,90] and
+    the longitudes range from [-180, 180).  var may also be a Dataset, in
+    which case every variable on the latitude-longitude grid is standardized.
+
+    The order of the dimensions is not changed.  Nothing is copied: the
+    result is a lazily indexed view of var, which is read (in standard order)
+    only when its values are used.  Call load() to read it all at once.
+    """
+    order = standard_order(Grid(array=var))
+    indexers = {}
+    for dim in ('lat', 'lon'):
+        index = order[dim + '_index']
+        if np.any(index != np.arange(len(index))):
+            indexers[dim] = index
+
+    # The reorder is done on a Dataset, because a DataArray constructor
+    # loads its data.  Only the data variables are deferred; coordinates are
+    # small.
+    if isinstance(var, xr.DataArray):
+        ds = to_temp_dataset(var)
+    else:
+        ds = var.copy(deep=False)
+    for name in ds.data_vars:
+        ds[name] = lazy_variable(ds[name].variable)
+
+    ds = ds.isel(**indexers)
+    ds = ds.assign_coords(lat=order['lat'], lon=order['lon'])
+    ds['lat'].attrs = var['lat'].attrs
+    ds['lon'].attrs = var['lon'].attrs
+
+    if isinstance(var, xr.DataArray):
+        return from_temp_dataset(var, ds)
+    return ds
+
+
+# The attributes that describe how a variable is packed in a file.
+PACKING_ATTRS = ('missing_value', '_FillValue', 'scale_factor', 'add_offset')
+
+# The number of values decoded at a time, which bounds the temporary arrays.
+DECODE_SLAB_SIZE = 4*1024*1024
+
+
+def _packing(attrs):
+    # The numeric packing attributes.  Others (e.g. missing_value = 'nan',
+    # as the regrid functions write) are not packing.
+    packing = {}
+    for key in PACKING_ATTRS:
+        if key not in attrs:
+            continue
+        try:
+            packing[key] = np.asarray(attrs[key], dtype=np.float64)
+        except (TypeError, ValueError):
+            continue
+    return packing
+
+
+def decoded_dtype(dtype, packing):
+    """The float type that holds the decoded values of a packed type.
+
+    float32 is used where it holds the values exactly (as in the CF
+    conventions): float32 data, and 8 or 16 bit integers without an offset.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f' and dtype.itemsize <= 4:
+        return np.dtype(np.float32)
+    if (dtype.kind in 'iu' and dtype.itemsize <= 2 and
+            'add_offset' not in packing):
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+
+def _missing(raw, value):
+    # Missing values are usually 1e+20, but values can be like
+    # 1.0000002e+20, which is different.  Ergo the tolerance.  A NaN fill
+    # value equals nothing, so NaNs are looked for instead, and an infinite
+    # one is matched exactly.
+    if np.isnan(value):
+        if raw.dtype.kind == 'f':
+            return np.isnan(raw)
+        return np.zeros(raw.shape, dtype=bool)
+    if raw.dtype.kind == 'f' and np.isfinite(value):
+        with np.errstate(invalid='ignore'):
+            return np.abs(raw - value) <= 1e-6*abs(value)
+    return raw == value
+
+
+def decode_values(values, packing, dtype):
+    """Replace missing values with NaN, and unpack the values.
+
+    The missing values, the fill value and the scale factor and offset are
+    applied together, a slab of DECODE_SLAB_SIZE values at a time, into a
+    single array of the decoded type.
+    """
+    raw = np.ascontiguousarray(values)
+    out = np.empty(raw.shape, dtype=dtype)
+    flat_raw = raw.reshape(-1)
+    flat_out = out.reshape(-1)
+
+    invalid = []
+    for key in ('missing_value', '_FillValue'):
+        if key in packing:
+            invalid.extend(np.atleast_1d(packing[key]))
+
+    for start in range(0, flat_raw.size, DECODE_SLAB_SIZE):
+        source = flat_raw[start:start + DECODE_SLAB_SIZE]
+        slab = flat_out[start:start + DECODE_SLAB_SIZE]
+        slab[...] = source
+        if 'scale_factor' in packing:
+            slab *= packing['scale_factor']
+        if 'add_offset' in packing:
+            slab += packing['add_offset']
+        for value in invalid:
+            slab[_missing(source, value)] = np.NaN
+    return out
+
+
+def decode_variable(variable):
+    """Lazily decode a Variable read with decode_cf=False.
+
+    Returns a Variable whose values are decoded (see decode_values) only
+    when they are read, and only the part of them that is read.  The
+    packing attributes are moved to the encoding, so the variable is packed
+    the same way if it is written again.  A variable that is not packed is
+    returned as it is.
+    """
+    packing = _packing(variable.attrs)
+    if not packing:
+        return variable
+
+    dtype = decoded_dtype(variable.dtype, packing)
+    attrs = dict((key, value) for key, value in variable.attrs.items()
+                 if key not in packing)
+    encoding = dict(variable.encoding)
+    encoding.update((key, variable.attrs[key]) for key in packing)
+    encoding.setdefault('dtype', variable.dtype)
+
+    def decode(array):
+        return decode_values(np.asarray(array), packing, dtype)
+
+    data = lazy_map(variable, decode, dtype)
+    return xr.Variable(variable.dims, data, attrs, encoding)
+
+
+def decode_dataset(dataset):
+    """Decode the data variables of a Dataset read with decode_cf=False.
+
+    The Dataset is modified, and also returned.  Nothing is read: each
+    variable is decoded as it is read (see decode_variable).
+    """
+    for name in list(dataset.data_vars):
+        dataset[name] = decode_variable(dataset[name].variable)
+    return dataset
+
+
+def transpose_var(data):
+    """Determines if the data in an Xarray DataArray is transposed.
+    
+    Occasionally, the data in a dataset is organized with the longitude
+    coordinate first and the latitude coordinate second.  This is causing
+    problems with the matplotlib contourf and addcyclic methods.
+    
+    This function determines the lon dimension by comparing the shape of the
+    data to the lengths of the latitude and longitude coordinates.  If the
+    shape is such that the longitude is first, the data is transposed and the
+    new DataArray is returned.
+    """
+    data_shape = data.shape
+    if data_shape[0] == len(data.lon.values):
+        # Longitude is first.  It needs to be transposed.
+        var_name = data.name
+        var_data = data.values
+        new_var_data = np.transpose(var_data)
+        new_array = xr.DataArray(new_var_data,
+                                 coords=[data.lat.values, data.lon.values],
+                                 dims=['lat', 'lon'])
+        new_array.name = var_name
+        return new_array
+    else:
+        return data
+
+def get_urs_file(url):
+    username = 'godfrey4000'
+    password = 'J#bunan0'
+#    the_url = 'https://disc2.gesdisc.eosdis.nasa.gov:443/opendap/TRMM_L3/TRMM_3B42.7/1998/001/3B42.19980101.03.7.HDF'
+    session = setup_session(username, password, check_url=url)
+#    dataset = open_url(the_url, session=session)
+    ds = xr.open_dataset(url, decode_cf=False, engine='pydap', session=session)
+    return ds
+
+# Windows longer than this are convolved with an FFT.  A direct convolution
+# costs the length of the window per value; an FFT costs the log of the length
+# of the series.
+FFT_WINDOW_LENGTH = 64
+
+
+def convolve_time(data, window, axis=0, method='auto'):
+    """Convolve data with a 1-D window along one axis.
+
+    The result has the same shape as data, and the data is taken to be zero
+    beyond its ends (as scipy.signal.convolve with 'same').
+
+    method is 'direct', 'fft', or 'auto', which uses an FFT for windows
+    longer than FFT_WINDOW_LENGTH.  NaN values spoil an FFT convolution
+    entirely, so 'auto' never uses one for data with NaNs in it.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    window = np.asarray(window, dtype=np.float64)
+    if method == 'auto':
+        if len(window) > FFT_WINDOW_LENGTH and not np.isnan(data).any():
+            method = 'fft'
+        else:
+            method = 'direct'
+
+    if method == 'direct':
+        return convolve1d(data, window, axis=axis, mode='constant', cval=0.0)
+    if method != 'fft':
+        raise ValueError("Unknown convolution method {0}.".format(method))
+
+    # Zero padding to the full length of the convolution makes the circular
+    # FFT convolution a linear one.
+    length = data.shape[axis]
+    nfft = next_fast_len(length + len(window) - 1)
+    shape = [1]*data.ndim
+    shape[axis] = -1
+    spectrum = (np.fft.rfft(data, nfft, axis=axis) *
+                np.reshape(np.fft.rfft(window, nfft), shape))
+    full = np.fft.irfft(spectrum, nfft, axis=axis)
+
+    start = (len(window) - 1)//2
+    index = [slice(None)]*data.ndim
+    index[axis] = slice(start, start + length)
+    return full[tuple(index)]
+
+
+def gaussian_smooth(var, sigma, method='auto', chunk_length=None,
+                    outfile=None, memory_budget=None, progressbar=None):
+    """Apply a filter, along the time dimension.
+    
+    Applies a gaussian filter to the data along the time dimension.  if the
+    time dimension is missing, raises an exception.  The DataArray that is
+    returned has the same shape as var.  Beyond the ends of the time series
+    the data are taken to be zero.
+    
+    The width of the window is 2xsigma + 1.
+
+    Parameters
+    ----------
+        var (DataArray): The variable to smooth.
+
+        sigma (int): The standard deviation of the gaussian, in time steps.
+
+        method (str) optional: 'direct', 'fft' or 'auto'.  See
+        convolve_time.
+
+        chunk_length (int) optional: If given, the variable is read and
+        smoothed this many time steps at a time, each chunk with sigma extra
+        time steps (the half-width of the window) on each side, so the
+        result is the same as smoothing it whole.  A lazily loaded variable
+        is then never read into memory all at once.
+
+        outfile (str) optional: If given, the smoothed chunks are written to
+        this file as they are done, as for chunked_regrid, and a DataArray
+        backed by the file is returned.  Time is its first dimension.  If
+        chunk_length is not given, it is chosen from memory_budget.
+
+        memory_budget (int) optional: The memory, in bytes, for a chunk.  The
+        default is REGRID_MEMORY_BUDGET.
+
+        progressbar optional: A progress bar to show progress of the chunks.
+    """
+    if type(var) is not xr.DataArray:
+        raise TypeError("First argument must be an Xarray DataArray.")
+    if 'time' not in var.dims:
+        raise IndexError("Time coordinate not found.")
+
+    # Use a normalized gaussian so the average of the variable does not change.
+    gausswin = gaussian(2*sigma + 1, sigma)
+    gausswin = gausswin/np.sum(gausswin)
+
+    # The gaussian is a 1-D filter, so it is a 1-D convolution along time,
+    # rather than an N-D convolution with a window that is 1 in every other
+    # dimension.
+    if chunk_length is None and outfile is None:
+        timepos = var.dims.index('time')
+        out = convolve_time(var.values, gausswin, axis=timepos, method=method)
+        outda = xr.DataArray(out,
+                             name=var.name,
+                             coords=var.coords,
+                             dims=var.dims)
+        outda.attrs = var.attrs
+        return outda
+
+    return _streaming_smooth(var, gausswin, method, chunk_length, outfile,
+                             memory_budget, progressbar)
+
+
+def _streaming_smooth(var, window, method, chunk_length, outfile,
+                      memory_budget, progressbar):
+    # Time is the first dimension, so each chunk is a contiguous piece of the
+    # source and of the output.
+    dims = ['time'] + [dim for dim in var.dims if dim != 'time']
+    source = var.transpose(*dims)
+    ntimes = source.shape[0]
+    halo = (len(window) - 1)//2
+
+    # The chunk, its halo, the float64 copy and the smoothed chunk.
+    if chunk_length is None:
+        if memory_budget is None:
+            memory_budget = REGRID_MEMORY_BUDGET
+        step_bytes = 8*int(np.prod(source.shape[1:]))
+        chunk_length = max(1, memory_budget//(3*step_bytes) - 2*halo)
+    chunk_length = min(chunk_length, ntimes)
+
+    attrs = dict((key, value) for key, value in var.attrs.items()
+                 if key not in ('_FillValue', 'scale_factor', 'add_offset'))
+    if outfile is not None:
+        template = xr.Dataset(coords=source.coords)
+        writer = _block_writer(outfile, template, var.name or 'smoothed',
+                               dims, source.shape, attrs, chunk_length)
+        out = None
+    else:
+        out = np.empty(source.shape)
+
+    chunks = list(time_blocks(ntimes, chunk_length))
+    if progressbar is not None:
+        progressbar.start(len(chunks))
+
+    try:
+        for start, stop in chunks:
+            lower = max(0, start - halo)
+            upper = min(ntimes, stop + halo)
+            smoothed = convolve_time(source[lower:upper].values, window,
+                                     axis=0, method=method)
+            smoothed = smoothed[start - lower:stop - lower]
+            if out is None:
+                writer.write(start, stop, smoothed)
+            else:
+                out[start:stop] = smoothed
+            if progressbar is not None:
+                msg = "Smoothed time steps {0} to {1} of {2}.".format(
+                    start, stop - 1, ntimes)
+                progressbar.update(msg)
+    finally:
+        if out is None:
+            writer.close()
+
+    if out is None:
+        return writer.open()
+    outda = xr.DataArray(out,
+                         name=var.name,
+                         coords=source.coords,
+                         dims=dims)
+    outda.attrs = attrs
+    return outda.transpose(*var.dims)
+
+
+# The mean radius of the earth, in km.
+EARTH_RADIUS = 6371.0
+
+
+# A spatial filter of a fixed width in km is a different filter in degrees at
+# every latitude.  It is applied as two 1-D passes: along longitude, with a
+# kernel that widens (in degrees) toward the poles, then along latitude.
+class SmoothingKernel(object):
+    """A separable smoothing kernel on a rectilinear grid.
+
+    lat_matrix is an (N, N) matrix that smooths along the N latitudes.  Its
+    rows sum to one.  lon_spectrum is an (N, nfft//2 + 1) array of the FFT of
+    the longitude kernel at each latitude, and lon_norm an (N, M) array of
+    the sum of the kernel weights that fall on the M longitudes.  If the
+    longitudes wrap, nfft is M and the convolution is circular.  Otherwise
+    the data is zero padded, and the kernel is renormalized at the edges.
+    """
+    def __init__(self, lat_matrix, lon_spectrum, lon_norm, nfft, grid):
+        self.lat_matrix = lat_matrix
+        self.lon_spectrum = lon_spectrum
+        self.lon_norm = lon_norm
+        self.nfft = nfft
+        self.grid = grid
+
+    def apply(self, data):
+        """Smooth data defined on the grid.
+
+        The last two axes of data must be latitude and longitude, in that
+        order.  All the leading axes (time, levels, ...) are smoothed at
+        once.
+        """
+        data = np.asarray(data, dtype=np.float64)
+        nlon = data.shape[-1]
+        spectrum = np.fft.rfft(data, self.nfft, axis=-1)*self.lon_spectrum
+        out = np.fft.irfft(spectrum, self.nfft, axis=-1)[..., :nlon]
+        out = out/self.lon_norm
+        return np.matmul(self.lat_matrix, out)
+
+    def arrays(self):
+        """Return the kernel as a dictionary of arrays."""
+        return {'lat_matrix': self.lat_matrix,
+                'lon_spectrum': self.lon_spectrum,
+                'lon_norm': self.lon_norm,
+                'nfft': np.array(self.nfft)}
+
+    @classmethod
+    def from_arrays(cls, arrays, grid):
+        """Create the kernel from the output of arrays()."""
+        return cls(arrays['lat_matrix'], arrays['lon_spectrum'],
+                   arrays['lon_norm'], int(arrays['nfft']), grid)
+
+
+def _kernel_weights(distance, radius, kind):
+    # The weight of a point distance km from the center.
+    if kind == 'gaussian':
+        return np.exp(-0.5*(distance/radius)**2)
+    if kind == 'boxcar':
+        return (distance <= radius).astype(np.float64)
+    raise ValueError("Unknown smoothing kernel {0}.".format(kind))
+
+
+def smoothing_kernel(grid, radius, kind='gaussian'):
+    """Compute the smoothing kernel of a given width for a grid.
+
+    Parameters
+    ----------
+        grid (Grid): A rectilinear grid with evenly spaced longitudes.
+
+        radius (float): The width of the kernel, in km: the standard
+        deviation of a gaussian, or the half-width of a boxcar.
+
+        kind (str) optional: 'gaussian' or 'boxcar'.
+
+    Returns a SmoothingKernel.
+    """
+    if not grid.rectilinear:
+        raise ValueError("Spatial smoothing requires a rectilinear grid.")
+    lats = np.asarray(grid.lat, dtype=np.float64)
+    lons = np.asarray(grid.lon, dtype=np.float64)
+    nlon = len(lons)
+    spacing = lons[1] - lons[0]
+    if not np.allclose(np.diff(lons), spacing):
+        raise ValueError("Spatial smoothing requires evenly spaced "
+                         "longitudes.")
+
+    # Along latitude the distance between rows is the same everywhere.  The
+    # rows are normalized, so the kernel is truncated at the poles.
+    distance = EARTH_RADIUS*np.radians(np.abs(lats[:, np.newaxis] -
+                                              lats[np.newaxis, :]))
+    lat_matrix = _kernel_weights(distance, radius, kind)
+    lat_matrix = lat_matrix/lat_matrix.sum(axis=1)[:, np.newaxis]
+
+    # Along longitude the distance shrinks with the cosine of the latitude.
+    # Position i of the FFT kernel is an offset of i cells, or i - nfft for
+    # the negative offsets.
+    if grid.lon_wraps:
+        nfft = nlon
+        offsets = np.arange(nfft)
+        offsets = np.where(offsets > nfft//2, offsets - nfft, offsets)
+    else:
+        nfft = next_fast_len(2*nlon - 1)
+        offsets = np.arange(nfft)
+        offsets = np.where(offsets >= nlon, offsets - nfft, offsets)
+    arc = np.radians(np.abs(offsets*spacing))
+    coslat = np.clip(np.cos(np.radians(lats)), 0, 1)
+    distance = EARTH_RADIUS*coslat[:, np.newaxis]*arc[np.newaxis, :]
+    lon_kernel = _kernel_weights(distance, radius, kind)
+    if not grid.lon_wraps:
+        lon_kernel[:, np.abs(offsets) >= nlon] = 0
+    lon_spectrum = np.fft.rfft(lon_kernel, nfft, axis=-1)
+
+    # The weight that falls on the grid, for each point.  With wrapping
+    # longitudes it is the whole kernel.
+    ones = np.ones((len(lats), nlon))
+    lon_norm = np.fft.irfft(np.fft.rfft(ones, nfft, axis=-1)*lon_spectrum,
+                            nfft, axis=-1)[:, :nlon]
+
+    return SmoothingKernel(lat_matrix, lon_spectrum, lon_norm, nfft, grid)
+
+
+def cached_smoothing_kernel(grid, radius, kind='gaussian', cache=None):
+    """Return the smoothing kernel for a grid, from the cache if possible.
+
+    Kernels are cached with the regrid weights, keyed by the grid, the kind
+    and the radius.  If cache is None, the shared weight cache is used.
+    """
+    if cache is None:
+        cache = weight_cache
+    key = cache.key("smooth-{0}-{1}".format(kind, float(radius)), grid)
+    arrays = cache.get(key)
+    if arrays is not None:
+        return SmoothingKernel.from_arrays(arrays, grid)
+
+    kernel = smoothing_kernel(grid, radius, kind)
+    cache.put(key, kernel.arrays())
+    return kernel
+
+
+def spatial_smooth(var, radius, kind='gaussian', min_coverage=1e-3):
+    """Apply a filter, along latitude and longitude.
+
+    Smooths a map (e.g. before contouring) with a kernel of a fixed width on
+    the surface of the earth.  Every other dimension (time, plev, ...) is
+    smoothed at once, with the same kernel.
+
+    Parameters
+    ----------
+        var (DataArray): The variable to smooth.  It must be on a rectilinear
+        grid, with evenly spaced longitudes.
+
+        radius (float): The width of the kernel, in km: the standard
+        deviation of a gaussian, or the half-width of a boxcar.
+
+        kind (str) optional: 'gaussian' (the default) or 'boxcar'.
+
+        min_coverage (float) optional: NaN values (e.g. land in an ocean
+        field) are left out, and the kernel renormalized around them.  A
+        smoothed value is NaN if less than this fraction of the kernel weight
+        falls on valid values.  See apply_weights.
+    """
+    if type(var) is not xr.DataArray:
+        raise TypeError("First argument must be an Xarray DataArray.")
+    if 'lat' not in var.dims or 'lon' not in var.dims:
+        raise IndexError("Spatial smoothing requires latitude and longitude "
+                         "dimensions.")
+
+    grid = Grid(array=var)
+    kernel = cached_smoothing_kernel(grid, radius, kind)
+
+    dims = batch_dims(var, grid.dims) + list(grid.dims)
+    data = var.transpose(*dims).values
+    outda = xr.DataArray(apply_weights(kernel, data, min_coverage),
+                         name=var.name,
+                         coords=var.coords,
+                         dims=dims)
+    outda.attrs = var.attrs
+    return outda.transpose(*var.dims)
@@ -5,7 +5,7 @@ from setuptools import setup, find_packages
 
 setup (
 	name='ncexplorer',
-	version='0.7.2'
+	version='0.7.2',
 	description='Climate data analysis utility.',
 	long_description='Climate data analysis utility.',
 	url='https://github.com/godfrey4000/ncexplorer',
@@ -22,5 +22,6 @@ setup (
 	# The packages
 	packages=find_packages(exclude=['docs', 'etc', 'ncexplorer/test']),
 #	install_requires=['xarray', 'esgf-pyclient'],
+	install_requires=['xarray>=0.11'],
 )
 